@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Gunicorn settings: workers only take requests once they are warm.
+
+With ``preload_app`` the master imports the app, waits for its warm-up and
+readiness probes, and forks workers that inherit the loaded models.
+Without it, every worker warms itself before it accepts a connection.
+Either way ``/readyz`` reports the probe results.
+"""
+import json
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+preload_app = os.environ.get('PRELOAD', '1') == '1'
+wsgi_app = 'app:app'
+
+
+def warm(app, log):
+    thread = app.extensions.get('warm_up')
+    if thread is not None:
+        thread.join()
+    readiness = app.extensions['readiness']
+    if not readiness.ready:
+        readiness.run()
+    log.info('readiness: %s', json.dumps(readiness.report()))
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        warm(server.app.wsgi(), server.log)
+
+
+def post_worker_init(worker):
+    if not worker.cfg.preload_app:
+        warm(worker.wsgi, worker.log)
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Columnar store of the historical monthly rainfall record.
+
+On disk the store is a directory of raw little-endian column files plus a
+JSON manifest:
+
+    code.u1      uint8 subdivision code per row
+    year.i2      int16 year per row
+    monthly.f32  float32 JAN..DEC per row, row-major
+    manifest.json
+
+Rows are only ever appended; the manifest's row count is written last,
+so readers never see a half-written append. When a (subdivision, year)
+appears more than once the latest row wins.
+
+``HistoryStore`` loads the columns once, orders them by subdivision and
+year into contiguous arrays and keeps an offset per subdivision, so range
+queries are slices (views) of those arrays rather than copies.
+"""
+import json
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+import click
+import numpy as np
+
+from src.features.build_features import MONTHS, load_rainfall
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; builds are not serialized there
+    fcntl = None
+
+STORE_DIR = 'data/processed/history'
+COLUMNS = {
+    'code': ('code.u1', np.dtype('<u1'), ()),
+    'year': ('year.i2', np.dtype('<i2'), ()),
+    'monthly': ('monthly.f32', np.dtype('<f4'), (len(MONTHS),)),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def read_manifest(store_dir=STORE_DIR):
+    with open(Path(store_dir) / 'manifest.json') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, store_dir=STORE_DIR):
+    path = Path(store_dir) / 'manifest.json'
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def append_rows(df, store_dir=STORE_DIR):
+    """Append rainfall rows (SUBDIVISION, YEAR, JAN..DEC) to the store.
+
+    Existing rows are left untouched. Returns the updated manifest.
+    """
+    store_dir = Path(store_dir)
+    if (store_dir / 'manifest.json').exists():
+        manifest = read_manifest(store_dir)
+    else:
+        store_dir.mkdir(parents=True, exist_ok=True)
+        manifest = {'rows': 0, 'subdivisions': [], 'centroids': {}}
+    subdivisions = manifest['subdivisions']
+    for name in df['SUBDIVISION'].unique():
+        if name not in subdivisions:
+            subdivisions.append(name)
+    if len(subdivisions) > np.iinfo(COLUMNS['code'][1]).max + 1:
+        raise ValueError('too many subdivisions for a uint8 code')
+    if {'Latitude', 'Longitude'} <= set(df.columns):
+        for name, lat, lon in df[['SUBDIVISION', 'Latitude',
+                                  'Longitude']].drop_duplicates(
+                                      'SUBDIVISION').itertuples(index=False):
+            manifest['centroids'][name] = [float(lat), float(lon)]
+
+    positions = {name: i for i, name in enumerate(subdivisions)}
+    columns = {
+        'code': df['SUBDIVISION'].map(positions).to_numpy(),
+        'year': df['YEAR'].to_numpy(),
+        'monthly': df[MONTHS].to_numpy(),
+    }
+    rows = manifest['rows']
+    for name, (filename, dtype, _) in COLUMNS.items():
+        path = store_dir / filename
+        with open(path, 'ab') as f:
+            # Drop any tail left by an append that never committed.
+            f.truncate(rows * dtype.itemsize * _width(name))
+            f.write(np.ascontiguousarray(columns[name], dtype=dtype)
+                    .tobytes())
+    manifest['rows'] = rows + len(df)
+    write_manifest(manifest, store_dir)
+    return manifest
+
+
+def _width(name):
+    return int(np.prod(COLUMNS[name][2], dtype=int))
+
+
+def read_columns(store_dir=STORE_DIR, manifest=None):
+    """Committed rows of every column, in append order."""
+    manifest = manifest or read_manifest(store_dir)
+    rows = manifest['rows']
+    columns = {}
+    for name, (filename, dtype, shape) in COLUMNS.items():
+        data = np.fromfile(Path(store_dir) / filename, dtype=dtype,
+                           count=rows * _width(name))
+        columns[name] = data.reshape((rows,) + shape)
+    return columns
+
+
+class HistoryStore:
+    """In-memory, subdivision-ordered view of the columnar store."""
+
+    def __init__(self, subdivisions, codes, years, monthly, centroids=None):
+        self.subdivisions = list(subdivisions)
+        self.centroids = centroids or {}
+        # Stable sort by (code, year); keep the last of duplicate keys.
+        order = np.lexsort((np.arange(len(codes)), years, codes))
+        codes, years = codes[order], years[order]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (codes[1:] != codes[:-1]) | (years[1:] != years[:-1])
+        keep = order[last]
+
+        self.codes = np.ascontiguousarray(codes[last])
+        self.years = np.ascontiguousarray(years[last])
+        self.monthly = np.ascontiguousarray(monthly[keep],
+                                            dtype=np.float32)
+        self.offsets = np.searchsorted(
+            self.codes, np.arange(len(self.subdivisions) + 1))
+        self._positions = {name: i for i, name in
+                           enumerate(self.subdivisions)}
+
+    @classmethod
+    def load(cls, store_dir=STORE_DIR):
+        manifest = read_manifest(store_dir)
+        columns = read_columns(store_dir, manifest)
+        return cls(manifest['subdivisions'], columns['code'],
+                   columns['year'], columns['monthly'],
+                   manifest.get('centroids'))
+
+    def _rows(self, subdivision, start=None, end=None):
+        i = self._positions[subdivision]
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        years = self.years[lo:hi]
+        if start is not None:
+            lo += np.searchsorted(years, start, side='left')
+        if end is not None:
+            hi = self.offsets[i] + np.searchsorted(years, end, side='right')
+        return lo, max(lo, hi)
+
+    def series(self, subdivision, start=None, end=None):
+        """Years and (n, 12) monthly values of one subdivision (views)."""
+        lo, hi = self._rows(subdivision, start, end)
+        return self.years[lo:hi], self.monthly[lo:hi]
+
+    def month(self, month, start=None, end=None, last=None):
+        """One month of every subdivision: name -> (years, values) views.
+
+        ``last`` keeps the most recent ``last`` years of each subdivision.
+        """
+        column = MONTHS.index(month)
+        result = {}
+        for name in self.subdivisions:
+            lo, hi = self._rows(name, start, end)
+            if last is not None:
+                lo = max(lo, hi - last)
+            result[name] = (self.years[lo:hi], self.monthly[lo:hi, column])
+        return result
+
+    def memory_usage(self):
+        """Bytes held by the store's arrays."""
+        return {name: int(getattr(self, name).nbytes)
+                for name in ('codes', 'years', 'monthly', 'offsets')}
+
+
+def build_store(df, store_dir=STORE_DIR):
+    """Create a fresh store from a rainfall DataFrame."""
+    store_dir = Path(store_dir)
+    for filename, _, _ in COLUMNS.values():
+        (store_dir / filename).unlink(missing_ok=True)
+    (store_dir / 'manifest.json').unlink(missing_ok=True)
+    return append_rows(df, store_dir)
+
+
+@contextmanager
+def _build_lock(store_dir):
+    with open(Path(store_dir) / 'build.lock', 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def open_store(data_path, store_dir=STORE_DIR):
+    """Load the store, building it from ``data_path`` the first time.
+
+    Workers starting together would otherwise all build it at once, so
+    the build holds a lock file in the store directory. The others wait
+    for it and then load the finished store.
+    """
+    store_dir = Path(store_dir)
+    if not (store_dir / 'manifest.json').exists():
+        store_dir.mkdir(parents=True, exist_ok=True)
+        with _build_lock(store_dir):
+            if not (store_dir / 'manifest.json').exists():
+                build_store(load_rainfall(data_path), store_dir)
+    return HistoryStore.load(store_dir)
+
+
+@click.command()
+@click.argument('data_path', type=click.Path(exists=True))
+@click.option('--output', default=STORE_DIR, show_default=True)
+def main(data_path, output):
+    """ Builds the columnar history store from the rainfall CSV.
+    """
+    manifest = build_store(load_rainfall(data_path), output)
+    store = HistoryStore.load(output)
+    logger.info('%d rows, %d subdivisions, %d bytes in memory',
+                manifest['rows'], len(manifest['subdivisions']),
+                sum(store.memory_usage().values()))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
@@ -1,28 +1,356 @@
 # -*- coding: utf-8 -*-
-import click
+"""Incremental ingestion of new rainfall releases.
+
+New IMD data arrives as CSV files in one of two layouts:
+
+* yearly: one row per (SUBDIVISION, YEAR) with JAN..DEC, as in
+  ``Rainfall_Data_LL.csv``. A row replaces the whole year.
+* monthly: one row per (SUBDIVISION, YEAR, MONTH) with RAINFALL, where
+  MONTH is JAN..DEC or 1..12. A row fills in one month of a year and
+  keeps the months already known.
+
+Rows are validated, and files are applied in order, so the last row for a
+(SUBDIVISION, YEAR) wins. A year equal to the one already stored is
+dropped as unchanged. The rest are written into ``Rainfall_Data_LL.csv``,
+which the region models are trained on, and appended to the columnar
+history store, never rewriting earlier rows there. The climatology cube
+then recomputes only the decades and subdivisions they touch. The store
+is written last, so a run that fails part way is simply run again.
+
+Each run that changes anything writes a change set to
+``<output>/changes/``. It is a JSON file listing the added and revised
+years per subdivision, the region models those subdivisions feed, and
+the rejected rows with reasons, so downstream training can refit only
+what changed from the updated CSV. The cube's ``source`` moves on with
+every change set, so cached API responses built from it change their
+ETags.
+"""
+import hashlib
+import json
 import logging
+import math
+import os
+from datetime import datetime
 from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
 from dotenv import find_dotenv, load_dotenv
 
+from src.data.history import append_rows, open_store, read_manifest
+from src.features.build_features import MONTHS, SEASONS
+from src.features.climatology import PERIODS, file_hash, load_or_build
+from src.models.registry import RAINFALL_DATA, SUBDIVISION_REGIONS
+
+MAX_MONTHLY_MM = 10000.0
+
+logger = logging.getLogger(__name__)
+
+
+def release_files(input_path):
+    """The CSV files of a release: a file, or every CSV in a directory."""
+    path = Path(input_path)
+    if path.is_dir():
+        return sorted(path.glob('*.csv'))
+    return [path]
+
+
+def _month(value):
+    value = str(value).strip().upper()
+    if value.isdigit() and 1 <= int(value) <= 12:
+        return int(value) - 1
+    return MONTHS.index(value[:3]) if value[:3] in MONTHS else None
+
+
+def _rainfall(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None, 'not a number'
+    if math.isnan(value):
+        return value, None
+    if not 0 <= value <= MAX_MONTHLY_MM:
+        return None, 'outside 0..{:g} mm'.format(MAX_MONTHLY_MM)
+    return value, None
+
+
+def _check_columns(df, path, monthly):
+    required = ['SUBDIVISION', 'YEAR'] + (['MONTH', 'RAINFALL'] if monthly
+                                          else MONTHS)
+    missing = [column for column in required if column not in df.columns]
+    if missing:
+        raise click.UsageError('{}: missing columns {}'.format(
+            path, ', '.join(missing)))
+
+
+def _key(row, first_year, last_year):
+    """(subdivision, year, reason) of a row; reason is None if valid."""
+    subdivision = row['SUBDIVISION'].strip()
+    try:
+        year = int(row['YEAR'])
+    except ValueError:
+        year = None
+    if not subdivision:
+        return subdivision, year, 'no SUBDIVISION'
+    if year is None or not first_year <= year <= last_year:
+        return subdivision, year, 'YEAR not in {}..{}'.format(first_year,
+                                                              last_year)
+    return subdivision, year, None
+
+
+def _monthly_values(row):
+    month = _month(row['MONTH'])
+    if month is None:
+        return None, 'unknown MONTH {!r}'.format(row['MONTH'])
+    value, reason = _rainfall(row['RAINFALL'])
+    return {month: value}, reason
+
+
+def _yearly_values(row):
+    values = {}
+    for i, name in enumerate(MONTHS):
+        value, reason = _rainfall(row[name] if row[name] != '' else 'nan')
+        if reason is not None:
+            return None, '{} {}'.format(name, reason)
+        values[i] = value
+    return values, None
+
+
+def read_release(path, first_year, last_year):
+    """Valid (subdivision, year, {month: mm}) updates and rejected rows."""
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    df.columns = [column.strip() for column in df.columns]
+    monthly = 'MONTH' in df.columns
+    _check_columns(df, path, monthly)
+    parse = _monthly_values if monthly else _yearly_values
+
+    updates, rejected = [], []
+    # Line numbers count the header as line 1
+    for line, row in zip(range(2, len(df) + 2), df.to_dict('records')):
+        subdivision, year, reason = _key(row, first_year, last_year)
+        if reason is None:
+            values, reason = parse(row)
+        if reason is not None:
+            rejected.append({'file': str(path), 'line': line,
+                             'reason': reason})
+            continue
+        updates.append((subdivision, year, values, monthly))
+    return updates, rejected
+
+
+def merge_updates(updates, store):
+    """Apply updates in order; returns (subdivision, year) -> 12 months."""
+    merged = {}
+    for subdivision, year, values, partial in updates:
+        key = (subdivision, year)
+        if partial:
+            current = merged.get(key)
+            if current is None:
+                current = stored_year(store, subdivision, year)
+            current = current.copy()
+        else:
+            current = np.full(len(MONTHS), np.nan)
+        for month, value in values.items():
+            current[month] = value
+        merged[key] = current
+    return merged
+
+
+def stored_year(store, subdivision, year):
+    """The stored months of a year, or all NaN."""
+    if subdivision in store.subdivisions:
+        years, values = store.series(subdivision, year, year)
+        if len(years):
+            # Back to the shortest decimals, as they are in the CSV
+            return values[0].astype(str).astype(np.float64)
+    return np.full(len(MONTHS), np.nan)
+
+
+def rainfall_frame(rows):
+    """Rows in the layout of ``Rainfall_Data_LL.csv``, totals included."""
+    df = pd.DataFrame(
+        [[subdivision, year, *values]
+         for (subdivision, year), values in rows.items()],
+        columns=['SUBDIVISION', 'YEAR'] + MONTHS)
+    df['YEAR'] = df['YEAR'].astype(np.int64)
+    # A total with a missing month is missing as well
+    df['ANNUAL'] = df[MONTHS].sum(axis=1, min_count=len(MONTHS))
+    for season, months in SEASONS.items():
+        columns = [MONTHS[month - 1] for month in months]
+        df[season] = df[columns].sum(axis=1, min_count=len(columns))
+    return df
+
+
+def write_rainfall(data_path, df):
+    """Write changed rows back into the rainfall CSV the models train on.
+
+    Known years are replaced in place and new years are added after the
+    others of their subdivision. Years with a missing month are left out
+    until they are complete, since the ARIMA fits take no gaps, and so
+    are subdivisions without a row in the CSV, which have no centroid
+    there. Returns the number of rows left out.
+    """
+    # Parsed exactly, so the rows that did not change are written back
+    # as they were
+    base = pd.read_csv(data_path, float_precision='round_trip')
+    known = (df['SUBDIVISION'].isin(set(base['SUBDIVISION']))
+             & df[MONTHS].notna().all(axis=1)).to_numpy()
+    keys = pd.MultiIndex.from_frame(base[['SUBDIVISION', 'YEAR']])
+    positions = keys.get_indexer(
+        pd.MultiIndex.from_frame(df[['SUBDIVISION', 'YEAR']]))
+    replace = known & (positions >= 0)
+    base.loc[positions[replace], PERIODS] = df.loc[replace, PERIODS].to_numpy()
+
+    new = df.loc[known & (positions < 0), ['SUBDIVISION', 'YEAR'] + PERIODS]
+    centroids = base.drop_duplicates('SUBDIVISION').set_index(
+        'SUBDIVISION')[['Latitude', 'Longitude']]
+    new = new.join(centroids, on='SUBDIVISION')
+    new.insert(0, 'Name', ['ROW{}'.format(i) for i in
+                           range(len(base) + 1, len(base) + len(new) + 1)])
+    merged = pd.concat([base, new[base.columns]], ignore_index=True)
+    order = {name: i for i, name in enumerate(merged['SUBDIVISION'].unique())}
+    merged = merged.iloc[np.lexsort((merged['YEAR'],
+                                     merged['SUBDIVISION'].map(order)))]
+
+    path = Path(data_path)
+    tmp = path.with_suffix('.tmp')
+    merged.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+    return int((~known).sum())
+
+
+def change_set_id(previous, df):
+    digest = hashlib.sha1(previous.encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy()
+                  .tobytes())
+    return digest.hexdigest()[:12]
+
+
+def ingest(files, output, data_path=RAINFALL_DATA, dry_run=False):
+    """Ingest release files; returns the change set (None if no change)."""
+    output = Path(output)
+    store_dir, cube_path = output / 'history', output / 'climatology.npz'
+    store = open_store(data_path, store_dir)
+    updates, rejected = [], []
+    # The climatology cannot take years before the record starts
+    first_year = int(store.years.min())
+    for path in files:
+        file_updates, file_rejected = read_release(path, first_year,
+                                                   datetime.now().year)
+        updates += file_updates
+        rejected += file_rejected
+        logger.info('%s: %d rows, %d rejected', path, len(file_updates),
+                    len(file_rejected))
+
+    added, revised, changed = {}, {}, {}
+    unchanged = 0
+    for (subdivision, year), values in merge_updates(updates, store).items():
+        stored = stored_year(store, subdivision, year)
+        # Compared at the store's float32 precision
+        if np.array_equal(stored.astype(np.float32), values.astype(np.float32),
+                          equal_nan=True):
+            unchanged += 1
+            continue
+        known = not np.isnan(stored).all()
+        (revised if known else added).setdefault(subdivision, []).append(year)
+        changed[subdivision, year] = values
+    if not changed:
+        logger.info('nothing to ingest (%d unchanged, %d rejected)',
+                    unchanged, len(rejected))
+        return None
+
+    df = rainfall_frame(changed)
+    cube = load_or_build(data_path, cube_path)
+    change_id = change_set_id(cube.source, df)
+    subdivisions = sorted(set(added) | set(revised))
+    change_set = {
+        'id': change_id,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'files': [str(path) for path in files],
+        'added': sum(map(len, added.values())),
+        'revised': sum(map(len, revised.values())),
+        'unchanged': unchanged,
+        'rejected': rejected,
+        'subdivisions': {name: {'added': sorted(added.get(name, [])),
+                                'revised': sorted(revised.get(name, []))}
+                         for name in subdivisions},
+        # Region models to refit; other subdivisions have no model
+        'regions': sorted({SUBDIVISION_REGIONS[name] for name in subdivisions
+                           if name in SUBDIVISION_REGIONS}),
+    }
+    if dry_run:
+        return change_set
+
+    # The store is written last. It is what a rerun compares the release
+    # against, so a run that stops before it is repeated in full, and
+    # writing the CSV, the cube and a change set again is harmless
+    left_out = write_rainfall(data_path, df)
+    if left_out:
+        logger.warning('%d incomplete or unknown years not written to %s',
+                       left_out, data_path)
+    cube.append(df[['SUBDIVISION', 'YEAR'] + PERIODS])
+    # Led by the CSV's new hash, so load_or_build accepts the cube
+    source = '{}+{}'.format(file_hash(data_path), change_id)
+    cube.source = source
+    cube.save(cube_path, source)
+    change_set.update({
+        'history_rows': read_manifest(store_dir)['rows'] + len(df),
+        'climatology_source': source, 'training_data': str(data_path)})
+    path = write_change_set(change_set, output / 'changes')
+    append_rows(df, store_dir)
+    change_set['path'] = str(path)
+    return change_set
+
+
+def write_change_set(change_set, changes_dir):
+    changes_dir.mkdir(parents=True, exist_ok=True)
+    path = changes_dir / '{:%Y%m%dT%H%M%S}-{}.json'.format(
+        datetime.now(), change_set['id'])
+    with open(path, 'w') as f:
+        json.dump(change_set, f, indent=2)
+    return path
+
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
-def main(input_filepath, output_filepath):
-    """ Runs data processing scripts to turn raw data from (../raw) into
-        cleaned data ready to be analyzed (saved in ../processed).
+@click.option('--data', 'data_path', default=RAINFALL_DATA, show_default=True,
+              help='Rainfall CSV the models train on; changed years are '
+              'written back to it.')
+@click.option('--dry-run', is_flag=True,
+              help='Validate and print the change set without writing.')
+def main(input_filepath, output_filepath, data_path, dry_run):
+    """ Ingests new rainfall releases (a CSV or a directory of them) into
+        the rainfall CSV, and the history store and climatology under
+        ``output_filepath``.
     """
-    logger = logging.getLogger(__name__)
-    logger.info('making final data set from raw data')
+    files = release_files(input_filepath)
+    if not files:
+        logger.info('no release files in %s', input_filepath)
+        return
+    change_set = ingest(files, output_filepath, data_path, dry_run)
+    if change_set is None:
+        return
+    for item in change_set['rejected']:
+        logger.warning('%s:%d rejected: %s', item['file'], item['line'],
+                       item['reason'])
+    logger.info('%s %d added, %d revised, %d unchanged years in %d '
+                'subdivisions; regions to refit: %s',
+                'would ingest' if dry_run else 'ingested',
+                change_set['added'], change_set['revised'],
+                change_set['unchanged'], len(change_set['subdivisions']),
+                ', '.join(change_set['regions']) or 'none')
+    if dry_run:
+        click.echo(json.dumps(change_set, indent=2))
+    else:
+        logger.info('change set %s', change_set['path'])
 
 
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
 
-    # not used in this stub but often useful for finding various files
-    project_dir = Path(__file__).resolve().parents[2]
-
     # find .env automagically by walking up directories until it's found, then
     # load up the .env entries as environment variables
     load_dotenv(find_dotenv())
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# pandas is imported where it is used: the web app imports MONTHS from here
+# and should not pay for pandas at start-up.
+import numpy as np
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+          'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+# Seasonal total columns of Rainfall_Data_LL.csv -> calendar months (1-12)
+SEASONS = {
+    'Jan-Feb': (1, 2),
+    'Mar-May': (3, 4, 5),
+    'June-September': (6, 7, 8, 9),
+    'Oct-Dec': (10, 11, 12),
+}
+
+
+def load_rainfall(file_path):
+    """Load the subdivision-wise rainfall data from a CSV file."""
+    import pandas as pd
+
+    return pd.read_csv(file_path)
+
+
+def monthly_series(df, subdivision):
+    """Monthly rainfall of one subdivision as a date-indexed series."""
+    import pandas as pd
+
+    rows = df.loc[df['SUBDIVISION'] == subdivision].sort_values('YEAR')
+    years = rows['YEAR'].to_numpy()
+    dates = pd.to_datetime(pd.DataFrame({
+        'year': np.repeat(years, 12),
+        'month': np.tile(np.arange(1, 13), len(years)),
+        'day': 1,
+    }))
+    values = rows[MONTHS].to_numpy(dtype=np.float64).ravel()
+    return pd.Series(values, index=pd.Index(dates, name='Date'),
+                     name='Rainfall')
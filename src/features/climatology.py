@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""Precomputed historical rainfall statistics.
+
+The climatology cube holds, for every subdivision x period x year bucket,
+the statistics in ``STATS``. Periods are the twelve months, the annual
+total and the four seasonal totals of ``Rainfall_Data_LL.csv``; buckets
+are decades plus ``all`` for the whole record.
+
+Observations are laid out as a dense (subdivision, year, period) array
+with NaN for missing years. Padding the year axis to whole decades lets
+every decade of every subdivision be reduced in the same NumPy call, and
+appending years only recomputes the decades they fall in plus ``all``.
+Return levels use the Gumbel method of moments.
+"""
+import hashlib
+import logging
+import warnings
+from pathlib import Path
+
+import click
+import numpy as np
+
+from src.features.build_features import MONTHS, SEASONS, load_rainfall
+
+PERIODS = MONTHS + ['ANNUAL'] + list(SEASONS)
+QUANTILES = {'p10': 10, 'p25': 25, 'p75': 75, 'p90': 90}
+RETURN_PERIODS = {'rp10': 10, 'rp25': 25, 'rp50': 50, 'rp100': 100}
+STATS = (['count', 'mean', 'std', 'min', 'median'] + list(QUANTILES)
+         + ['max'] + list(RETURN_PERIODS))
+BUCKET_YEARS = 10
+ALL = 'all'
+CUBE_PATH = 'data/processed/climatology.npz'
+
+logger = logging.getLogger(__name__)
+
+# Gumbel frequency factors: x_T = mean + K_T * std
+_EULER = 0.5772156649
+_GUMBEL_K = np.array([
+    -np.sqrt(6) / np.pi * (_EULER + np.log(np.log(t / (t - 1))))
+    for t in RETURN_PERIODS.values()])
+
+
+def reduce_years(values, axis):
+    """Every statistic in ``STATS`` along the year axis.
+
+    Returns an array with a trailing stats axis in place of ``axis``.
+    """
+    values = np.moveaxis(values, axis, -1)
+    count = np.sum(~np.isnan(values), axis=-1)
+    with warnings.catch_warnings():
+        # All-NaN slices (years a subdivision lacks) stay NaN.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(values, axis=-1)
+        std = np.nanstd(values, axis=-1, ddof=1)
+        quantiles = np.nanpercentile(
+            values, [0, 50] + list(QUANTILES.values()) + [100], axis=-1)
+    low, median, *middle, high = quantiles
+    return_levels = mean[..., None] + std[..., None] * _GUMBEL_K
+    return np.concatenate([
+        np.stack([count, mean, std, low, median] + middle + [high],
+                 axis=-1),
+        return_levels,
+    ], axis=-1).astype(np.float32)
+
+
+class Climatology:
+    """Subdivision x period x bucket statistics with O(1) lookups."""
+
+    def __init__(self, subdivisions, first_year, observations):
+        self.subdivisions = list(subdivisions)
+        self.first_year = int(first_year)
+        # (subdivision, year, period), NaN where a year is missing
+        self.observations = np.asarray(observations, dtype=np.float32)
+        self.source = ''
+        self.rebuild()
+
+    @classmethod
+    def from_frame(cls, df):
+        subdivisions, codes = np.unique(df['SUBDIVISION'],
+                                        return_inverse=True)
+        years = df['YEAR'].to_numpy()
+        first_year = years.min()
+        observations = np.full(
+            (len(subdivisions), years.max() - first_year + 1, len(PERIODS)),
+            np.nan, dtype=np.float32)
+        observations[codes, years - first_year] = df[PERIODS].to_numpy()
+        return cls(subdivisions, first_year, observations)
+
+    @property
+    def buckets(self):
+        n_buckets = -(-self.observations.shape[1] // BUCKET_YEARS)
+        labels = []
+        for i in range(n_buckets):
+            start = self.first_year + i * BUCKET_YEARS
+            labels.append('{}-{}'.format(start, start + BUCKET_YEARS - 1))
+        return labels + [ALL]
+
+    def _decades(self, subdivisions=slice(None)):
+        """Observations reshaped to (subdivision, decade, year, period)."""
+        observations = self.observations[subdivisions]
+        n_years = observations.shape[1]
+        padded = -(-n_years // BUCKET_YEARS) * BUCKET_YEARS
+        if padded != n_years:
+            observations = np.pad(
+                observations, ((0, 0), (0, padded - n_years), (0, 0)),
+                constant_values=np.nan)
+        return observations.reshape(observations.shape[0], -1,
+                                    BUCKET_YEARS, len(PERIODS))
+
+    def _index(self):
+        self._positions = {name: i for i, name in
+                           enumerate(self.subdivisions)}
+        self._buckets = {name: i for i, name in enumerate(self.buckets)}
+        self._periods = {name: i for i, name in enumerate(PERIODS)}
+        self._stats = {name: i for i, name in enumerate(STATS)}
+
+    def rebuild(self):
+        """Recompute the whole cube in one pass."""
+        by_decade = reduce_years(self._decades(), axis=2)
+        overall = reduce_years(self.observations, axis=1)
+        # (subdivision, bucket, period, stat)
+        self.stats = np.concatenate([by_decade, overall[:, None]], axis=1)
+        self._index()
+
+    def append(self, df):
+        """Add or replace (SUBDIVISION, YEAR) rows and refresh only the
+        decades they touch plus ``all``.
+
+        Returns the names of the affected subdivisions.
+        """
+        if int(df['YEAR'].min()) < self.first_year:
+            raise ValueError('cannot add years before {}'.format(
+                self.first_year))
+        new = [name for name in df['SUBDIVISION'].unique()
+               if name not in self._positions]
+        if new:
+            base = len(self.subdivisions)
+            self.subdivisions += new
+            self._positions.update(
+                (name, base + i) for i, name in enumerate(new))
+            self.observations = np.concatenate([
+                self.observations,
+                np.full((len(new),) + self.observations.shape[1:], np.nan,
+                        dtype=np.float32)])
+        last_year = self.first_year + self.observations.shape[1] - 1
+        extra = int(df['YEAR'].max()) - last_year
+        if extra > 0:
+            self.observations = np.pad(
+                self.observations, ((0, 0), (0, extra), (0, 0)),
+                constant_values=np.nan)
+
+        codes = np.array([self._positions[name]
+                          for name in df['SUBDIVISION']])
+        years = df['YEAR'].to_numpy() - self.first_year
+        self.observations[codes, years] = df[PERIODS].to_numpy()
+
+        if new or self.stats.shape[1] != len(self.buckets):
+            self.rebuild()
+        else:
+            rows = np.unique(codes)
+            decades = np.unique(years // BUCKET_YEARS)
+            by_decade = reduce_years(
+                self._decades(rows)[:, decades], axis=2)
+            self.stats[np.ix_(rows, decades)] = by_decade
+            self.stats[rows, -1] = reduce_years(self.observations[rows],
+                                                axis=1)
+        return sorted(set(df['SUBDIVISION']))
+
+    def lookup(self, subdivision, period, bucket=ALL):
+        """All statistics of one cell as a dict (None for missing)."""
+        cell = self.stats[self._positions[subdivision],
+                          self._buckets[bucket], self._periods[period]]
+        return {name: (None if np.isnan(value) else round(float(value), 2))
+                for name, value in zip(STATS, cell)}
+
+    def value(self, subdivision, period, stat, bucket=ALL):
+        return float(self.stats[self._positions[subdivision],
+                                self._buckets[bucket],
+                                self._periods[period], self._stats[stat]])
+
+    def save(self, path=CUBE_PATH, source=''):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Replaced in one step, so readers never load a half-written cube
+        tmp = path.with_suffix('.tmp.npz')
+        np.savez(tmp, subdivisions=np.asarray(self.subdivisions),
+                 first_year=self.first_year, observations=self.observations,
+                 stats=self.stats, source=np.asarray(source))
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path=CUBE_PATH):
+        with np.load(path) as saved:
+            cube = cls.__new__(cls)
+            cube.subdivisions = list(saved['subdivisions'])
+            cube.first_year = int(saved['first_year'])
+            cube.observations = saved['observations']
+            cube.stats = saved['stats']
+            cube.source = str(saved['source'])
+        cube._index()
+        return cube
+
+
+def file_hash(path):
+    return hashlib.sha1(Path(path).read_bytes()).hexdigest()[:12]
+
+
+def load_or_build(data_path, path=CUBE_PATH):
+    """Load the saved cube if it was built from ``data_path`` as it is.
+
+    Ingested change sets extend the source as ``<csv hash>+<change set>``.
+    """
+    source = file_hash(data_path)
+    if Path(path).exists():
+        cube = Climatology.load(path)
+        if cube.source.partition('+')[0] == source:
+            return cube
+    cube = Climatology.from_frame(load_rainfall(data_path))
+    cube.source = source
+    cube.save(path, source)
+    return cube
+
+
+@click.command()
+@click.argument('data_path', type=click.Path(exists=True))
+@click.option('--output', default=CUBE_PATH, show_default=True)
+def main(data_path, output):
+    """ Builds the climatology cube from the rainfall CSV.
+    """
+    cube = Climatology.from_frame(load_rainfall(data_path))
+    cube.save(output, file_hash(data_path))
+    logger.info('%d subdivisions x %d buckets x %d periods -> %s',
+                len(cube.subdivisions), len(cube.buckets), len(PERIODS),
+                output)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
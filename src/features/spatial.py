@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Map coordinates to rainfall subdivisions.
+
+Subdivision centroids come from the Latitude/Longitude columns of
+``Rainfall_Data_LL.csv``. They are indexed in a KD-tree over unit-sphere
+coordinates, where straight-line (chord) distance orders points the same
+way as great-circle distance, so one tree query resolves any number of
+points. Optional GeoJSON boundaries take precedence over the nearest
+centroid for points that fall inside a polygon.
+
+``InverseDistance`` blends per-subdivision values (such as forecasts) at
+arbitrary points from the k nearest centroids. Its weight matrix depends
+only on the points, so it is cached per grid and every later blend is a
+single matrix product.
+"""
+import csv
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def to_unit_sphere(lat, lon):
+    """(n, 3) Cartesian coordinates of points on the unit sphere."""
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon),
+                            np.sin(lat)])
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+def read_centroids(data_path):
+    """Subdivision names and their centroid latitude/longitude."""
+    centroids = {}
+    with open(data_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            centroids.setdefault(row['SUBDIVISION'], (
+                float(row['Latitude']), float(row['Longitude'])))
+    names = sorted(centroids)
+    lat, lon = np.array([centroids[name] for name in names]).T
+    return np.asarray(names), lat, lon
+
+
+def read_boundaries(geojson_path, names):
+    """Polygons per subdivision from a GeoJSON FeatureCollection.
+
+    Features are matched on their ``SUBDIVISION`` property; returns a list
+    of (subdivision index, matplotlib Path) pairs.
+    """
+    # Only needed when boundaries are configured.
+    from matplotlib.path import Path
+
+    positions = {name: i for i, name in enumerate(names)}
+    with open(geojson_path, encoding='utf-8') as f:
+        features = json.load(f)['features']
+    polygons = []
+    for feature in features:
+        index = positions.get(feature['properties'].get('SUBDIVISION'))
+        if index is None:
+            continue
+        geometry = feature['geometry']
+        rings = geometry['coordinates']
+        if geometry['type'] == 'Polygon':
+            rings = [rings]
+        for polygon in rings:
+            # Outer ring only; GeoJSON stores (lon, lat).
+            polygons.append((index, Path(np.asarray(polygon[0]))))
+    return polygons
+
+
+class SubdivisionIndex:
+    """Nearest-subdivision lookup for batches of coordinates."""
+
+    def __init__(self, names, lat, lon, boundaries=None):
+        # scipy is slow to import; only pay for it once an index is built.
+        from scipy.spatial import cKDTree
+
+        self.names = np.asarray(names)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.tree = cKDTree(to_unit_sphere(self.lat, self.lon))
+        self.boundaries = boundaries or []
+
+    @classmethod
+    def from_csv(cls, data_path, boundaries_path=None):
+        names, lat, lon = read_centroids(data_path)
+        boundaries = None
+        if boundaries_path:
+            boundaries = read_boundaries(boundaries_path, names)
+        return cls(names, lat, lon, boundaries)
+
+    def subset(self, names):
+        """Index over only the given subdivisions, in the given order."""
+        positions = {name: i for i, name in enumerate(self.names)}
+        keep = [positions[name] for name in names]
+        return SubdivisionIndex(self.names[keep], self.lat[keep],
+                                self.lon[keep])
+
+    def query(self, lat, lon, k=1):
+        """Distances (km) and indices of the ``k`` nearest centroids."""
+        chord, index = self.tree.query(to_unit_sphere(lat, lon), k=k)
+        return chord_to_km(chord), index
+
+    def locate(self, lat, lon):
+        """Subdivision index and centroid distance (km) of every point."""
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        distance, index = self.query(lat, lon)
+        if self.boundaries:
+            points = np.column_stack([lon, lat])
+            for subdivision, path in self.boundaries:
+                index[path.contains_points(points)] = subdivision
+            chord = np.linalg.norm(
+                to_unit_sphere(lat, lon)
+                - to_unit_sphere(self.lat[index], self.lon[index]), axis=1)
+            distance = chord_to_km(chord)
+        return index, distance
+
+
+class InverseDistance:
+    """Inverse-distance weighting over the centroids of an index."""
+
+    def __init__(self, index, k=3, power=2, cache_size=32):
+        self.index = index
+        self.k = min(k, len(index.names))
+        self.power = power
+        self.cache_size = cache_size
+        self._weights = OrderedDict()
+        self._lock = threading.Lock()
+
+    def weights(self, lat, lon):
+        """(n_points, n_subdivisions) blending matrix, cached per grid."""
+        lat = np.ascontiguousarray(np.atleast_1d(lat), dtype=np.float64)
+        lon = np.ascontiguousarray(np.atleast_1d(lon), dtype=np.float64)
+        key = hashlib.sha1(lat.tobytes() + lon.tobytes()).hexdigest()
+        with self._lock:
+            weights = self._weights.get(key)
+            if weights is not None:
+                self._weights.move_to_end(key)
+                return weights
+
+        distance, index = self.index.query(lat, lon, k=self.k)
+        distance = distance.reshape(len(lat), self.k)
+        index = index.reshape(len(lat), self.k)
+        with np.errstate(divide='ignore'):
+            inverse = 1.0 / distance ** self.power
+        # A point on a centroid takes that subdivision's value exactly.
+        exact = np.isinf(inverse)
+        inverse = np.where(exact.any(axis=1, keepdims=True),
+                           exact.astype(np.float64), inverse)
+        weights = np.zeros((len(lat), len(self.index.names)))
+        np.put_along_axis(weights, index,
+                          inverse / inverse.sum(axis=1, keepdims=True),
+                          axis=1)
+
+        with self._lock:
+            self._weights[key] = weights
+            self._weights.move_to_end(key)
+            if len(self._weights) > self.cache_size:
+                self._weights.popitem(last=False)
+        return weights
+
+    def interpolate(self, lat, lon, values):
+        """Blend ``values`` (one row per subdivision) at every point."""
+        return self.weights(lat, lon) @ np.asarray(values)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Forecast-only ARIMA artifacts, exported from the pickled pmdarima models.
+
+A pickled ``pmdarima.ARIMA`` carries the full statsmodels results:
+training series, residuals, filter output for every observation and
+caches. Forecasting forward needs only the state-space system of the
+fitted model and the predicted state at the end of the sample. With those,
+the h-step forecast is the Kalman recursion with no observations::
+
+    mean_h = Z a_h + d          var_h = Z P_h Z' + H
+    a_h+1  = T a_h + c          P_h+1 = T P_h T' + R Q R'
+
+and the intervals are ``mean_h +- z * sqrt(var_h)``, exactly as in
+statsmodels' ``get_forecast``. ``SlimARIMA`` stores these arrays in an
+uncompressed ``.npz`` of a few KB and keeps pmdarima's ``predict`` API.
+As a result ``forecast_store.build_forecast`` works on either model,
+and neither statsmodels nor pmdarima is imported when serving.
+
+``python -m src.models.arima_export`` exports every region model. Each
+export is verified against the full model before it is written. The
+command then reports load time and peak RSS of both artifacts, each
+measured in a fresh interpreter.
+"""
+import bz2
+import json
+import logging
+import pickle
+import subprocess
+import sys
+from pathlib import Path
+from statistics import NormalDist
+
+import click
+import numpy as np
+
+from src.models.registry import REGIONS, model_version
+
+SLIM_DIR = 'models/slim'
+VERIFY_HORIZON = 240
+VERIFY_LEVELS = (50, 80, 95, 99)
+TOLERANCE = 1e-6
+SYSTEM = ('design', 'obs_intercept', 'obs_cov', 'transition',
+          'state_intercept', 'selection', 'state_cov')
+# Peak RSS from VmHWM: ru_maxrss survives exec, so a child would report
+# the peak of the exporting process that started it
+PROBE = """
+import json, time
+started = time.perf_counter()
+{load}
+loaded = time.perf_counter()
+model.predict(n_periods=12, return_conf_int=True)
+predicted = time.perf_counter()
+with open('/proc/self/status') as f:
+    peak = next(int(line.split()[1]) for line in f if line.startswith('VmHWM'))
+print(json.dumps({{'load_ms': (loaded - started) * 1000,
+                  'predict_ms': (predicted - loaded) * 1000,
+                  'rss_mb': peak / 1024}}))
+"""
+LOAD_FULL = ("import bz2, pickle\n"
+             "model = pickle.load(bz2.BZ2File({path!r}, 'rb'))")
+LOAD_SLIM = ("from src.models.arima_export import SlimARIMA\n"
+             "model = SlimARIMA.load({path!r})")
+
+logger = logging.getLogger(__name__)
+
+
+def slim_path(model_path, slim_dir=SLIM_DIR):
+    return Path(slim_dir) / (Path(model_path).stem + '.npz')
+
+
+class SlimARIMA:
+    """The forecasting part of a fitted ARIMA, as plain arrays."""
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.source_version = str(arrays['source_version'])
+        self.design = arrays['design']
+        self.obs_intercept = arrays['obs_intercept']
+        self.obs_cov = arrays['obs_cov']
+        self.transition = arrays['transition']
+        self.state_intercept = arrays['state_intercept']
+        self.state = arrays['state']
+        self.state_cov = arrays['predicted_state_cov']
+        selection = arrays['selection']
+        self.noise_cov = selection @ arrays['state_cov'] @ selection.T
+
+    @classmethod
+    def from_model(cls, model, source_version=''):
+        """Extract the arrays from a fitted ``pmdarima.ARIMA``."""
+        results = model.arima_res_
+        ssm = results.model.ssm
+        arrays = {}
+        for name in SYSTEM:
+            array = np.asarray(ssm[name], dtype=np.float64)
+            # Time-varying parts are stored per observation, on a last axis;
+            # only constant ones can be carried past the sample
+            if array.ndim == (2 if name.endswith('intercept') else 3):
+                if np.ptp(array, axis=-1).max() > 0:
+                    raise ValueError('time-varying {} is not supported'
+                                     .format(name))
+                array = array[..., -1]
+            arrays[name] = array
+        filtered = results.filter_results
+        arrays['state'] = filtered.predicted_state[:, -1].copy()
+        arrays['predicted_state_cov'] = \
+            filtered.predicted_state_cov[:, :, -1].copy()
+        arrays['source_version'] = np.array(source_version)
+        return cls(arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls({name: arrays[name] for name in arrays.files})
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp.npz')
+        np.savez(tmp, **self.arrays)
+        tmp.replace(path)
+
+    def moments(self, n_periods):
+        """Forecast mean and variance for the next ``n_periods``."""
+        a, P = self.state, self.state_cov
+        mean = np.empty(n_periods)
+        var = np.empty(n_periods)
+        for h in range(n_periods):
+            mean[h] = (self.design @ a + self.obs_intercept)[0]
+            var[h] = (self.design @ P @ self.design.T + self.obs_cov)[0, 0]
+            a = self.transition @ a + self.state_intercept
+            P = self.transition @ P @ self.transition.T + self.noise_cov
+        return mean, var
+
+    def predict(self, n_periods=10, return_conf_int=False, alpha=0.05):
+        """Same contract as ``pmdarima.ARIMA.predict``, without exogenous
+        data."""
+        mean, var = self.moments(n_periods)
+        if not return_conf_int:
+            return mean
+        half = NormalDist().inv_cdf(1 - alpha / 2) * np.sqrt(var)
+        return mean, np.column_stack([mean - half, mean + half])
+
+
+def load_full(model_path):
+    with bz2.BZ2File(model_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def verify(full, slim, horizon=VERIFY_HORIZON, levels=VERIFY_LEVELS,
+           tolerance=TOLERANCE):
+    """Largest difference between the two models' forecasts; raises if
+    it exceeds ``tolerance`` relative to the forecast's scale."""
+    worst = 0.0
+    for level in levels:
+        alpha = 1 - level / 100
+        expected = full.predict(n_periods=horizon, return_conf_int=True,
+                                alpha=alpha)
+        actual = slim.predict(n_periods=horizon, return_conf_int=True,
+                              alpha=alpha)
+        for want, got in zip(expected, actual):
+            want = np.asarray(want)
+            scale = max(1.0, float(np.abs(want).max()))
+            worst = max(worst, float(np.abs(want - got).max()) / scale)
+    if worst > tolerance:
+        raise ValueError('slim forecast differs from the full model by '
+                         '{:.3g} (tolerance {:.3g})'.format(worst, tolerance))
+    return worst
+
+
+def load_slim(model_path, slim_dir=SLIM_DIR):
+    """The exported artifact of a model, if present and up to date."""
+    path = slim_path(model_path, slim_dir)
+    if not path.exists():
+        return None
+    slim = SlimARIMA.load(path)
+    if slim.source_version != model_version(model_path):
+        logger.warning('%s is stale, re-run the export', path)
+        return None
+    return slim
+
+
+def probe(load, path):
+    """Load time, first prediction time and peak RSS in a fresh process."""
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE.format(load=load.format(path=str(path)))],
+        capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+@click.command()
+@click.option('--output', default=SLIM_DIR, show_default=True)
+@click.option('--horizon', default=VERIFY_HORIZON, show_default=True,
+              help='Months compared against the full model.')
+@click.option('--report/--no-report', default=True, show_default=True,
+              help='Measure load time and RSS of both artifacts.')
+def main(output, horizon, report):
+    """ Exports and verifies a forecast-only artifact per region model.
+    """
+    totals = {'full': [0.0, 0.0], 'slim': [0.0, 0.0]}
+    for region, (subdivision, model_path) in REGIONS.items():
+        if not Path(model_path).exists():
+            logger.warning('%s: %s not found, skipping', region, model_path)
+            continue
+        full = load_full(model_path)
+        slim = SlimARIMA.from_model(full, model_version(model_path))
+        error = verify(full, slim, horizon)
+        path = slim_path(model_path, output)
+        slim.save(path)
+        logger.info('%s: %s -> %s (%.0f KB -> %.1f KB), max relative '
+                    'difference %.2g over %d months', region, model_path,
+                    path, Path(model_path).stat().st_size / 1024,
+                    path.stat().st_size / 1024, error, horizon)
+        if not report:
+            continue
+        for name, load, artifact in (('full', LOAD_FULL, model_path),
+                                     ('slim', LOAD_SLIM, path)):
+            measured = probe(load, artifact)
+            totals[name][0] += measured['load_ms']
+            totals[name][1] += measured['rss_mb']
+            logger.info('%s: %s load %7.1f ms, first predict %6.1f ms, '
+                        'rss %5.0f MB', region, name, measured['load_ms'],
+                        measured['predict_ms'], measured['rss_mb'])
+    if report and totals['full'][0]:
+        logger.info('all regions: load %.0f ms -> %.0f ms, rss %.0f MB -> '
+                    '%.0f MB', totals['full'][0], totals['slim'][0],
+                    totals['full'][1], totals['slim'][1])
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
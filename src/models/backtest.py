@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Rolling-origin backtests of the subdivision rainfall models.
+
+Every subdivision is evaluated in its own worker process. Within a
+subdivision the ARIMA is fitted once at the earliest origin and then
+rolled forward with ``ARIMA.update``, so later folds only pay for a few
+optimizer iterations instead of a fresh fit.
+"""
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+from pmdarima import ARIMA, auto_arima
+
+from src.features.build_features import load_rainfall, monthly_series
+from src.models.order_search import ORDERS_PATH, load_orders
+
+HORIZONS = (1, 3, 6, 12)
+N_FOLDS = 8
+STEP = 12
+REPORT_DIR = 'reports/backtest'
+
+logger = logging.getLogger(__name__)
+
+
+def origins(n_samples, max_horizon, n_folds=N_FOLDS, step=STEP):
+    """Forecast origins, oldest first, each leaving ``max_horizon`` ahead."""
+    last = n_samples - max_horizon
+    first = last - step * (n_folds - 1)
+    if first <= 2 * STEP:
+        raise ValueError('series too short for {} folds'.format(n_folds))
+    return list(range(first, last + 1, step))
+
+
+def _initial_model(train, seed, m=12):
+    """Fit the persisted order, or search one on the first window."""
+    if seed is None:
+        return auto_arima(y=train, m=m, suppress_warnings=True)
+    model = ARIMA(order=tuple(seed['order']),
+                  seasonal_order=tuple(seed['seasonal_order']),
+                  with_intercept=seed['with_intercept'],
+                  suppress_warnings=True)
+    return model.fit(train)
+
+
+def seasonal_naive(y, origin, max_horizon, m=12):
+    """Repeat the last observed season."""
+    last_season = y[origin - m:origin]
+    return np.resize(last_season, max_horizon)
+
+
+def score(forecasts, actuals, horizons=HORIZONS):
+    """MAE/RMSE of an h-month forecast, averaged over steps 1..h and folds.
+
+    ``forecasts`` and ``actuals`` are (n_folds, max_horizon) arrays.
+    """
+    errors = np.asarray(forecasts) - np.asarray(actuals)
+    rows = []
+    for h in horizons:
+        window = errors[:, :h]
+        rows.append({
+            'horizon': h,
+            'mae': float(np.mean(np.abs(window))),
+            'rmse': float(np.sqrt(np.mean(window ** 2))),
+        })
+    return rows
+
+
+def backtest_series(name, y, seed=None, horizons=HORIZONS,
+                    n_folds=N_FOLDS, step=STEP):
+    """Backtest one subdivision; returns long-format metric rows."""
+    start = time.perf_counter()
+    y = np.asarray(y, dtype=np.float64)
+    max_horizon = max(horizons)
+    cuts = origins(len(y), max_horizon, n_folds, step)
+
+    actuals = np.stack([y[o:o + max_horizon] for o in cuts])
+    naive = np.stack([seasonal_naive(y, o, max_horizon) for o in cuts])
+    arima = np.empty_like(actuals)
+
+    model = _initial_model(y[:cuts[0]], seed)
+    for i, origin in enumerate(cuts):
+        if i:
+            # Roll the fitted model forward instead of refitting it.
+            model.update(y[cuts[i - 1]:origin])
+        arima[i] = model.predict(n_periods=max_horizon)
+
+    rows = []
+    for label, forecasts in (('arima', arima), ('seasonal_naive', naive)):
+        for row in score(forecasts, actuals, horizons):
+            row.update(subdivision=name, model=label, folds=len(cuts))
+            rows.append(row)
+    logger.info('%s: %d folds in %.1fs', name, len(cuts),
+                time.perf_counter() - start)
+    return rows
+
+
+def _run(job):
+    return backtest_series(*job)
+
+
+def run_backtests(df, subdivisions=None, horizons=HORIZONS,
+                  n_folds=N_FOLDS, step=STEP, orders_path=ORDERS_PATH,
+                  max_workers=None):
+    """Backtest every subdivision across a process pool."""
+    if subdivisions is None:
+        subdivisions = sorted(df['SUBDIVISION'].unique())
+    orders = load_orders(orders_path)
+    jobs = [(name, monthly_series(df, name).to_numpy(), orders.get(name),
+             tuple(horizons), n_folds, step) for name in subdivisions]
+    # Longest series first so the pool does not end on a straggler.
+    jobs.sort(key=lambda job: -len(job[1]))
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for result in pool.map(_run, jobs):
+            rows.extend(result)
+    columns = ['subdivision', 'model', 'horizon', 'folds', 'mae', 'rmse']
+    return pd.DataFrame(rows, columns=columns).sort_values(
+        ['subdivision', 'model', 'horizon'], ignore_index=True)
+
+
+def write_tables(metrics, output_dir=REPORT_DIR):
+    """Write the long metrics table plus subdivision x horizon pivots."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    metrics.to_csv(output_dir / 'metrics.csv', index=False)
+    for metric in ('mae', 'rmse'):
+        table = metrics.pivot_table(index='subdivision',
+                                    columns=['model', 'horizon'],
+                                    values=metric)
+        table.to_csv(output_dir / '{}.csv'.format(metric))
+
+
+@click.command()
+@click.argument('data_path', type=click.Path(exists=True))
+@click.option('--subdivision', '-s', multiple=True,
+              help='Subdivisions to evaluate (default: all).')
+@click.option('--horizon', '-h', 'horizons', multiple=True, type=int,
+              default=HORIZONS, show_default=True)
+@click.option('--folds', default=N_FOLDS, show_default=True)
+@click.option('--step', default=STEP, show_default=True,
+              help='Months between consecutive origins.')
+@click.option('--workers', default=os.cpu_count(), show_default=True)
+@click.option('--output', default=REPORT_DIR, show_default=True)
+def main(data_path, subdivision, horizons, folds, step, workers, output):
+    """ Runs rolling-origin backtests for every subdivision and writes
+        MAE/RMSE tables to the reports directory.
+    """
+    start = time.perf_counter()
+    df = load_rainfall(data_path)
+    metrics = run_backtests(df, subdivision or None, horizons, folds, step,
+                            max_workers=workers)
+    write_tables(metrics, output)
+    logger.info('backtested %d subdivisions in %.1fs',
+                metrics['subdivision'].nunique(),
+                time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Point forecasts and prediction intervals, computed once per model.
+
+ARIMA forecasts are deterministic, so the first ``n`` months of a long
+forecast are exactly the ``n``-month forecast. Each model is therefore
+forecast once up to ``MAX_HORIZON`` months (or the longest horizon asked
+for, if longer) at every configured confidence level and the result is
+stored next to the model, keyed by a hash of the model file. Requests
+only slice the stored arrays.
+
+Forecasts are built from the model's forecast-only export
+(``src.models.arima_export``) when it is up to date, and from the full
+pickled model otherwise.
+"""
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import click
+
+from src.models.arima_export import SLIM_DIR, load_full, load_slim
+from src.models.registry import REGIONS, model_version
+
+MAX_HORIZON = 60
+LEVELS = (80, 95)
+FORECAST_DIR = 'models/forecasts'
+
+logger = logging.getLogger(__name__)
+
+_loaded = {}
+
+
+def forecast_path(model_path, forecast_dir=FORECAST_DIR):
+    return Path(forecast_dir) / (Path(model_path).stem + '.json')
+
+
+def build_forecast(model, version, horizon=MAX_HORIZON, levels=LEVELS):
+    """Forecast ``horizon`` months with an interval per confidence level."""
+    mean = model.predict(n_periods=horizon)
+    intervals = {}
+    for level in levels:
+        _, conf_int = model.predict(n_periods=horizon, return_conf_int=True,
+                                    alpha=1 - level / 100)
+        intervals[str(level)] = conf_int.tolist()
+    return {
+        'version': version,
+        'horizon': horizon,
+        'levels': [int(level) for level in levels],
+        'mean': [float(value) for value in mean],
+        'intervals': intervals,
+    }
+
+
+def _usable(forecast, version, horizon, levels):
+    return (forecast['version'] == version
+            and forecast['horizon'] >= horizon
+            and all(str(level) in forecast['intervals'] for level in levels))
+
+
+def is_loaded(model_path, horizon=MAX_HORIZON, levels=LEVELS):
+    """Whether ``load_forecast`` would answer from memory."""
+    stat = os.stat(model_path)
+    forecast = _loaded.get((str(model_path), stat.st_mtime_ns, stat.st_size))
+    return forecast is not None and _usable(forecast, forecast['version'],
+                                            horizon, levels)
+
+
+def load_forecast(model_path, horizon=MAX_HORIZON, levels=LEVELS,
+                  forecast_dir=FORECAST_DIR, slim_dir=SLIM_DIR):
+    """Return the stored forecast of a model, building it if it is stale.
+
+    Loaded forecasts are kept in memory until the model file changes.
+    """
+    stat = os.stat(model_path)
+    key = (str(model_path), stat.st_mtime_ns, stat.st_size)
+    forecast = _loaded.get(key)
+    if forecast is not None and _usable(forecast, forecast['version'],
+                                        horizon, levels):
+        return forecast
+
+    version = model_version(model_path)
+    path = forecast_path(model_path, forecast_dir)
+    forecast = None
+    if path.exists():
+        with open(path) as f:
+            forecast = json.load(f)
+        if not _usable(forecast, version, horizon, levels):
+            forecast = None
+    if forecast is None:
+        logger.info('building forecast for %s (version %s)', model_path,
+                    version)
+        model = load_slim(model_path, slim_dir)
+        if model is None:
+            model = load_full(model_path)
+        forecast = build_forecast(model, version, horizon, levels)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # A temporary file of its own, as other workers may be building
+        # the same forecast
+        with tempfile.NamedTemporaryFile('w', dir=path.parent,
+                                         suffix='.tmp', delete=False) as f:
+            json.dump(forecast, f)
+        os.replace(f.name, path)
+    _loaded[key] = forecast
+    return forecast
+
+
+def forecast_rows(forecast, dates, levels=LEVELS):
+    """Per-month rows of a stored forecast, one per label in ``dates``.
+
+    Rainfall cannot be negative, so lower bounds are clipped at zero.
+    """
+    rows = []
+    for i, date in enumerate(dates):
+        intervals = []
+        for level in levels:
+            lower, upper = forecast['intervals'][str(level)][i]
+            intervals.append({'level': level,
+                              'lower': round(max(lower, 0.0), 2),
+                              'upper': round(upper, 2)})
+        rows.append({'Date': date,
+                     'Rainfall': f"{forecast['mean'][i]:.2f}",
+                     'Intervals': intervals})
+    return rows
+
+
+@click.command()
+@click.option('--horizon', default=MAX_HORIZON, show_default=True)
+@click.option('--level', '-l', 'levels', multiple=True, type=int,
+              default=LEVELS, show_default=True)
+@click.option('--output', default=FORECAST_DIR, show_default=True)
+def main(horizon, levels, output):
+    """ Precomputes the stored forecast of every region model.
+    """
+    for region, (subdivision, model_path) in REGIONS.items():
+        if not Path(model_path).exists():
+            logger.warning('%s: %s not found, skipping', region, model_path)
+            continue
+        forecast = load_forecast(model_path, horizon, levels, output)
+        logger.info('%s: forecast version %s', region, forecast['version'])
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Warm-started, cached ARIMA order search.
+
+The first search for a subdivision is the usual stepwise ``auto_arima``.
+The chosen (p,d,q)(P,D,Q,m) is then persisted and later searches only walk
+the neighbourhood of that order, reusing any candidate fit already
+evaluated on the same data.
+
+Cached fits are kept only for the data each subdivision's order was last
+chosen on, and the cache is held under ``MAX_CACHE_BYTES`` by dropping
+the fits used least recently.
+"""
+import bz2
+import csv
+import hashlib
+import json
+import logging
+import pickle
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+from pmdarima import ARIMA, auto_arima
+
+ORDERS_PATH = 'models/arima_orders.json'
+CACHE_DIR = 'models/cache/fits'
+REPORT_PATH = 'reports/order_search.csv'
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+# Same upper bounds auto_arima uses for its stepwise search.
+MAX_ORDER = {'p': 5, 'q': 5, 'P': 2, 'Q': 2}
+
+logger = logging.getLogger(__name__)
+
+
+def data_hash(y):
+    """Hash a series so cached fits are only reused on identical data."""
+    values = np.ascontiguousarray(np.asarray(y, dtype=np.float64))
+    return hashlib.sha1(values.tobytes()).hexdigest()[:16]
+
+
+def load_orders(path=ORDERS_PATH):
+    """Load the persisted order of every subdivision."""
+    path = Path(path)
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_order(subdivision, model, path=ORDERS_PATH, digest=None):
+    """Persist the order (and fitted params) chosen for a subdivision."""
+    orders = load_orders(path)
+    orders[subdivision] = {
+        'order': list(model.order),
+        'seasonal_order': list(model.seasonal_order),
+        'with_intercept': bool(model.with_intercept),
+        'params': [float(p) for p in model.params()],
+        # The data it was chosen on; fits of other data are pruned
+        'digest': digest,
+    }
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(orders, f, indent=2, sort_keys=True)
+
+
+def _cache_key(digest, order, seasonal_order, with_intercept):
+    p, d, q = order
+    P, D, Q, m = seasonal_order
+    return '{}-{}{}{}-{}{}{}{}-{:d}'.format(
+        digest, p, d, q, P, D, Q, m, with_intercept)
+
+
+def cached_fit(y, order, seasonal_order, with_intercept, digest,
+               cache_dir=CACHE_DIR, start_params=None):
+    """Fit one candidate, or load it if it was fitted on the same data.
+
+    Returns ``(model, hit)``; ``model`` is None when the fit failed.
+    """
+    path = Path(cache_dir) / (_cache_key(
+        digest, order, seasonal_order, with_intercept) + '.pbz2')
+    if path.exists():
+        # Marks the fit as recently used for prune_cache
+        path.touch()
+        with bz2.BZ2File(path, 'rb') as f:
+            return pickle.load(f), True
+    model = ARIMA(order=tuple(order), seasonal_order=tuple(seasonal_order),
+                  with_intercept=with_intercept, start_params=start_params,
+                  suppress_warnings=True)
+    try:
+        model.fit(y)
+    except Exception as e:
+        logger.debug('fit %s%s failed: %s', order, seasonal_order, e)
+        return None, False
+    store_fit(model, digest, cache_dir)
+    return model, False
+
+
+def store_fit(model, digest, cache_dir=CACHE_DIR):
+    """Add an already fitted candidate to the cache."""
+    path = Path(cache_dir) / (_cache_key(
+        digest, model.order, model.seasonal_order,
+        model.with_intercept) + '.pbz2')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with bz2.BZ2File(path, 'w') as f:
+        pickle.dump(model, f)
+
+
+def prune_cache(keep, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """Drop cached fits of data digests not in ``keep``, then the least
+    recently used ones until the cache fits in ``max_bytes``.
+
+    Returns the number of files removed.
+    """
+    paths = sorted(Path(cache_dir).glob('*.pbz2'),
+                   key=lambda path: path.stat().st_mtime, reverse=True)
+    total = removed = 0
+    for path in paths:
+        size = path.stat().st_size
+        if (path.name.partition('-')[0] in keep
+                and total + size <= max_bytes):
+            total += size
+            continue
+        path.unlink(missing_ok=True)
+        removed += 1
+    return removed
+
+
+def neighbours(order, seasonal_order):
+    """Orders one step away in p, q, P or Q, keeping d, D and m fixed."""
+    p, d, q = order
+    P, D, Q, m = seasonal_order
+    current = {'p': p, 'q': q, 'P': P, 'Q': Q}
+    for name in ('p', 'q', 'P', 'Q'):
+        for step in (-1, 1):
+            value = current[name] + step
+            if not 0 <= value <= MAX_ORDER[name]:
+                continue
+            moved = dict(current, **{name: value})
+            yield ((moved['p'], d, moved['q']),
+                   (moved['P'], D, moved['Q'], m))
+
+
+def cold_search(y, digest, m=12, cache_dir=CACHE_DIR):
+    """Run the full stepwise search and cache every candidate it fitted."""
+    fits = auto_arima(y=y, m=m, return_valid_fits=True)
+    for model in fits:
+        store_fit(model, digest, cache_dir)
+    return fits[0], {'fits': len(fits), 'hits': 0}
+
+
+def warm_search(y, seed, digest, cache_dir=CACHE_DIR):
+    """Hill-climb on AIC from a persisted order.
+
+    The seed order is refitted starting from its previous params, then
+    neighbouring orders are tried until none of them improves the AIC.
+    """
+    stats = {'fits': 0, 'hits': 0}
+    with_intercept = seed['with_intercept']
+    seen = set()
+
+    def evaluate(order, seasonal_order, start_params=None):
+        seen.add((tuple(order), tuple(seasonal_order)))
+        model, hit = cached_fit(y, order, seasonal_order, with_intercept,
+                                digest, cache_dir, start_params)
+        stats['hits' if hit else 'fits'] += 1
+        return model
+
+    best = evaluate(seed['order'], seed['seasonal_order'],
+                    seed.get('params'))
+    if best is None:
+        # The old params no longer converge on this data.
+        best = evaluate(seed['order'], seed['seasonal_order'])
+    if best is None:
+        return None, stats
+
+    improved = True
+    while improved:
+        improved = False
+        for order, seasonal_order in neighbours(best.order,
+                                                best.seasonal_order):
+            if (order, seasonal_order) in seen:
+                continue
+            model = evaluate(order, seasonal_order)
+            if model is not None and model.aic() < best.aic():
+                best, improved = model, True
+    return best, stats
+
+
+def search_order(y, subdivision, m=12, orders_path=ORDERS_PATH,
+                 cache_dir=CACHE_DIR, warm=True, prune=True):
+    """Choose and fit an ARIMA order for ``subdivision``.
+
+    Returns ``(model, stats)`` where ``stats`` records the search mode,
+    the number of fits, cache hits and the wall time. With ``prune``,
+    cached fits of data that no order was chosen on are then dropped
+    (see ``prune_cache``).
+    """
+    y = np.asarray(y, dtype=np.float64)
+    digest = data_hash(y)
+    seed = load_orders(orders_path).get(subdivision) if warm else None
+
+    start = time.perf_counter()
+    model = None
+    if seed is not None and seed['seasonal_order'][3] == m:
+        model, stats = warm_search(y, seed, digest, cache_dir)
+        stats['mode'] = 'warm'
+    if model is None:
+        model, stats = cold_search(y, digest, m, cache_dir)
+        stats['mode'] = 'cold'
+    stats['seconds'] = time.perf_counter() - start
+
+    save_order(subdivision, model, orders_path, digest)
+    if prune:
+        keep = {entry.get('digest')
+                for entry in load_orders(orders_path).values()}
+        stats['pruned'] = prune_cache(keep, cache_dir)
+    logger.info('%s: %s%s via %s search (%d fits, %d cached) in %.1fs',
+                subdivision, model.order, model.seasonal_order,
+                stats['mode'], stats['fits'], stats['hits'],
+                stats['seconds'])
+    return model, stats
+
+
+def compare(y, subdivision, m=12, orders_path=ORDERS_PATH,
+            cache_dir=CACHE_DIR):
+    """Time a cold search against a warm one on the same series.
+
+    Only measures: the persisted orders are left as they are.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    # Throwaway cache so the cold baseline never sees cached fits.
+    with tempfile.TemporaryDirectory(prefix='arima-cold-') as scratch:
+        start = time.perf_counter()
+        cold, _ = cold_search(y, data_hash(y), m, cache_dir=scratch)
+        cold_seconds = time.perf_counter() - start
+
+        # The warm search starts from the persisted order but saves its
+        # choice to a copy, and leaves the cache to the real searches
+        scratch_orders = Path(scratch) / 'orders.json'
+        if Path(orders_path).exists():
+            shutil.copyfile(orders_path, scratch_orders)
+        warm, stats = search_order(y, subdivision, m, scratch_orders,
+                                   cache_dir, prune=False)
+    return {
+        'subdivision': subdivision,
+        'cold_order': '{}{}'.format(cold.order, cold.seasonal_order),
+        'cold_aic': round(cold.aic(), 2),
+        'cold_seconds': round(cold_seconds, 2),
+        'warm_mode': stats['mode'],
+        'warm_order': '{}{}'.format(warm.order, warm.seasonal_order),
+        'warm_aic': round(warm.aic(), 2),
+        'warm_seconds': round(stats['seconds'], 2),
+        'warm_fits': stats['fits'],
+        'cache_hits': stats['hits'],
+        'saved_seconds': round(cold_seconds - stats['seconds'], 2),
+    }
+
+
+def write_report(rows, path=REPORT_PATH):
+    """Write the cold vs warm comparison as CSV."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+@click.command()
+@click.argument('data_path', type=click.Path(exists=True))
+@click.option('--subdivision', '-s', multiple=True,
+              help='Subdivisions to report on (default: all).')
+@click.option('--output', default=REPORT_PATH, show_default=True)
+def main(data_path, subdivision, output):
+    """ Report fit-time savings of the warm order search versus a cold
+        stepwise auto_arima search.
+    """
+    from src.features.build_features import load_rainfall, monthly_series
+
+    df = load_rainfall(data_path)
+    names = subdivision or sorted(df['SUBDIVISION'].unique())
+    rows = [compare(monthly_series(df, name), name) for name in names]
+    write_report(rows, output)
+    for row in rows:
+        logger.info('%s: cold %.1fs, warm %.1fs (saved %.1fs)',
+                    row['subdivision'], row['cold_seconds'],
+                    row['warm_seconds'], row['saved_seconds'])
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Rank crops for the coming season from soil tests and forecast rain.
+
+The crop model wants temperature and humidity, which we do not forecast,
+so every crop is scored over a grid of plausible scenarios in a single
+batch and its probabilities are averaged across the grid.
+
+Rainfall is a subdivision's mean monthly rainfall over the season, in
+mm, held within the range the crop model was trained on. A wet season
+runs well past that range (Konkan's monsoon is about 740 mm a month),
+and a tree model cannot tell such values from the range's top anyway.
+Rankings there say what the model does at its edge, not beyond it.
+"""
+import numpy as np
+
+from src.features.build_features import SEASONS
+
+# Rainfall (mm) of Crop_recommendation.csv, which the crop model learnt
+TRAINED_RAINFALL = (20.2, 298.6)
+DEFAULT_SEASON = 'June-September'
+TEMPERATURES = np.arange(15.0, 35.1, 2.5)
+HUMIDITIES = np.arange(40.0, 90.1, 10.0)
+
+
+def season_rainfall(monthly_forecast, season, first_month=1):
+    """Mean monthly rainfall of the next occurrence of ``season``.
+
+    ``monthly_forecast`` starts at calendar month ``first_month``.
+    """
+    months = SEASONS[season]
+    for start in range(len(monthly_forecast)):
+        if (first_month - 1 + start) % 12 + 1 == months[0]:
+            window = monthly_forecast[start:start + len(months)]
+            if len(window) == len(months):
+                return float(np.mean(window))
+            break
+    raise ValueError('forecast does not cover {}'.format(season))
+
+
+def model_rainfall(rainfall):
+    """``rainfall`` clipped to the crop model's training range."""
+    return np.clip(rainfall, *TRAINED_RAINFALL)
+
+
+def scenario_grid(N, P, K, ph, rainfall, temperatures=TEMPERATURES,
+                  humidities=HUMIDITIES):
+    """One model row per (temperature, humidity) pair."""
+    temperature, humidity = np.meshgrid(temperatures, humidities,
+                                        indexing='ij')
+    n = temperature.size
+    return np.column_stack([
+        np.full(n, N), np.full(n, P), np.full(n, K), temperature.ravel(),
+        humidity.ravel(), np.full(n, ph), np.full(n, rainfall),
+    ]).astype(np.float32)
+
+
+def rank_crops(forest, rows, top=5):
+    """Crops ordered by their mean probability over all scenario rows."""
+    proba = forest.predict_proba(rows).mean(axis=0)
+    order = np.argsort(proba)[::-1][:top]
+    return [{'crop': str(forest.labels[i]),
+             'probability': round(float(proba[i]), 4)} for i in order]
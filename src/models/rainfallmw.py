@@ -1,9 +1,12 @@
 import pandas as pd
 from datetime import datetime
-from pmdarima import auto_arima
 import pickle
 import bz2
 
+from src.models.order_search import search_order
+
+SUBDIVISION = 'Matathwada'
+
 def load_data(file_path):
     """Load the rainfall data from a CSV file."""
     df = pd.read_csv(file_path)
@@ -11,7 +14,7 @@ def load_data(file_path):
 
 def preprocess_data(df):
     """Preprocess the rainfall data."""
-    df1 = df.loc[df['SUBDIVISION'] == 'Matathwada'].iloc[:, 2:16]
+    df1 = df.loc[df['SUBDIVISION'] == SUBDIVISION].iloc[:, 2:16]
     df2 = pd.melt(df1, id_vars='YEAR', value_vars=df1.columns[1:-1])
     df2['Date'] = df2['variable'] + ' ' + df2['YEAR'].astype(str)
     df2.loc[:, 'Date'] = df2['Date'].apply(lambda x: datetime.strptime(x, '%b %Y'))
@@ -22,8 +25,8 @@ def preprocess_data(df):
     return df3
 
 def train_model(data):
-    """Train an ARIMA model."""
-    model = auto_arima(y=data.Rainfall, m=12)
+    """Train an ARIMA model, warm-starting from the last chosen order."""
+    model, _ = search_order(data.Rainfall, SUBDIVISION, m=12)
     return model
 
 def save_model(model, file_path):
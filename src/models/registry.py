@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""Models served by the web app."""
+import hashlib
+
+# Region page -> (subdivision in Rainfall_Data_LL.csv, ARIMA model file)
+REGIONS = {
+    'konkan': ('Konkan & Goa', 'models/model1.pbz2'),
+    'madhya_maharashtra': ('Madhya Maharashtra', 'models/model2.pbz2'),
+    'marathwada': ('Matathwada', 'models/model3.pbz2'),
+    'vidarbha': ('Vidarbha', 'models/model4.pbz2'),
+}
+
+SUBDIVISION_REGIONS = {subdivision: region
+                       for region, (subdivision, _) in REGIONS.items()}
+
+CROP_MODEL = 'models/XB.pbz2'
+CROP_DATA = 'Dataset/Crop_recommendation.csv'
+RAINFALL_DATA = 'Dataset/Rainfall_Data_LL.csv'
+
+
+def model_version(model_path):
+    """Content hash of a model file."""
+    digest = hashlib.sha1()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""Crop suitability rasters over a regular lat/lon grid.
+
+Every grid cell is scored with the compiled crop model. Soil inputs are
+either constants or ``.npy`` rasters of the grid's shape, opened memory
+mapped; rainfall comes from the cell's nearest subdivision, from its
+seasonal climatology or cached forecast.
+
+The grid is processed in fixed-size chunks of cells by a process pool.
+Each worker writes its chunk straight into the memory-mapped outputs, so
+memory stays bounded by the chunk size whatever the grid size. Cells in a
+chunk that share the same inputs (common with constant or coarse soil
+rasters) are scored once.
+"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import click
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from src.features.climatology import load_or_build
+from src.features.spatial import SubdivisionIndex
+from src.models.planner import (DEFAULT_SEASON, SEASONS, model_rainfall,
+                                season_rainfall)
+from src.models.registry import RAINFALL_DATA, REGIONS
+from src.models.tree_compiler import load_compiled
+
+INPUTS = ['N', 'P', 'K', 'temperature', 'humidity', 'ph']
+CHUNK_CELLS = 1 << 16
+
+logger = logging.getLogger(__name__)
+
+# Per-worker state, set once by _init_worker.
+_worker = {}
+
+
+def grid_shape(bounds, resolution):
+    lat_min, lat_max, lon_min, lon_max = bounds
+    return (int(round((lat_max - lat_min) / resolution)) + 1,
+            int(round((lon_max - lon_min) / resolution)) + 1)
+
+
+def cell_coordinates(start, stop, bounds, resolution, shape):
+    """Latitude/longitude of flat cell indices ``start:stop``."""
+    row, col = np.divmod(np.arange(start, stop), shape[1])
+    return bounds[0] + row * resolution, bounds[2] + col * resolution
+
+
+def subdivision_rainfall(names, season, source, climatology):
+    """Mean monthly rainfall of ``season`` for every subdivision, within
+    the crop model's training range."""
+    from src.models.forecast_store import load_forecast
+
+    models = {subdivision: path for subdivision, path in REGIONS.values()}
+    months = len(SEASONS[season])
+    rainfall = np.empty(len(names), dtype=np.float32)
+    for i, name in enumerate(names):
+        path = models.get(name)
+        if source == 'forecast' and path and os.path.exists(path):
+            rainfall[i] = season_rainfall(load_forecast(path)['mean'],
+                                          season)
+        else:
+            rainfall[i] = climatology.value(name, season, 'mean') / months
+    return model_rainfall(rainfall)
+
+
+def open_input(value):
+    """A constant or a memory-mapped raster."""
+    if isinstance(value, str) and value.endswith('.npy'):
+        return np.load(value, mmap_mode='r')
+    return float(value)
+
+
+def _init_worker(inputs, rainfall, bounds, resolution, shape, output_dir):
+    _worker.update(
+        forest=load_compiled(),
+        index=SubdivisionIndex.from_csv(RAINFALL_DATA),
+        inputs={name: open_input(value) for name, value in inputs.items()},
+        rainfall=rainfall, bounds=bounds, resolution=resolution,
+        shape=shape,
+        crop=open_memmap(Path(output_dir) / 'crop.npy', mode='r+'),
+        probability=open_memmap(Path(output_dir) / 'probability.npy',
+                                mode='r+'),
+    )
+
+
+def score_chunk(span):
+    """Score flat cells ``start:stop`` and write them to the outputs."""
+    start, stop = span
+    w = _worker
+    lat, lon = cell_coordinates(start, stop, w['bounds'], w['resolution'],
+                                w['shape'])
+    subdivision, _ = w['index'].locate(lat, lon)
+
+    rows = np.empty((stop - start, 7), dtype=np.float32)
+    for column, name in zip((0, 1, 2, 3, 4, 5), INPUTS):
+        value = w['inputs'][name]
+        rows[:, column] = value if np.isscalar(value) \
+            else value.reshape(-1)[start:stop]
+    rows[:, 6] = w['rainfall'][subdivision]
+
+    unique, inverse = np.unique(rows, axis=0, return_inverse=True)
+    proba = w['forest'].predict_proba(unique)
+    best = proba.argmax(axis=1)
+    inverse = inverse.reshape(-1)
+    w['crop'].reshape(-1)[start:stop] = best[inverse]
+    w['probability'].reshape(-1)[start:stop] = \
+        proba[np.arange(len(best)), best][inverse]
+    return stop - start, len(unique)
+
+
+def generate(bounds, resolution, inputs, output_dir, season=DEFAULT_SEASON,
+             source='climatology', chunk_cells=CHUNK_CELLS,
+             max_workers=None):
+    """Write crop.npy, probability.npy and labels.json for the grid."""
+    shape = grid_shape(bounds, resolution)
+    for name, value in inputs.items():
+        raster = open_input(value)
+        if not np.isscalar(raster) and raster.shape != shape:
+            raise ValueError('{} raster is {}, grid is {}'.format(
+                name, raster.shape, shape))
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    open_memmap(output_dir / 'crop.npy', mode='w+', dtype=np.uint8,
+                shape=shape).flush()
+    open_memmap(output_dir / 'probability.npy', mode='w+',
+                dtype=np.float32, shape=shape).flush()
+
+    names = SubdivisionIndex.from_csv(RAINFALL_DATA).names
+    rainfall = subdivision_rainfall(names, season, source,
+                                    load_or_build(RAINFALL_DATA))
+    labels = load_compiled().labels.tolist()
+    with open(output_dir / 'labels.json', 'w') as f:
+        json.dump({'labels': labels, 'bounds': list(bounds),
+                   'resolution': resolution, 'season': season,
+                   'rainfall_source': source}, f, indent=2)
+
+    n_cells = shape[0] * shape[1]
+    spans = [(start, min(start + chunk_cells, n_cells))
+             for start in range(0, n_cells, chunk_cells)]
+    started = time.perf_counter()
+    scored = unique = 0
+    with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker,
+            initargs=(inputs, rainfall, bounds, resolution, shape,
+                      str(output_dir))) as pool:
+        for cells, distinct in pool.map(score_chunk, spans):
+            scored += cells
+            unique += distinct
+    seconds = time.perf_counter() - started
+    logger.info('%d cells (%d distinct inputs) in %.1fs, %.0f cells/s',
+                scored, unique, seconds, scored / max(seconds, 1e-9))
+    return shape
+
+
+@click.command()
+@click.option('--bounds', nargs=4, type=float, required=True,
+              help='LAT_MIN LAT_MAX LON_MIN LON_MAX')
+@click.option('--resolution', type=float, required=True,
+              help='Cell size in degrees.')
+@click.option('--season', type=click.Choice(list(SEASONS)),
+              default=DEFAULT_SEASON, show_default=True)
+@click.option('--rainfall', 'source', show_default=True,
+              type=click.Choice(['climatology', 'forecast']),
+              default='climatology')
+@click.option('--chunk-cells', default=CHUNK_CELLS, show_default=True)
+@click.option('--workers', default=os.cpu_count(), show_default=True)
+@click.option('--output', default='reports/suitability',
+              show_default=True)
+@click.option('--N', 'N', required=True, help='Number or .npy raster.')
+@click.option('--P', 'P', required=True, help='Number or .npy raster.')
+@click.option('--K', 'K', required=True, help='Number or .npy raster.')
+@click.option('--ph', required=True, help='Number or .npy raster.')
+@click.option('--temperature', required=True,
+              help='Number or .npy raster.')
+@click.option('--humidity', required=True, help='Number or .npy raster.')
+def main(bounds, resolution, season, source, chunk_cells, workers, output,
+         **inputs):
+    """ Scores the crop model over every cell of a lat/lon grid and writes
+        memory-mapped crop and probability rasters.
+    """
+    generate(bounds, resolution, inputs, output, season, source,
+             chunk_cells, workers)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Reproducible training of the XGBoost crop recommendation model.
+
+Candidates from a small hyperparameter grid are cross-validated and
+refitted on the full dataset in a process pool. Once the pool has shut
+down, each one is compiled with ``tree_compiler`` and timed on the
+serving path, one at a time. The most accurate candidate within the
+latency budget is written out as ``XB.pbz2`` together with its compiled
+form and label vocabulary.
+"""
+import bz2
+import hashlib
+import itertools
+import json
+import logging
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import StratifiedKFold
+from xgboost import XGBClassifier
+
+from src.models.registry import CROP_DATA, CROP_MODEL, model_version
+from src.models.tree_compiler import (COMPILED_PATH, CompiledForest,
+                                      compile_model, flatten_booster)
+
+FEATURES = ['N', 'P', 'K', 'temperature', 'humidity', 'ph', 'rainfall']
+CACHE_DIR = 'data/processed'
+LABELS_PATH = 'models/crop_labels.json'
+REPORT_PATH = 'reports/crop_search.csv'
+
+GRID = {
+    'n_estimators': [50, 100, 200],
+    'max_depth': [3, 4, 6],
+    'learning_rate': [0.1, 0.3],
+}
+N_SPLITS = 5
+LATENCY_BUDGET_MS = 0.5
+SEED = 42
+
+logger = logging.getLogger(__name__)
+
+
+def load_dataset(data_path=CROP_DATA, cache_dir=CACHE_DIR):
+    """Features, encoded labels and label vocabulary of the crop data.
+
+    The parsed arrays are cached as ``.npz`` keyed by the CSV's content,
+    so repeated runs skip the CSV parse.
+    """
+    digest = hashlib.sha1(Path(data_path).read_bytes()).hexdigest()[:12]
+    cache_path = Path(cache_dir) / 'crop_{}.npz'.format(digest)
+    if cache_path.exists():
+        with np.load(cache_path) as cached:
+            return cached['X'], cached['y'], list(cached['labels'])
+
+    df = pd.read_csv(data_path, encoding='utf-8')
+    # Sorted labels reproduce the LabelEncoder the notebook used.
+    labels = sorted(df['label'].unique())
+    X = df[FEATURES].to_numpy(dtype=np.float32)
+    y = np.searchsorted(labels, df['label'].to_numpy())
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(cache_path, X=X, y=y, labels=np.asarray(labels))
+    return X, y, labels
+
+
+def candidates(grid=GRID):
+    names = sorted(grid)
+    for values in itertools.product(*(grid[name] for name in names)):
+        yield dict(zip(names, values))
+
+
+def make_model(params):
+    return XGBClassifier(objective='multi:softprob', random_state=SEED,
+                         n_jobs=1, **params)
+
+
+def evaluate(job):
+    """Cross-validate one candidate, then refit it on all rows.
+
+    Runs in a worker process; returns the metrics, the refitted booster
+    as JSON so the parent can compile and time it, and the model itself.
+    """
+    params, X, y, n_splits = job
+    folds = StratifiedKFold(n_splits=n_splits, shuffle=True,
+                            random_state=SEED)
+    scores, fit_times = [], []
+    for train, test in folds.split(X, y):
+        model = make_model(params)
+        start = time.perf_counter()
+        model.fit(X[train], y[train])
+        fit_times.append(time.perf_counter() - start)
+        scores.append(float((model.predict(X[test]) == y[test]).mean()))
+
+    model = make_model(params).fit(X, y)
+    raw = bytes(model.get_booster().save_raw(raw_format='json'))
+    metrics = dict(params, cv_accuracy=float(np.mean(scores)),
+                   cv_accuracy_std=float(np.std(scores)),
+                   fit_seconds=float(np.mean(fit_times)))
+    return metrics, raw.decode('utf-8'), model
+
+
+def serving_latency(raw_json, X, labels, repeat=200):
+    """Median single-row and full-batch latency of the compiled model."""
+    arrays = flatten_booster(raw_json)
+    arrays['labels'] = np.asarray(labels)
+    forest = CompiledForest(arrays)
+    single = []
+    for i in range(repeat):
+        row = X[i % len(X)][None, :]
+        start = time.perf_counter()
+        forest.predict(row)
+        single.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    forest.predict(X)
+    batch = time.perf_counter() - start
+    return float(np.median(single)) * 1e3, batch * 1e3
+
+
+def search(X, y, labels, grid=GRID, n_splits=N_SPLITS, max_workers=None):
+    """Evaluate every candidate.
+
+    Returns the results sorted by accuracy, and the fitted models keyed
+    by ``_describe`` of their parameters.
+    """
+    jobs = [(params, X, y, n_splits) for params in candidates(grid)]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        evaluated = list(pool.map(evaluate, jobs))
+    results, models = [], {}
+    for metrics, raw, model in evaluated:
+        # Timed after the pool has shut down, one at a time, so fits in
+        # other workers do not compete for the CPU
+        single_ms, batch_ms = serving_latency(raw, X, labels)
+        metrics.update(single_row_ms=single_ms, batch_ms=batch_ms,
+                       batch_rows=len(X))
+        logger.info('%s: accuracy %.4f, %.3f ms/row', _describe(metrics),
+                    metrics['cv_accuracy'], single_ms)
+        results.append(metrics)
+        models[_describe(metrics)] = model
+    results.sort(key=lambda r: (-r['cv_accuracy'], r['single_row_ms']))
+    return results, models
+
+
+def choose(results, budget_ms=LATENCY_BUDGET_MS):
+    """Most accurate candidate within the single-row latency budget."""
+    within = [r for r in results if r['single_row_ms'] <= budget_ms]
+    if within:
+        return within[0]
+    logger.warning('no candidate meets %.3f ms; using the fastest',
+                   budget_ms)
+    return min(results, key=lambda r: r['single_row_ms'])
+
+
+def _describe(metrics):
+    return ', '.join('{}={}'.format(name, metrics[name])
+                     for name in sorted(GRID))
+
+
+def save_artifacts(model, labels, model_path=CROP_MODEL,
+                   compiled_path=COMPILED_PATH, labels_path=LABELS_PATH):
+    """Write the pickled model, its compiled form and the vocabulary."""
+    with bz2.BZ2File(model_path, 'w') as f:
+        pickle.dump(model, f)
+    compile_model(model, labels, compiled_path, model_version(model_path))
+    with open(labels_path, 'w') as f:
+        json.dump(list(labels), f, indent=2)
+
+
+@click.command()
+@click.option('--data', 'data_path', default=CROP_DATA, show_default=True,
+              type=click.Path(exists=True))
+@click.option('--budget-ms', default=LATENCY_BUDGET_MS, show_default=True,
+              help='Single-row latency budget of the compiled model.')
+@click.option('--folds', default=N_SPLITS, show_default=True)
+@click.option('--workers', default=os.cpu_count(), show_default=True)
+@click.option('--model', 'model_path', default=CROP_MODEL,
+              show_default=True)
+@click.option('--report', 'report_path', default=REPORT_PATH,
+              show_default=True)
+def main(data_path, budget_ms, folds, workers, model_path, report_path):
+    """ Trains the crop model with a cross-validated parallel search and
+        writes the chosen model, its compiled form and label vocabulary.
+    """
+    X, y, labels = load_dataset(data_path)
+    results, models = search(X, y, labels, n_splits=folds,
+                             max_workers=workers)
+    best = choose(results, budget_ms)
+
+    report = pd.DataFrame(results)
+    report['chosen'] = report.index == results.index(best)
+    Path(report_path).parent.mkdir(parents=True, exist_ok=True)
+    report.to_csv(report_path, index=False)
+
+    # Already fitted on every row by the search
+    model = models[_describe(best)]
+    compiled_path = str(Path(model_path).with_suffix('.npz'))
+    labels_path = str(Path(model_path).parent / Path(LABELS_PATH).name)
+    save_artifacts(model, labels, model_path, compiled_path, labels_path)
+    logger.info('chose %s: accuracy %.4f, %.3f ms/row -> %s',
+                _describe(best), best['cv_accuracy'], best['single_row_ms'],
+                model_path)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""Compile an XGBoost multi-class booster into flat NumPy arrays.
+
+Serving a single row through ``XGBClassifier.predict`` pays for DMatrix
+construction and a trip through the xgboost library. The compiled forest
+stores every tree as a complete binary tree of the forest's maximum depth
+in contiguous (n_trees, n_nodes) arrays: feature index, threshold and
+missing-value direction per internal node, and a value per leaf slot.
+Child offsets are implicit (``2 * i + 1`` and ``2 * i + 2``), so all trees
+are walked at once with one gather and one compare per level and NumPy is
+the only dependency at serving time.
+
+Leaves above the maximum depth are pushed down by copying their value to
+every leaf slot below them, which makes the direction taken through the
+padding irrelevant.
+"""
+import bz2
+import csv
+import json
+import logging
+import os
+import pickle
+import time
+
+import click
+import numpy as np
+
+from src.models.registry import CROP_DATA, CROP_MODEL, model_version
+
+COMPILED_PATH = 'models/XB.npz'
+CHUNK_ROWS = 64
+
+logger = logging.getLogger(__name__)
+
+_loaded = {}
+
+
+def _parse_base_score(value):
+    # Newer xgboost writes a per-class vector such as "[5E-1,5E-1]".
+    return np.array([float(v) for v in value.strip('[]').split(',')],
+                    dtype=np.float64)
+
+
+def _depth(tree):
+    left, right = tree['left_children'], tree['right_children']
+    depth = [0] * len(left)
+    # Children always come after their parent in xgboost's node order.
+    for node in range(len(left)):
+        if left[node] != -1:
+            depth[left[node]] = depth[right[node]] = depth[node] + 1
+    return max(depth)
+
+
+def _complete(tree, max_depth, feature, threshold, default_left, value):
+    """Write one tree into its rows of the complete-tree arrays."""
+    n_internal = 2 ** max_depth - 1
+    stack = [(0, 0, 0)]  # (xgboost node, complete-tree slot, depth)
+    while stack:
+        node, slot, depth = stack.pop()
+        child = tree['left_children'][node]
+        if child == -1:
+            # Fill every leaf slot of the subtree rooted at ``slot``.
+            span = 2 ** (max_depth - depth)
+            first = (slot + 1) * span - 1 - n_internal
+            value[first:first + span] = tree['split_conditions'][node]
+            continue
+        feature[slot] = tree['split_indices'][node]
+        threshold[slot] = tree['split_conditions'][node]
+        default_left[slot] = tree['default_left'][node]
+        stack.append((child, 2 * slot + 1, depth + 1))
+        stack.append((tree['right_children'][node], 2 * slot + 2, depth + 1))
+
+
+def flatten_booster(raw_json):
+    """Flatten the JSON model of a multi-class booster into arrays."""
+    learner = json.loads(raw_json)['learner']
+    objective = learner['objective']['name']
+    if objective not in ('multi:softprob', 'multi:softmax'):
+        raise ValueError('unsupported objective: {}'.format(objective))
+    params = learner['learner_model_param']
+    n_classes = int(params['num_class'])
+    trees = learner['gradient_booster']['model']['trees']
+
+    max_depth = max(max(_depth(tree) for tree in trees), 1)
+    n_trees, n_internal = len(trees), 2 ** max_depth - 1
+    feature = np.zeros((n_trees, n_internal), dtype=np.int32)
+    threshold = np.zeros((n_trees, n_internal), dtype=np.float32)
+    default_left = np.ones((n_trees, n_internal), dtype=bool)
+    value = np.zeros((n_trees, n_internal + 1), dtype=np.float32)
+    for i, tree in enumerate(trees):
+        _complete(tree, max_depth, feature[i], threshold[i],
+                  default_left[i], value[i])
+
+    base_score = _parse_base_score(params['base_score'])
+    return {
+        'feature': feature,
+        'threshold': threshold,
+        'default_left': default_left,
+        'value': value,
+        'tree_class': np.asarray(
+            learner['gradient_booster']['model']['tree_info'],
+            dtype=np.int32),
+        'max_depth': np.int32(max_depth),
+        'n_classes': np.int32(n_classes),
+        'base_margin': np.resize(base_score, n_classes),
+        'feature_names': np.asarray(learner.get('feature_names') or []),
+    }
+
+
+def compile_model(model, labels, path=COMPILED_PATH, source_version=''):
+    """Compile a fitted ``XGBClassifier`` and save it as ``.npz``."""
+    raw = model.get_booster().save_raw(raw_format='json')
+    arrays = flatten_booster(bytes(raw).decode('utf-8'))
+    arrays['labels'] = np.asarray(labels)
+    arrays['source_version'] = np.asarray(source_version)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # Padding of the shallow trees is zeros and repeated leaves, so the
+    # file compresses about 50x; loading costs a few ms more
+    np.savez_compressed(path, **arrays)
+    return CompiledForest(arrays)
+
+
+class CompiledForest:
+    """NumPy-only evaluator for a flattened booster."""
+
+    def __init__(self, arrays):
+        self.max_depth = int(arrays['max_depth'])
+        self.n_classes = int(arrays['n_classes'])
+        self.base_margin = np.asarray(arrays['base_margin'])
+        self.labels = np.asarray(arrays['labels'])
+        self.source_version = str(arrays.get('source_version', ''))
+        self.tree_class = np.asarray(arrays['tree_class'])
+        n_trees = len(self.tree_class)
+        # Trees are addressed through one flat array each.
+        self.feature = np.ascontiguousarray(arrays['feature']).ravel()
+        self.threshold = np.ascontiguousarray(arrays['threshold']).ravel()
+        self.default_left = np.ascontiguousarray(
+            arrays['default_left']).ravel()
+        self.value = np.ascontiguousarray(arrays['value']).ravel()
+        self.n_internal = 2 ** self.max_depth - 1
+        self.tree_offset = np.arange(n_trees, dtype=np.intp) \
+            * self.n_internal
+        self.leaf_offset = np.arange(n_trees, dtype=np.intp) \
+            * (self.n_internal + 1) - self.n_internal
+        # Summing leaf values per class is one matrix product.
+        self.class_matrix = np.zeros((n_trees, self.n_classes),
+                                     dtype=np.float32)
+        self.class_matrix[np.arange(n_trees), self.tree_class] = 1
+
+    @classmethod
+    def load(cls, path=COMPILED_PATH):
+        with np.load(path) as arrays:
+            return cls({name: arrays[name] for name in arrays.files})
+
+    def leaf_values(self, X):
+        """Leaf value reached by every row in every tree."""
+        n_rows = len(X)
+        slot = np.zeros((n_rows, len(self.tree_offset)), dtype=np.intp)
+        # Row r's feature f sits at r * n_features + f in the flat input.
+        row_offset = (np.arange(n_rows) * X.shape[1])[:, None]
+        flat_x = X.ravel()
+        has_missing = np.isnan(flat_x).any()
+        for _ in range(self.max_depth):
+            node = slot + self.tree_offset
+            x = flat_x[row_offset + self.feature[node]]
+            go_right = ~(x < self.threshold[node])
+            if has_missing:
+                go_right = np.where(np.isnan(x), ~self.default_left[node],
+                                    go_right)
+            slot *= 2
+            slot += 1
+            slot += go_right
+        return self.value[slot + self.leaf_offset]
+
+    def predict_margin(self, X):
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        margin = np.empty((len(X), self.n_classes), dtype=np.float64)
+        # Bounded chunks keep the (rows, trees) work arrays in cache.
+        for start in range(0, len(X), CHUNK_ROWS):
+            chunk = np.ascontiguousarray(X[start:start + CHUNK_ROWS])
+            margin[start:start + len(chunk)] = \
+                self.leaf_values(chunk) @ self.class_matrix
+        return margin + self.base_margin
+
+    def predict_proba(self, X):
+        margin = self.predict_margin(X)
+        margin -= margin.max(axis=1, keepdims=True)
+        proba = np.exp(margin)
+        return proba / proba.sum(axis=1, keepdims=True)
+
+    def predict(self, X):
+        """Encoded class of every row, as ``XGBClassifier.predict``."""
+        return self.predict_margin(X).argmax(axis=1)
+
+    def predict_labels(self, X):
+        return self.labels[self.predict(X)]
+
+
+def crop_labels(data_path):
+    """Label vocabulary in LabelEncoder order (sorted unique labels)."""
+    with open(data_path, newline='', encoding='utf-8') as f:
+        return sorted({row['label'] for row in csv.DictReader(f)})
+
+
+def load_compiled(model_path=CROP_MODEL, compiled_path=COMPILED_PATH,
+                  data_path=CROP_DATA):
+    """Return the compiled crop model, recompiling it if it is stale.
+
+    Only a missing or outdated ``.npz`` needs xgboost, to unpickle the
+    source model once.
+    """
+    stat = os.stat(model_path)
+    key = (str(model_path), stat.st_mtime_ns, stat.st_size)
+    forest = _loaded.get(key)
+    if forest is not None:
+        return forest
+
+    version = model_version(model_path)
+    forest = None
+    if os.path.exists(compiled_path):
+        forest = CompiledForest.load(compiled_path)
+        if forest.source_version != version:
+            forest = None
+    if forest is None:
+        logger.info('compiling %s (version %s)', model_path, version)
+        with bz2.BZ2File(model_path, 'rb') as f:
+            model = pickle.load(f)
+        forest = compile_model(model, crop_labels(data_path), compiled_path,
+                               version)
+    _loaded[key] = forest
+    return forest
+
+
+def _median_seconds(fn, repeat=200):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+@click.command()
+@click.option('--model', 'model_path', default=CROP_MODEL,
+              show_default=True, type=click.Path(exists=True))
+@click.option('--data', 'data_path', default=CROP_DATA, show_default=True,
+              type=click.Path(exists=True))
+@click.option('--output', default=COMPILED_PATH, show_default=True)
+def main(model_path, data_path, output):
+    """ Compiles the pickled crop model, checks that it predicts the same
+        classes as xgboost on the whole dataset and reports latency.
+    """
+    with bz2.BZ2File(model_path, 'rb') as f:
+        model = pickle.load(f)
+    labels = crop_labels(data_path)
+    forest = compile_model(model, labels, output, model_version(model_path))
+
+    X = np.genfromtxt(data_path, delimiter=',', skip_header=1,
+                      usecols=range(7), dtype=np.float32)
+    expected = model.predict(X)
+    mismatches = int((forest.predict(X) != expected).sum())
+    if mismatches:
+        raise click.ClickException(
+            '{} of {} rows disagree with xgboost'.format(mismatches, len(X)))
+
+    row = X[:1]
+    logger.info('single row: xgboost %.3f ms, compiled %.3f ms',
+                _median_seconds(lambda: model.predict(row)) * 1e3,
+                _median_seconds(lambda: forest.predict(row)) * 1e3)
+    logger.info('%d rows: xgboost %.1f ms, compiled %.1f ms', len(X),
+                _median_seconds(lambda: model.predict(X), 5) * 1e3,
+                _median_seconds(lambda: forest.predict(X), 5) * 1e3)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
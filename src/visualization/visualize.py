@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""Static EDA figures for every subdivision, built in parallel and cached.
+
+These are the notebook figures of ``Rainfall_EDA.ipynb``, written to
+``reports/figures`` for every subdivision. The web app only serves the
+files.
+
+=============  =====  ==============================================
+figure         file   content
+=============  =====  ==============================================
+``boxplot``    PNG    monthly box plot
+``annual``     PNG    distribution of annual totals
+``share``      PNG    share of the year's rain falling in each month
+``timeline``   HTML   monthly series with a range slider
+``monthly``    HTML   one timeline per month, faceted
+=============  =====  ==============================================
+
+A figure's cache key hashes the subdivision's rows in the history store,
+the figure name, ``PARAMS`` and ``STYLE_VERSION``. It is recorded in
+``manifest.json``. A figure whose file exists under the same key is
+skipped, so after an ingestion only the subdivisions that changed are
+redrawn. The rest run on a process pool. HTML figures share one
+``plotly.min.js`` next to them rather than embedding it. HTML and the
+script are precompressed like the static assets, so the web app sends
+them as they are.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+import click
+import numpy as np
+
+from src.data.history import open_store
+from src.features.build_features import MONTHS
+from src.models.registry import RAINFALL_DATA
+from src.web.assets import compress
+
+FIGURES_DIR = 'reports/figures'
+STYLE_VERSION = 1
+PARAMS = {'dpi': 100, 'width': 9.0, 'height': 5.0, 'bins': 20}
+FIGURES = {'boxplot': 'png', 'annual': 'png', 'share': 'png',
+           'timeline': 'html', 'monthly': 'html'}
+
+logger = logging.getLogger(__name__)
+
+
+def slug(name):
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+
+def figure_key(figure, years, monthly, params):
+    digest = hashlib.sha1(json.dumps(
+        [figure, STYLE_VERSION, params], sort_keys=True).encode('utf-8'))
+    digest.update(np.ascontiguousarray(years).tobytes())
+    digest.update(np.ascontiguousarray(monthly).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def read_manifest(output):
+    path = Path(output) / 'manifest.json'
+    if not path.exists():
+        return {'subdivisions': {}, 'keys': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, output):
+    path = Path(output) / 'manifest.json'
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _pyplot(params):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(params['width'], params['height']))
+    return plt, fig, ax
+
+
+def plot_boxplot(name, years, monthly, path, params):
+    plt, fig, ax = _pyplot(params)
+    ax.boxplot([column[~np.isnan(column)] for column in monthly.T])
+    ax.set_xticks(range(1, len(MONTHS) + 1), MONTHS)
+    ax.set(title='{}: minimum, maximum and median monthly rainfall'.format(
+        name), xlabel='Month', ylabel='Rainfall in mm')
+    fig.savefig(path, dpi=params['dpi'], bbox_inches='tight')
+    plt.close(fig)
+
+
+def plot_annual(name, years, monthly, path, params):
+    plt, fig, ax = _pyplot(params)
+    annual = monthly.sum(axis=1)
+    annual = annual[~np.isnan(annual)]
+    ax.hist(annual, bins=params['bins'], color='tab:blue', alpha=0.8)
+    ax.axvline(annual.mean(), color='tab:red', label='mean')
+    ax.set(title='{}: annual rainfall {}-{}'.format(name, years.min(),
+                                                    years.max()),
+           xlabel='Annual rainfall in mm', ylabel='Years')
+    ax.legend()
+    fig.savefig(path, dpi=params['dpi'], bbox_inches='tight')
+    plt.close(fig)
+
+
+def plot_share(name, years, monthly, path, params):
+    plt, fig, ax = _pyplot(params)
+    means = np.nanmean(monthly, axis=0)
+    ax.pie(means, labels=MONTHS, autopct='%1.0f%%', startangle=90,
+           counterclock=False)
+    ax.set(title='{}: rainfall distribution by month'.format(name))
+    fig.savefig(path, dpi=params['dpi'], bbox_inches='tight')
+    plt.close(fig)
+
+
+def plot_timeline(name, years, monthly, path, params):
+    import plotly.graph_objects as go
+
+    dates = ['{}-{:02d}-01'.format(year, month + 1)
+             for year in years for month in range(len(MONTHS))]
+    fig = go.Figure(go.Scatter(x=dates, y=monthly.ravel()))
+    fig.update_layout(
+        title='{}: rainfall through the timeline'.format(name),
+        xaxis_title='Time', yaxis_title='Rainfall in mm',
+        xaxis=dict(type='date', rangeslider=dict(visible=True),
+                   rangeselector=dict(buttons=[
+                       dict(label='Whole view', step='all'),
+                       dict(count=1, label='One year view', step='year',
+                            stepmode='todate')])))
+    fig.write_html(path, include_plotlyjs='directory', full_html=True)
+
+
+def plot_monthly(name, years, monthly, path, params):
+    import plotly.express as px
+
+    fig = px.line(x=np.repeat(years, len(MONTHS)), y=monthly.ravel(),
+                  facet_col=np.tile(MONTHS, len(years)), facet_col_wrap=4,
+                  labels={'x': 'Year', 'y': 'Rainfall', 'facet_col': 'Month'},
+                  category_orders={'facet_col': MONTHS})
+    fig.update_layout(
+        title='{}: monthly rainfall through history'.format(name))
+    fig.write_html(path, include_plotlyjs='directory', full_html=True)
+
+
+PLOTS = {'boxplot': plot_boxplot, 'annual': plot_annual, 'share': plot_share,
+         'timeline': plot_timeline, 'monthly': plot_monthly}
+
+
+def render(figure, name, years, monthly, path, params):
+    """Draw one figure into ``path`` (atomically); returns ``path``."""
+    path = Path(path)
+    tmp = path.with_name('.tmp-' + path.name)
+    PLOTS[figure](name, years, monthly, str(tmp), params)
+    for suffix in ('.gz', '.br'):
+        Path(str(path) + suffix).unlink(missing_ok=True)
+    os.replace(tmp, path)
+    if FIGURES[figure] == 'html':
+        compress(path, path.read_bytes())
+    return path
+
+
+def stale_figures(store, names, manifest, output, params, force=False):
+    """Render tasks of the figures whose cached file is out of date."""
+    tasks = []
+    for name in names:
+        years, monthly = store.series(name)
+        files = {}
+        for figure, extension in FIGURES.items():
+            filename = '{}-{}.{}'.format(slug(name), figure, extension)
+            files[figure] = filename
+            key = figure_key(figure, years, monthly, params)
+            if (not force and manifest['keys'].get(filename) == key
+                    and (output / filename).exists()):
+                continue
+            tasks.append((filename, key, (figure, name, years, monthly,
+                                          output / filename, params)))
+        manifest['subdivisions'][slug(name)] = {'subdivision': name,
+                                                'files': files}
+    return tasks
+
+
+def render_all(tasks, manifest, max_workers=None):
+    """Render on a process pool, recording the key of every figure drawn.
+
+    A failed figure is logged and keeps its old key, so the next run
+    draws it again. Returns (built, failed) counts.
+    """
+    # Imported here: the web app imports this module for FIGURES_DIR
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    built = failed = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(render, *args): (filename, key)
+                   for filename, key, args in tasks}
+        for future in as_completed(futures):
+            filename, key = futures[future]
+            try:
+                future.result()
+            except Exception:
+                failed += 1
+                logger.exception('could not draw %s', filename)
+                continue
+            manifest['keys'][filename] = key
+            built += 1
+    return built, failed
+
+
+def generate(output=FIGURES_DIR, data_path=RAINFALL_DATA, subdivisions=None,
+             params=PARAMS, max_workers=None, force=False):
+    """Build every stale figure; returns (built, skipped, failed) counts."""
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    store = open_store(data_path)
+    manifest = read_manifest(output)
+    names = subdivisions or store.subdivisions
+    tasks = stale_figures(store, names, manifest, output, params, force)
+    built = failed = 0
+    try:
+        if tasks:
+            logger.info('drawing %d figures', len(tasks))
+            built, failed = render_all(tasks, manifest, max_workers)
+        script = output / 'plotly.min.js'
+        if script.exists() and not Path(str(script) + '.gz').exists():
+            compress(script, script.read_bytes())
+    finally:
+        # Also when interrupted, so the figures already drawn stay cached
+        write_manifest(manifest, output)
+    return built, len(names) * len(FIGURES) - len(tasks), failed
+
+
+@click.command()
+@click.option('--output', default=FIGURES_DIR, show_default=True)
+@click.option('--data', 'data_path', default=RAINFALL_DATA, show_default=True)
+@click.option('--subdivision', '-s', 'subdivisions', multiple=True,
+              help='Only these subdivisions (default: all).')
+@click.option('--workers', default=None, type=int,
+              help='Worker processes (default: one per CPU).')
+@click.option('--dpi', default=PARAMS['dpi'], show_default=True)
+@click.option('--force', is_flag=True, help='Redraw cached figures too.')
+def main(output, data_path, subdivisions, workers, dpi, force):
+    """ Draws the EDA figures of every subdivision into reports/figures.
+    """
+    params = dict(PARAMS, dpi=dpi)
+    built, skipped, failed = generate(output, data_path, subdivisions or None,
+                                      params, workers, force)
+    logger.info('%d figures drawn, %d unchanged, in %s', built, skipped,
+                output)
+    if failed:
+        raise click.ClickException('{} figures failed'.format(failed))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""Build and serve fingerprinted static assets.
+
+``python -m src.web.assets`` turns ``static/`` into ``static/dist/``:
+
+* identical files (the same image is checked in under several paths) are
+  processed once and share one output;
+* JPEG/PNG images are re-encoded as WebP at their own size capped at
+  ``MAX_WIDTH``, plus smaller widths for ``srcset``;
+* ``url(...)`` references inside CSS are rewritten to the built images,
+  and CSS is precompressed with gzip and, when installed, brotli;
+* every output is named after a hash of its content, so it can be cached
+  forever.
+
+``manifest.json`` maps each original ``static/`` path to its built file.
+``install`` makes ``url_for('static', filename=...)`` resolve through the
+manifest and serves built files precompressed and immutable. Without a
+manifest the original files are served as before.
+"""
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+import click
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # optional; CSS is precompressed with gzip only
+    brotli = None
+
+STATIC_DIR = 'static'
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+MAX_WIDTH = 1920
+WIDTHS = (640, 1280)
+QUALITY = 80
+IMAGES = {'.jpg', '.jpeg', '.png'}
+ONE_YEAR = 365 * 24 * 3600
+
+logger = logging.getLogger(__name__)
+
+_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def fingerprint(data):
+    return hashlib.sha1(data).hexdigest()[:10]
+
+
+def output_name(logical, data, suffix=None, width=None):
+    """``dist/<dir>/<stem>[.w<width>].<hash><suffix>``."""
+    path = Path(logical)
+    stem = path.stem.replace(' ', '-')
+    if width is not None:
+        stem += '.w{}'.format(width)
+    return (Path(DIST) / path.parent / '{}.{}{}'.format(
+        stem, fingerprint(data), suffix or path.suffix)).as_posix()
+
+
+def encode_image(data, widths=WIDTHS, max_width=MAX_WIDTH, quality=QUALITY):
+    """WebP bytes of an image at each width, largest first."""
+    # Pillow is only needed to build assets, not to serve them.
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    full = min(image.width, max_width)
+    encoded = []
+    for width in sorted({full} | {w for w in widths if w < full},
+                        reverse=True):
+        resized = image
+        if width != image.width:
+            height = round(image.height * width / image.width)
+            resized = image.resize((width, height), Image.LANCZOS)
+        buffer = io.BytesIO()
+        resized.save(buffer, 'WEBP', quality=quality, method=6)
+        encoded.append((width, buffer.getvalue()))
+    return encoded
+
+
+def compress(path, data):
+    """Write gzip (and brotli, if available) siblings of ``path``."""
+    encodings = ['gzip']
+    Path(str(path) + '.gz').write_bytes(
+        gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        Path(str(path) + '.br').write_bytes(
+            brotli.compress(data, quality=11))
+        encodings.insert(0, 'br')
+    return encodings
+
+
+def rewrite_css(css, logical, assets):
+    """Point relative ``url(...)`` references at built assets."""
+    base = Path(logical).parent
+
+    def replace(match):
+        quote, url = match.groups()
+        for candidate in (base / url, Path(url)):
+            key = os.path.normpath(candidate).replace(os.sep, '/')
+            if key in assets:
+                return 'url({0}/static/{1}{0})'.format(
+                    quote or '"', assets[key])
+        return match.group(0)
+
+    return _CSS_URL.sub(replace, css)
+
+
+def build(static_dir=STATIC_DIR, widths=WIDTHS, max_width=MAX_WIDTH,
+          quality=QUALITY):
+    """Build ``static/dist`` and its manifest; returns the manifest.
+
+    The new generation is written to a sibling directory and swapped in
+    once complete, so a running app keeps serving the previous one while
+    the build runs, and a failed build leaves it untouched.
+    """
+    if brotli is None:
+        logger.warning('brotli not installed, precompressing with gzip only')
+    static_dir = Path(static_dir)
+    sources = sorted(path for path in static_dir.rglob('*')
+                     if path.is_file() and not path.relative_to(
+                         static_dir).parts[0].startswith((DIST, '.' + DIST)))
+    build_dir = Path(tempfile.mkdtemp(prefix='.{}-'.format(DIST),
+                                      dir=static_dir))
+    try:
+        manifest = _build(static_dir, build_dir, sources, widths, max_width,
+                          quality)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    os.chmod(build_dir, 0o755)
+    _swap(build_dir, static_dir / DIST)
+    return manifest
+
+
+def _swap(build_dir, dist_dir):
+    """Replace ``dist_dir`` by ``build_dir``, then drop the old one."""
+    previous = None
+    if dist_dir.exists():
+        previous = Path(tempfile.mkdtemp(prefix='.{}-old-'.format(DIST),
+                                         dir=dist_dir.parent))
+        os.replace(dist_dir, previous / DIST)
+    os.replace(build_dir, dist_dir)
+    if previous is not None:
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def _build(static_dir, build_dir, sources, widths, max_width, quality):
+
+    manifest = {'assets': {}, 'srcset': {}, 'encodings': {}}
+    built = {}  # content hash -> (asset, srcset) of the first copy
+    report = {'before': 0, 'after': 0, 'duplicates': 0}
+
+    def write(name, data):
+        target = build_dir / Path(name).relative_to(DIST)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(data)
+        report['after'] += len(data)
+        return target
+
+    # Images first, so CSS can be rewritten to point at them.
+    sources.sort(key=lambda path: path.suffix.lower() == '.css')
+    for path in sources:
+        logical = path.relative_to(static_dir).as_posix()
+        data = path.read_bytes()
+        report['before'] += len(data)
+        digest = fingerprint(data)
+        suffix = path.suffix.lower()
+        if digest in built and suffix != '.css':
+            report['duplicates'] += 1
+            manifest['assets'][logical], srcset = built[digest]
+            if srcset:
+                manifest['srcset'][logical] = srcset
+            continue
+
+        srcset = None
+        if suffix in IMAGES:
+            variants = encode_image(data, widths, max_width, quality)
+            srcset = []
+            for width, encoded in variants:
+                name = output_name(logical, encoded, '.webp', width)
+                write(name, encoded)
+                srcset.append([width, name])
+            asset = srcset[0][1]
+        elif suffix == '.css':
+            css = rewrite_css(data.decode('utf-8'), logical,
+                              manifest['assets'])
+            data = css.encode('utf-8')
+            asset = output_name(logical, data)
+            manifest['encodings'][asset] = compress(write(asset, data), data)
+        else:
+            asset = output_name(logical, data)
+            write(asset, data)
+        manifest['assets'][logical] = asset
+        if srcset and len(srcset) > 1:
+            manifest['srcset'][logical] = srcset
+        built[digest] = (asset, manifest['srcset'].get(logical))
+
+    with open(build_dir / MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    manifest['report'] = report
+    return manifest
+
+
+def load_manifest(static_dir=STATIC_DIR):
+    path = Path(static_dir) / DIST / MANIFEST
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def install(app):
+    """Resolve static URLs through the manifest and serve built assets."""
+    manifest = load_manifest(app.static_folder)
+    if manifest is None:
+        app.jinja_env.globals['static_srcset'] = lambda filename: ''
+        return None
+    assets = manifest['assets']
+    encodings = manifest['encodings']
+
+    @app.url_defaults
+    def built_asset(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in assets:
+            values['filename'] = assets[values['filename']]
+
+    def static_srcset(filename):
+        return ', '.join('{} {}w'.format(
+            app.url_for('static', filename=name), width)
+            for width, name in manifest['srcset'].get(filename, []))
+
+    app.jinja_env.globals['static_srcset'] = static_srcset
+
+    send_static = app.view_functions['static']
+
+    def static(filename):
+        if not filename.startswith(DIST + '/'):
+            return send_static(filename=filename)
+        for encoding in encodings.get(filename, []):
+            if encoding in request.accept_encodings:
+                suffix = '.br' if encoding == 'br' else '.gz'
+                response = send_from_directory(
+                    app.static_folder, filename + suffix,
+                    mimetype=mimetypes.guess_type(filename)[0])
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_static(filename=filename)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = ONE_YEAR
+        response.cache_control.immutable = True
+        return response
+
+    app.view_functions['static'] = static
+    return manifest
+
+
+@click.command()
+@click.option('--static-dir', default=STATIC_DIR, show_default=True)
+@click.option('--max-width', default=MAX_WIDTH, show_default=True)
+@click.option('--width', '-w', 'widths', multiple=True, type=int,
+              default=WIDTHS, show_default=True)
+@click.option('--quality', default=QUALITY, show_default=True)
+def main(static_dir, max_width, widths, quality):
+    """ Builds fingerprinted, resized and precompressed static assets.
+    """
+    manifest = build(static_dir, widths, max_width, quality)
+    report = manifest['report']
+    logger.info('%d assets (%d duplicates): %.1f MB -> %.1f MB',
+                len(manifest['assets']), report['duplicates'],
+                report['before'] / 1e6, report['after'] / 1e6)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
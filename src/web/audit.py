@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Write-behind audit log of the predictions served.
+
+Every prediction route calls ``AuditLog.record`` with the route, its
+inputs and output, the model version and the latency. That is a
+``put_nowait`` of a tuple into a bounded queue, so the response never
+waits on disk. When the queue is full the entry is dropped and counted.
+
+A daemon thread per process serializes the entries and writes them to
+SQLite (``instance/audit.db``) one transaction per batch. Under load the
+batches grow to ``BATCH_SIZE``. At exit the thread drains the queue.
+``python -m src.web.audit`` reports request counts, errors and latency
+per route and model version.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+import click
+import numpy as np
+
+AUDIT_DB = 'instance/audit.db'
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS audit (
+    created REAL NOT NULL,
+    route TEXT NOT NULL,
+    inputs TEXT NOT NULL,
+    output TEXT,
+    model_version TEXT,
+    latency_ms REAL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS audit_created ON audit (created);
+CREATE INDEX IF NOT EXISTS audit_route ON audit (route, model_version);
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def _plain(value):
+    return value.tolist() if hasattr(value, 'tolist') else str(value)
+
+
+def _json(value):
+    return json.dumps(value, default=_plain)
+
+
+def _percentile(values, q):
+    if not len(values):
+        return None
+    return round(float(np.percentile(values, q)), 3)
+
+
+class AuditStore:
+    """Audit entries in SQLite."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=10,
+                                       isolation_level=None))
+
+    def add(self, entries):
+        rows = [(created, route, _json(inputs), _json(output), version,
+                 latency_ms, status)
+                for created, route, inputs, output, version, latency_ms,
+                status in entries]
+        with self._connect() as conn:
+            conn.execute('BEGIN')
+            conn.executemany('INSERT INTO audit VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             rows)
+            conn.execute('COMMIT')
+
+    def report(self, since=0.0):
+        """Counts, errors and latency percentiles per route and version."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT route, model_version, latency_ms, status FROM audit '
+                'WHERE created >= ? ORDER BY route, model_version',
+                (since,)).fetchall()
+        groups = {}
+        for route, version, latency_ms, status in rows:
+            groups.setdefault((route, version), []).append(
+                (latency_ms, status))
+        report = []
+        for (route, version), values in groups.items():
+            latency = np.array([ms for ms, _ in values if ms is not None])
+            report.append({
+                'route': route, 'model_version': version,
+                'requests': len(values),
+                'errors': sum(status != 'ok' for _, status in values),
+                'p50_ms': _percentile(latency, 50),
+                'p99_ms': _percentile(latency, 99),
+            })
+        return report
+
+
+class AuditLog:
+    """Record served predictions, off the response path."""
+
+    def __init__(self, app=None, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.store = None
+        self.counters = dict.fromkeys(
+            ['recorded', 'dropped', 'written', 'failed'], 0)
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.store = AuditStore(app.config.get('AUDIT_DB', AUDIT_DB))
+
+    def record(self, route, inputs, output, model_version, latency_ms,
+               status='ok'):
+        """Queue one served prediction; never blocks."""
+        if self.store is None:
+            return
+        self._start()
+        try:
+            self._queue.put_nowait((time.time(), route, inputs, output,
+                                    model_version, latency_ms, status))
+        except queue.Full:
+            self.counters['dropped'] += 1
+            return
+        self.counters['recorded'] += 1
+
+    def _start(self):
+        # Started on first use in each process, since a thread started in a
+        # preloading parent does not survive the fork into a worker
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.queue_size)
+                self._thread = threading.Thread(target=self._run,
+                                                name='audit', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        pending = self._queue
+        while True:
+            batch = [pending.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            # None is the stop signal from close
+            stop = None in batch
+            entries = [entry for entry in batch if entry is not None]
+            if entries:
+                try:
+                    self.store.add(entries)
+                except sqlite3.Error:
+                    self.counters['failed'] += len(entries)
+                    logger.exception('could not write %d audit entries',
+                                     len(entries))
+                else:
+                    self.counters['written'] += len(entries)
+            if stop:
+                return
+
+    def close(self, timeout=5):
+        """Write what is queued and stop this process's writer."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                try:
+                    self._queue.put(None, timeout=timeout)
+                except queue.Full:
+                    return
+                self._thread.join(timeout)
+                self._pid = None
+
+    def stats(self):
+        pending = self._queue.qsize() if self._pid == os.getpid() else 0
+        return dict(self.counters, pending=pending, queue_size=self.queue_size)
+
+
+@click.command()
+@click.option('--db', default=AUDIT_DB, show_default=True)
+@click.option('--hours', default=0.0, help='Only the last N hours (0: all).')
+def main(db, hours):
+    """ Reports the predictions served per route and model version.
+    """
+    since = time.time() - hours * 3600 if hours else 0.0
+    report = AuditStore(db).report(since)
+    if not report:
+        logger.info('no audit entries in %s', db)
+    for row in report:
+        logger.info('%-36s %-24s %6d requests, %4d errors, '
+                    'p50 %s ms, p99 %s ms',
+                    row['route'], row['model_version'], row['requests'],
+                    row['errors'], row['p50_ms'], row['p99_ms'])
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Single-flight coalescing of identical concurrent computations.
+
+When many requests ask for the same thing at once, ``SingleFlight.do``
+runs the computation for the first of them. The others wait for that
+run and get its result.
+
+Only expensive calls are coalesced across worker processes: those given
+a ``lock_key``, with a ``lock_dir`` configured. The run holds an
+exclusive lock file for that key. Other workers asking for it wait until
+the run is done and then run it themselves. Their run is cheap, because
+the first one filled a cache on disk, such as the stored forecast. No
+results are written, and the lock file is removed when the run ends, so
+``lock_dir`` does not grow. ``stats()`` reports how many calls were
+served by someone else's run and how many waited for another worker.
+"""
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; coalescing stays in-process there
+    fcntl = None
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Concurrent calls with equal keys share one computation."""
+
+    def __init__(self, lock_dir=None):
+        self.lock_dir = Path(lock_dir) if lock_dir and fcntl else None
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = self.executed = 0
+        self.shared_in_process = self.waited_for_workers = 0
+
+    def do(self, key, fn, lock_key=None):
+        """``fn()``, or the result of the identical call already running.
+
+        With a ``lock_key``, other workers running a call under the same
+        lock key are waited for first.
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared_in_process += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = self._run(fn, lock_key)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _run(self, fn, lock_key):
+        if self.lock_dir is None or lock_key is None:
+            self._count('executed')
+            return fn()
+        digest = hashlib.sha1(repr(lock_key).encode('utf-8')).hexdigest()
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        path = self.lock_dir / (digest + '.lock')
+        with open(path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self._count('waited_for_workers')
+            try:
+                value = fn()
+                self._count('executed')
+                return value
+            finally:
+                # Removed while still locked; a worker that opens the path
+                # afterwards makes a new file, and its run is a cheap one
+                try:
+                    if os.stat(path).st_ino == os.fstat(lock.fileno()).st_ino:
+                        os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'executed': self.executed,
+                    'shared_in_process': self.shared_in_process,
+                    'waited_for_workers': self.waited_for_workers,
+                    'in_flight': len(self._calls),
+                    'dedup_ratio': (round(self.shared_in_process / self.calls,
+                                          4) if self.calls else 0.0)}
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Conditional GETs, per-route caching headers and response compression.
+
+Views wrapped with ``HttpCache.cached`` get a strong ETag. When the view's
+output is fully determined by a cheap key, such as a model version, the
+tag comes from that key plus the query string. A request that already
+holds the tag is then answered with 304 before the view runs. Without a
+key the tag is a hash of the rendered body.
+
+HTML and JSON responses over ``min_size`` bytes are gzip or brotli
+compressed. A compressed body carries its own tag (``<etag>-<encoding>``),
+as strong ETags must differ between encodings. Streamed responses are
+passed through untouched.
+"""
+import functools
+import gzip
+import hashlib
+from collections import OrderedDict
+
+from flask import make_response, request
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
+
+COMPRESSIBLE = {'text/html', 'application/json', 'text/css',
+                'application/javascript', 'text/plain'}
+MIN_SIZE = 1024
+
+
+class HttpCache:
+    """ETag/304 handling and compression, with byte counters."""
+
+    def __init__(self, app=None, min_size=MIN_SIZE, level=6, max_tags=1024):
+        self.min_size = min_size
+        self.level = level
+        self.max_tags = max_tags
+        # Body size last sent under each tag, to count what a 304 saved
+        self._sizes = OrderedDict()
+        self.counters = dict.fromkeys(
+            ['responses', 'not_modified', 'compressed', 'bytes_in',
+             'bytes_out', 'saved_by_304', 'saved_by_compression'], 0)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.compress)
+
+    @staticmethod
+    def etag(*parts):
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def _remember(self, tag, size):
+        self._sizes[tag] = size
+        self._sizes.move_to_end(tag)
+        if len(self._sizes) > self.max_tags:
+            self._sizes.popitem(last=False)
+
+    def _matched(self, tag):
+        """The variant of ``tag`` the client already holds, if any."""
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        for variant in (tag, tag + '-br', tag + '-gzip'):
+            if request.if_none_match.contains(variant):
+                return variant
+        return None
+
+    def _not_modified(self, tag, response=None):
+        self.counters['not_modified'] += 1
+        self.counters['saved_by_304'] += self._sizes.get(tag, 0)
+        response = response or make_response('', 304)
+        response.status_code = 304
+        response.set_data(b'')
+        response.set_etag(tag)
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def cached(self, key=None, max_age=0, public=False):
+        """Decorate a view with a strong ETag and ``Cache-Control``.
+
+        ``key(**view_args)`` returns what the output depends on besides
+        the query string, or None when no tag can be given up front.
+        ``max_age`` 0 means clients must revalidate every time.
+        ``public`` lets shared caches keep the response; leave it off for
+        views behind the login, which must only be cached by the browser.
+        """
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                tag = None
+                if key is not None:
+                    parts = key(**kwargs)
+                    if parts is not None:
+                        tag = self.etag(request.endpoint, parts, sorted(
+                            request.args.items(multi=True)))
+                        matched = self._matched(tag)
+                        if matched:
+                            response = self._not_modified(matched)
+                            self._cache_control(response, max_age, public)
+                            return response
+
+                response = make_response(view(**kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                if tag is None:
+                    tag = self.etag(response.get_data())
+                    matched = self._matched(tag)
+                    if matched:
+                        response = self._not_modified(matched, response)
+                        self._cache_control(response, max_age, public)
+                        return response
+                response.set_etag(tag)
+                self._remember(tag, response.content_length)
+                self._cache_control(response, max_age, public)
+                return response
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _cache_control(response, max_age, public):
+        if public:
+            response.cache_control.public = True
+        else:
+            response.cache_control.private = True
+        response.cache_control.max_age = max_age
+        if not max_age:
+            response.cache_control.no_cache = True
+
+    def compress(self, response):
+        """after_request hook: compress eligible responses in place."""
+        self.counters['responses'] += 1
+        if (response.status_code != 200 or response.direct_passthrough
+                or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE):
+            return response
+        response.vary.add('Accept-Encoding')
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br']:
+            encoding, body = 'br', brotli.compress(data, quality=5)
+        elif accepted['gzip']:
+            encoding, body = 'gzip', gzip.compress(
+                data, compresslevel=self.level)
+        else:
+            return response
+
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        tag, weak = response.get_etag()
+        if tag and not weak:
+            tag = '{}-{}'.format(tag, encoding)
+            response.set_etag(tag)
+            self._remember(tag, len(body))
+        self.counters['compressed'] += 1
+        self.counters['bytes_in'] += len(data)
+        self.counters['bytes_out'] += len(body)
+        self.counters['saved_by_compression'] += len(data) - len(body)
+        return response
+
+    def stats(self):
+        return dict(self.counters)
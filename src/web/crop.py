@@ -0,0 +1,180 @@
+"""Crop recommendation pages and the planting API."""
+import logging
+import os
+import time
+
+from flask import (Blueprint, abort, current_app, jsonify, redirect,
+                   render_template, request, session, url_for)
+
+from src.models.forecast_store import load_forecast
+from src.models.planner import (DEFAULT_SEASON, HUMIDITIES, SEASONS,
+                                TEMPERATURES, model_rainfall, rank_crops,
+                                scenario_grid, season_rainfall)
+from src.models.registry import REGIONS, SUBDIVISION_REGIONS
+from src.models.tree_compiler import load_compiled
+from src.web.resources import (audit, climatology, http_cache, limiter,
+                               shadow, subdivision_index)
+
+bp = Blueprint('crop', __name__)
+logger = logging.getLogger(__name__)
+
+# Endpoints reachable without logging in
+PUBLIC = ['login_crop', 'register_crop', 'crop_home', 'crop_index',
+          'crop_parameters']
+# Background job kinds a node serving this blueprint accepts
+JOB_KINDS = ['crop']
+
+
+def warm_up(app):
+    load_compiled()
+
+
+def probe(app):
+    # One row of Crop_recommendation.csv (rice)
+    load_compiled().predict_labels([[90, 42, 43, 20.88, 82.0, 6.5, 202.94]])
+
+
+@bp.route('/register_crop', methods=['GET', 'POST'])
+@limiter.limit('10 per minute')
+def register_crop():
+    if request.method == 'POST':
+        email = request.form['email']
+        password = request.form['password']
+        users = current_app.extensions['users']
+
+        if users.exists(email) or not users.add(email, password):
+            return render_template('register.html', register_type='crop',
+                                   error='Email already registered')
+        return redirect(url_for('crop.login_crop'))
+    return render_template('register.html', register_type='crop')
+
+
+@bp.route('/login_crop', methods=['GET', 'POST'])
+@limiter.limit('10 per minute')
+def login_crop():
+    if request.method == 'POST':  # Corrected: Changed `]` to `)`
+        email = request.form['email']
+        password = request.form['password']
+        if current_app.extensions['users'].check(email, password):
+            session['email'] = email
+            return redirect('/crop_index')
+        return render_template(
+            'login.html', login_type='crop',
+            error='Invalid User.If this is your first time here please '
+                  'register first.')
+    return render_template('login.html', login_type='crop')
+
+
+@bp.route('/logout_crop', methods=['POST'])
+def logout_crop():
+    session.pop('email', None)
+    return redirect(url_for('crop.login_crop'))
+
+
+@bp.route('/crop_home')
+@http_cache.cached(public=True)
+def crop_home():
+    return render_template('crop_home.html')
+
+
+@bp.route('/crop_index')
+@http_cache.cached(public=True)
+def crop_index():
+    return render_template('crop_index.html')
+
+
+@bp.route('/crop_parameters', methods=['POST'])
+@limiter.limit('5 per minute')
+def crop_parameters():
+    try:
+        # Retrieve form data
+        N = float(request.form['N'])
+        P = float(request.form['P'])
+        K = float(request.form['K'])
+        temperature = float(request.form['temperature'])
+        humidity = float(request.form['humidity'])
+        ph = float(request.form['ph'])
+        rainfall = float(request.form['rainfall'])
+
+        # Load the compiled crop model
+        started = time.perf_counter()
+        model = load_compiled()
+
+        # Make prediction; the compiled model carries its label vocabulary
+        inputs = [N, P, K, temperature, humidity, ph, rainfall]
+        predicted_crop = model.predict_labels([inputs])
+        elapsed = (time.perf_counter() - started) * 1000
+        shadow.submit('crop', inputs, predicted_crop[0],
+                      model.source_version, elapsed)
+        audit.record(request.endpoint, inputs, predicted_crop[0],
+                     model.source_version, elapsed)
+
+        # Render the result template with prediction results
+        return render_template('crop_result.html', crop=predicted_crop[0])
+
+    except Exception as e:
+        # Logged and audited off the request thread
+        logger.exception('crop prediction failed',
+                         extra={'endpoint': request.endpoint})
+        audit.record(request.endpoint, request.form.to_dict(), repr(e), None,
+                     None, status='error')
+        return render_template('crop_result.html',
+                               crop="Error occurred during prediction")
+
+    return 'Invalid request'
+
+
+def planting_rainfall(subdivision, season):
+    # Forecast where the subdivision has a model, climatology otherwise
+    region = SUBDIVISION_REGIONS.get(subdivision)
+    if region is not None and os.path.exists(REGIONS[region][1]):
+        forecast = load_forecast(REGIONS[region][1],
+                                 levels=current_app.config['FORECAST_LEVELS'])
+        return season_rainfall(forecast['mean'], season), 'forecast'
+    mean = climatology().value(subdivision, season, 'mean')
+    return mean / len(SEASONS[season]), 'climatology'
+
+
+@bp.route('/api/plan', methods=['POST'])
+@limiter.limit('10 per minute')
+def plan_api():
+    data = request.get_json(silent=True) or request.form
+    try:
+        N, P, K, ph = (float(data[name]) for name in ('N', 'P', 'K', 'ph'))
+        temperatures = ([float(data['temperature'])]
+                        if 'temperature' in data else TEMPERATURES)
+        humidities = ([float(data['humidity'])]
+                      if 'humidity' in data else HUMIDITIES)
+        top = int(data.get('top', 5))
+    except (KeyError, TypeError, ValueError):
+        abort(400, 'N, P, K and ph are required numbers')
+    if top < 1:
+        abort(400, 'top must be positive')
+    season = data.get('season', DEFAULT_SEASON)
+    if season not in SEASONS:
+        abort(400, f'season must be one of {", ".join(SEASONS)}')
+
+    subdivision = data.get('subdivision')
+    if subdivision is None:
+        try:
+            lat, lon = float(data['lat']), float(data['lon'])
+        except (KeyError, TypeError, ValueError):
+            abort(400, 'expected a subdivision or lat/lon')
+        index, _ = subdivision_index().locate(lat, lon)
+        subdivision = str(subdivision_index().names[index[0]])
+    elif subdivision not in climatology().subdivisions:
+        abort(404)
+
+    started = time.perf_counter()
+    rainfall, source = planting_rainfall(subdivision, season)
+    # Ranked on rainfall within the crop model's training range
+    rows = scenario_grid(N, P, K, ph, float(model_rainfall(rainfall)),
+                         temperatures, humidities)
+    model = load_compiled()
+    crops = rank_crops(model, rows, top)
+    audit.record(request.endpoint, dict(data), crops, model.source_version,
+                 (time.perf_counter() - started) * 1000)
+    return jsonify(subdivision=subdivision, season=season,
+                   rainfall=round(rainfall, 2), rainfall_source=source,
+                   model_rainfall=round(float(model_rainfall(rainfall)), 2),
+                   scenarios=len(rows), crops=crops)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Application factory and deployment profiles.
+
+A profile picks the blueprints a worker serves. ``rain`` nodes never load
+the crop model and ``crop`` nodes never load the history store or the
+rain-only APIs; ``all`` serves everything from one process as before.
+Each blueprint module provides ``PUBLIC`` (endpoints open without a
+login), ``JOB_KINDS`` (background jobs it accepts), ``warm_up(app)``
+(what to load in the background at start-up) and ``probe(app)`` (a
+synthetic prediction that must be fast before the worker reports ready
+on ``/readyz``). A ``rain`` node queues no crop jobs and vice versa.
+"""
+import logging
+import os
+from functools import partial
+from pathlib import Path
+
+from flask import (Flask, current_app, jsonify, redirect, render_template,
+                   request, session, url_for)
+
+from src.models.forecast_store import LEVELS
+from src.visualization.visualize import FIGURES_DIR
+from src.web import assets, crop, jobs, logs, rain
+from src.web.resources import audit, http_cache, limiter, predictions, shadow
+from src.web.startup import READY_THRESHOLD_MS, Readiness, start_warm_up
+from src.web.templating import (BYTECODE_DIR, compile_templates,
+                                install_bytecode_cache)
+from src.web.users import UserStore
+
+ROOT = Path(__file__).resolve().parents[2]
+BLUEPRINTS = {'rain': rain, 'crop': crop}
+PROFILES = {
+    'all': ('rain', 'crop'),
+    'rain': ('rain',),
+    'crop': ('crop',),
+}
+
+
+def create_app(profile='all', warm_up=None):
+    """Build the app for a profile in ``PROFILES``.
+
+    ``warm_up`` defaults to the ``WARM_UP`` environment variable (on
+    unless it is ``0``). The user, job, audit, shadow and rate limit
+    databases live in ``INSTANCE_PATH``, by default ``instance/``.
+    """
+    if profile not in PROFILES:
+        raise ValueError('unknown profile {!r}, expected one of {}'.format(
+            profile, ', '.join(PROFILES)))
+    app = Flask('app', root_path=str(ROOT),
+                instance_path=os.path.abspath(os.environ.get(
+                    'INSTANCE_PATH', ROOT / 'instance')))
+    app.secret_key = 'secret_key'
+    app.config['PROFILE'] = profile
+    app.config['BLUEPRINTS'] = PROFILES[profile]
+    app.config['FORECAST_LEVELS'] = LEVELS
+    # Result tables at least this long are streamed while they render
+    app.config['STREAM_TABLE_ROWS'] = 24
+    app.config['FIGURES_DIR'] = str(ROOT / FIGURES_DIR)
+    # Token buckets in one SQLite file, so limits hold across workers
+    app.config['RATELIMIT_STORAGE_URI'] = os.environ.get(
+        'RATELIMIT_STORAGE_URI',
+        'sqlite:///' + os.path.join(app.instance_path, 'ratelimit.db'))
+    app.config['RATELIMIT_STRATEGY'] = 'moving-window'
+    # Candidate models fed copies of live inputs, e.g.
+    # crop=models/candidates/XB.pbz2
+    app.config['SHADOW_MODELS'] = os.environ.get('SHADOW_MODELS', '')
+    app.config['SHADOW_DB'] = os.path.join(app.instance_path, 'shadow.db')
+    app.config['AUDIT_DB'] = os.environ.get(
+        'AUDIT_DB', os.path.join(app.instance_path, 'audit.db'))
+
+    # JSON lines through a queue, so a slow stderr never stalls a request
+    if os.environ.get('LOG_JSON', '1') == '1':
+        logs.install(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO')),
+                     int(os.environ.get('LOG_QUEUE_SIZE', logs.QUEUE_SIZE)))
+
+    install_bytecode_cache(app, os.environ.get('TEMPLATE_CACHE_DIR',
+                                               BYTECODE_DIR))
+    # Fingerprinted assets from `python -m src.web.assets`, when built
+    assets.install(app)
+    http_cache.init_app(app)
+    limiter.init_app(app)
+    shadow.init_app(app)
+    audit.init_app(app)
+    app.extensions['users'] = UserStore(
+        os.path.join(app.instance_path, 'database.db'))
+    # Served by `python -m src.web.jobs` workers, which share the queue file
+    app.config['JOB_RESULTS_DIR'] = str(ROOT / jobs.RESULTS_DIR)
+    app.config['MAX_CONTENT_LENGTH'] = jobs.MAX_UPLOAD_BYTES
+    app.config['JOB_KINDS'] = [kind for name in PROFILES[profile]
+                               for kind in BLUEPRINTS[name].JOB_KINDS]
+    app.extensions['jobs'] = jobs.JobQueue(os.environ.get(
+        'JOBS_DB', os.path.join(app.instance_path, 'jobs.db')))
+    app.register_blueprint(jobs.bp)
+
+    public = {'static', 'newhome', 'healthz', 'readyz'}
+    for name in PROFILES[profile]:
+        module = BLUEPRINTS[name]
+        app.register_blueprint(module.bp)
+        public.update('{}.{}'.format(name, endpoint)
+                      for endpoint in module.PUBLIC)
+
+    app.add_url_rule('/', 'newhome', http_cache.cached(public=True)(newhome))
+    app.add_url_rule('/api/http/stats', 'http_stats_api', http_stats_api)
+    app.add_url_rule('/api/coalesce/stats', 'coalesce_stats_api',
+                     coalesce_stats_api)
+    app.add_url_rule('/api/shadow/report', 'shadow_report_api',
+                     shadow_report_api)
+    app.add_url_rule('/api/audit/stats', 'audit_stats_api', audit_stats_api)
+    # Polled by load balancers, so kept out of the rate limits
+    app.add_url_rule('/healthz', 'healthz', limiter.exempt(healthz))
+    app.add_url_rule('/readyz', 'readyz', limiter.exempt(readyz))
+    app.before_request(partial(require_login, public))
+    app.cli.command('compile-templates')(compile_templates_command)
+
+    if warm_up is None:
+        warm_up = os.environ.get('WARM_UP', '1') == '1'
+    app.extensions['readiness'] = Readiness(
+        {name: partial(BLUEPRINTS[name].probe, app)
+         for name in PROFILES[profile]},
+        float(os.environ.get('READY_THRESHOLD_MS', READY_THRESHOLD_MS)))
+    if warm_up:
+        app.extensions['warm_up'] = start_warm_up(
+            [partial(BLUEPRINTS[name].warm_up, app)
+             for name in PROFILES[profile]]
+            + [app.extensions['readiness'].run])
+    return app
+
+
+def newhome():
+    return render_template('newhome.html')
+
+
+def http_stats_api():
+    return jsonify(http_cache.stats())
+
+
+def coalesce_stats_api():
+    return jsonify(predictions.stats())
+
+
+def shadow_report_api():
+    return jsonify(shadow.report(request.args.get('since', 0.0, type=float)))
+
+
+def audit_stats_api():
+    return jsonify(audit=audit.stats(), logging=logs.stats())
+
+
+def healthz():
+    return jsonify(status='ok')
+
+
+def readyz():
+    readiness = current_app.extensions['readiness']
+    warming = current_app.extensions.get('warm_up')
+    # Probe here when no warm-up is running: it is off, or it ran in a
+    # preloading parent process and did not pass there
+    if not readiness.ready and (warming is None or not warming.is_alive()):
+        readiness.run()
+    report = readiness.report()
+    return jsonify(report), 200 if report['ready'] else 503
+
+
+def require_login(public):
+    if request.endpoint in public or 'email' in session:
+        return
+    # Crop pages send visitors to the crop login, everything else to rain's
+    if (request.blueprint == 'crop'
+            or 'rain' not in current_app.config['BLUEPRINTS']):
+        return redirect(url_for('crop.login_crop'))
+    return redirect(url_for('rain.login_rain'))
+
+
+def compile_templates_command():
+    """Compile every template into the shared bytecode cache."""
+    names = compile_templates(current_app)
+    print(f'compiled {len(names)} templates')
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+"""Background jobs: long forecasts and bulk crop files off the web workers.
+
+The web app only records a job in a SQLite queue (``instance/jobs.db``)
+and returns its id. ``python -m src.web.jobs`` runs a pool of worker
+processes. Each worker loads the forecasts and the crop model once, then
+claims queued jobs, reports progress and writes the result file under
+``reports/jobs/``. No broker is involved. Jobs are rows in the queue,
+so queued work survives restarts. A job left running by a worker that
+died is queued again when the pool starts or replaces that worker, and
+marked failed once it has been claimed ``MAX_ATTEMPTS`` times.
+
+Job kinds:
+
+* ``forecast``: monthly forecasts with intervals for some or all regions,
+  up to ``MAX_JOB_HORIZON`` months, as CSV. Workers keep these long
+  forecasts under ``models/cache/jobs``, apart from the ones the web app
+  serves.
+* ``crop``: an uploaded CSV (at most ``MAX_UPLOAD_BYTES``) with the crop
+  model's input columns, written back with a ``crop`` column added. It
+  is streamed ``CROP_CHUNK_ROWS`` rows at a time, never held whole.
+
+A web node accepts only the kinds of the blueprints its profile serves,
+and ``--kind`` limits a worker pool to some kinds.
+"""
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+from pathlib import Path
+
+import click
+import numpy as np
+from flask import (Blueprint, abort, current_app, jsonify, request,
+                   send_file, url_for)
+
+from src.models.forecast_store import LEVELS, load_forecast
+from src.models.registry import REGIONS
+from src.models.tree_compiler import load_compiled
+from src.web.resources import forecast_dates, limiter
+
+JOBS_DB = 'instance/jobs.db'
+RESULTS_DIR = 'reports/jobs'
+MAX_JOB_HORIZON = 240
+JOB_FORECAST_DIR = 'models/cache/jobs'
+KINDS = ('forecast', 'crop')
+CROP_COLUMNS = ['N', 'P', 'K', 'temperature', 'humidity', 'ph', 'rainfall']
+CROP_CHUNK_ROWS = 10000
+# Request bodies past this are refused with 413 before they are read
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+# Claims of a job before a dying worker marks it failed, not queued
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 0.5
+POLL_LIMIT = '120 per minute'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    progress REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    worker INTEGER,
+    worker_start INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS job_queued ON job (status, created);
+"""
+# Columns added since the first schema, for queues created before them
+ADDED_COLUMNS = {'worker_start': 'INTEGER',
+                 'attempts': 'INTEGER NOT NULL DEFAULT 0'}
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('jobs', __name__)
+
+
+class JobQueue:
+    """Jobs and their state in one SQLite file, shared by all processes."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in
+                       conn.execute('PRAGMA table_info(job)')}
+            for name, definition in ADDED_COLUMNS.items():
+                if name not in columns:
+                    conn.execute('ALTER TABLE job ADD COLUMN {} {}'.format(
+                        name, definition))
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=10,
+                                       isolation_level=None))
+
+    def submit(self, kind, params, job_id=None):
+        job_id = job_id or uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute('INSERT INTO job (id, kind, params, created) '
+                         'VALUES (?, ?, ?, ?)',
+                         (job_id, kind, json.dumps(params), time.time()))
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('SELECT * FROM job WHERE id = ?',
+                               (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        return job
+
+    def claim(self, worker, kinds=KINDS):
+        """Mark the oldest queued job of ``kinds`` running and return it."""
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT id FROM job WHERE status = 'queued' AND kind IN "
+                "({}) ORDER BY created LIMIT 1".format(
+                    ', '.join('?' * len(kinds))), tuple(kinds)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE job SET status = 'running', worker = ?, "
+                             "worker_start = ?, attempts = attempts + 1, "
+                             "started = ? WHERE id = ?",
+                             (worker, _process_start(worker), time.time(),
+                              row[0]))
+            conn.execute('COMMIT')
+        return None if row is None else self.get(row[0])
+
+    def progress(self, job_id, fraction):
+        with self._connect() as conn:
+            conn.execute('UPDATE job SET progress = ? WHERE id = ?',
+                         (round(fraction, 4), job_id))
+
+    def finish(self, job_id, result=None, error=None):
+        with self._connect() as conn:
+            if error is None:
+                conn.execute("UPDATE job SET status = 'done', progress = 1, "
+                             "result = ?, finished = ? WHERE id = ?",
+                             (result, time.time(), job_id))
+            else:
+                conn.execute("UPDATE job SET status = 'failed', error = ?, "
+                             "finished = ? WHERE id = ?",
+                             (error, time.time(), job_id))
+
+    def requeue(self, workers=None, max_attempts=MAX_ATTEMPTS):
+        """Queue again jobs running on ``workers``, or on dead processes.
+
+        A job already claimed ``max_attempts`` times is marked failed, so
+        an input that kills its worker is not retried forever. Returns the
+        ids queued again.
+        """
+        with self._connect() as conn:
+            running = conn.execute(
+                "SELECT id, worker, worker_start, attempts FROM job "
+                "WHERE status = 'running'").fetchall()
+            stale = [(job_id, attempts)
+                     for job_id, pid, started, attempts in running
+                     if (pid in workers if workers is not None
+                         else not _alive(pid, started))]
+            requeued = [job_id for job_id, attempts in stale
+                        if attempts < max_attempts]
+            failed = [job_id for job_id, attempts in stale
+                      if attempts >= max_attempts]
+            conn.executemany("UPDATE job SET status = 'queued', progress = 0, "
+                             "worker = NULL, worker_start = NULL, "
+                             "started = NULL WHERE id = ?",
+                             [(job_id,) for job_id in requeued])
+            conn.executemany("UPDATE job SET status = 'failed', error = ?, "
+                             "finished = ? WHERE id = ?",
+                             [('worker died on each of {} attempts'.format(
+                                 max_attempts), time.time(), job_id)
+                              for job_id in failed])
+        for job_id in failed:
+            logger.warning('job %s failed after %d attempts', job_id,
+                           max_attempts)
+        return requeued
+
+
+def _process_start(pid):
+    """Start time of ``pid`` in clock ticks since boot, or None."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+    except OSError:  # no such process, or no /proc on this platform
+        return None
+    # Fields after the command name, which may itself hold spaces
+    return int(stat.rsplit(')', 1)[1].split()[19])
+
+
+def _alive(pid, started=None):
+    """Whether ``pid`` still runs and, if known, started at ``started``.
+
+    A recycled pid belongs to a process with another start time.
+    """
+    try:
+        os.kill(pid, 0)
+    except (OSError, TypeError):
+        return False
+    return started is None or _process_start(pid) == started
+
+
+def _write_csv(path, header, rows):
+    tmp = Path(str(path) + '.tmp')
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(tmp, path)
+
+
+def run_forecast(params, output, progress):
+    """Forecast rows for each requested region, one CSV for all of them."""
+    months, regions = params['months'], params['regions']
+    levels = params.get('levels', LEVELS)
+    dates = forecast_dates(months)
+    rows = []
+    for done, region in enumerate(regions):
+        subdivision, model_path = REGIONS[region]
+        forecast = load_forecast(model_path, MAX_JOB_HORIZON, levels,
+                                 forecast_dir=JOB_FORECAST_DIR)
+        for i, date in enumerate(dates):
+            row = [region, subdivision, date, round(forecast['mean'][i], 2)]
+            for level in levels:
+                lower, upper = forecast['intervals'][str(level)][i]
+                row += [round(max(lower, 0.0), 2), round(upper, 2)]
+            rows.append(row)
+        progress((done + 1) / len(regions))
+    header = ['region', 'subdivision', 'date', 'rainfall']
+    for level in levels:
+        header += ['lower_{}'.format(level), 'upper_{}'.format(level)]
+    _write_csv(output, header, rows)
+
+
+def run_crop(params, output, progress):
+    """Predict a crop for every row of the uploaded CSV."""
+    model = load_compiled()
+    # A first streaming pass only counts rows, for progress
+    with open(params['input'], newline='') as f:
+        total = max(sum(1 for _ in csv.reader(f)) - 1, 1)
+    with open(params['input'], newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        columns = [header.index(name) for name in CROP_COLUMNS]
+        _write_csv(output, header + ['crop'],
+                   _crop_rows(model, reader, columns, total, progress))
+
+
+def _crop_rows(model, reader, columns, total, progress):
+    """Rows with their predicted crop, read and scored a chunk at a time."""
+    done = 0
+    while True:
+        chunk = list(itertools.islice(reader, CROP_CHUNK_ROWS))
+        if not chunk:
+            return
+        X = np.array([[row[i] for i in columns] for row in chunk],
+                     dtype=np.float64)
+        for row, label in zip(chunk, model.predict_labels(X).tolist()):
+            yield row + [label]
+        done += len(chunk)
+        progress(done / total)
+
+
+HANDLERS = {'forecast': run_forecast, 'crop': run_crop}
+
+
+def warm_worker(kinds=KINDS):
+    """Load everything jobs of ``kinds`` use once per worker process."""
+    if 'crop' in kinds:
+        load_compiled()
+    if 'forecast' in kinds:
+        for subdivision, model_path in REGIONS.values():
+            if os.path.exists(model_path):
+                load_forecast(model_path, MAX_JOB_HORIZON,
+                              forecast_dir=JOB_FORECAST_DIR)
+
+
+def run_worker(db, results_dir, kinds=KINDS, poll=POLL_SECONDS):
+    """Claim and run jobs until the process is terminated."""
+    queue = JobQueue(db)
+    warm_worker(kinds)
+    pid = os.getpid()
+    while True:
+        job = queue.claim(pid, kinds)
+        if job is None:
+            time.sleep(poll)
+            continue
+        output = Path(results_dir) / '{}.csv'.format(job['id'])
+        output.parent.mkdir(parents=True, exist_ok=True)
+        started = time.perf_counter()
+        try:
+            HANDLERS[job['kind']](
+                job['params'], output,
+                lambda fraction: queue.progress(job['id'], fraction))
+        except Exception as e:
+            logger.exception('job %s (%s) failed', job['id'], job['kind'])
+            queue.finish(job['id'], error='{}: {}'.format(type(e).__name__, e))
+            continue
+        queue.finish(job['id'], result=str(output))
+        logger.info('job %s (%s) done in %.1f s', job['id'], job['kind'],
+                    time.perf_counter() - started)
+
+
+def _validate_forecast(data):
+    try:
+        months = int(data.get('months', 12))
+    except (TypeError, ValueError):
+        abort(400, 'months must be a number')
+    if not 1 <= months <= MAX_JOB_HORIZON:
+        abort(400, f'months must be between 1 and {MAX_JOB_HORIZON}')
+    available = [region for region, (_, path) in REGIONS.items()
+                 if os.path.exists(path)]
+    if not available:
+        abort(503, 'no forecast models available')
+    regions = data.get('regions') or available
+    if isinstance(regions, str):
+        regions = regions.split(',')
+    if not regions or any(region not in REGIONS for region in regions):
+        abort(400, f'regions must be some of {", ".join(REGIONS)}')
+    # Refused here rather than failing in a worker later
+    missing = [region for region in regions if region not in available]
+    if missing:
+        abort(400, f'no forecast model for {", ".join(missing)}; '
+                   f'available: {", ".join(available)}')
+    return {'months': months, 'regions': list(regions),
+            'levels': list(current_app.config['FORECAST_LEVELS'])}
+
+
+def _save_crop_upload(job_id):
+    upload = request.files.get('file')
+    if upload is None:
+        abort(400, 'expected a CSV file upload named file')
+    path = (Path(current_app.config['JOB_RESULTS_DIR'])
+            / '{}.input.csv'.format(job_id))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    upload.save(path)
+    with open(path, newline='') as f:
+        header = next(csv.reader(f), [])
+    missing = [name for name in CROP_COLUMNS if name not in header]
+    if missing:
+        path.unlink()
+        abort(400, f'missing columns: {", ".join(missing)}')
+    return {'input': str(path)}
+
+
+def job_status(job):
+    status = {name: job[name]
+              for name in ('id', 'kind', 'status', 'progress', 'error')}
+    if job['status'] == 'done':
+        status['result_url'] = url_for('jobs.job_result', job_id=job['id'])
+    return status
+
+
+@bp.route('/api/jobs', methods=['POST'])
+@limiter.limit('5 per minute')
+def submit_job():
+    data = request.get_json(silent=True) or request.form
+    kind = data.get('kind')
+    kinds = current_app.config['JOB_KINDS']
+    if kind not in kinds:
+        # Only the kinds of the blueprints this node serves
+        abort(400, f'kind must be one of {", ".join(kinds)}')
+    queue = current_app.extensions['jobs']
+    job_id = uuid.uuid4().hex
+    if kind == 'forecast':
+        params = _validate_forecast(data)
+    else:
+        params = _save_crop_upload(job_id)
+    queue.submit(kind, params, job_id)
+    response = jsonify(job_status(queue.get(job_id)))
+    response.status_code = 202
+    response.headers['Location'] = url_for('jobs.job_api', job_id=job_id)
+    return response
+
+
+@bp.route('/api/jobs/<job_id>')
+# Polled until the job is done, so allowed far more often than submits
+@limiter.limit(POLL_LIMIT)
+def job_api(job_id):
+    job = current_app.extensions['jobs'].get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job_status(job))
+
+
+@bp.route('/api/jobs/<job_id>/result')
+def job_result(job_id):
+    job = current_app.extensions['jobs'].get(job_id)
+    if job is None:
+        abort(404)
+    if job['status'] != 'done':
+        abort(409, f'job is {job["status"]}')
+    return send_file(os.path.abspath(job['result']), mimetype='text/csv',
+                     as_attachment=True,
+                     download_name='{}-{}.csv'.format(job['kind'], job_id))
+
+
+@click.command()
+@click.option('--workers', '-w', default=2, show_default=True)
+@click.option('--db', default=JOBS_DB, show_default=True)
+@click.option('--output', default=RESULTS_DIR, show_default=True)
+@click.option('--kind', '-k', 'kinds', multiple=True,
+              type=click.Choice(KINDS), default=KINDS,
+              show_default=True, help='Job kinds these workers run.')
+def main(workers, db, output, kinds):
+    """ Runs a pool of job worker processes, replacing any that die.
+    """
+    queue = JobQueue(db)
+    requeued = queue.requeue()
+    if requeued:
+        logger.info('requeued %d interrupted jobs', len(requeued))
+
+    def start():
+        process = multiprocessing.Process(target=run_worker,
+                                          args=(db, output, kinds),
+                                          daemon=True)
+        process.start()
+        return process
+
+    pool = [start() for _ in range(workers)]
+    logger.info('%d workers for %s on %s, results in %s', workers,
+                ', '.join(kinds), db, output)
+    try:
+        while True:
+            time.sleep(1)
+            for i, process in enumerate(pool):
+                if not process.is_alive():
+                    requeued = queue.requeue([process.pid])
+                    logger.warning(
+                        'worker %d exited with %s, requeued %d jobs',
+                        process.pid, process.exitcode, len(requeued))
+                    pool[i] = start()
+    except KeyboardInterrupt:
+        for process in pool:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
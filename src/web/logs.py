@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Structured logging that never blocks a request.
+
+``install`` puts one ``QueueHandler`` on the root logger. A request
+thread only formats the message and does a ``put_nowait`` into a bounded
+queue. A listener thread turns each record into one JSON line on stderr:
+time, level, logger, message, pid, thread, any ``extra=`` fields and the
+traceback. When the queue is full the record is dropped and counted per
+level. ``stats()`` (served at ``/api/audit/stats``) reports the drops.
+
+The listener is started on first use in each process, because a thread
+started in a preloading parent does not survive the fork into a worker.
+At exit it drains what is queued.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+
+QUEUE_SIZE = 10000
+# Attributes every LogRecord has; anything else came in through ``extra=``
+RECORD_ATTRS = (set(vars(logging.LogRecord('', 0, '', 0, '', (), None)))
+                | {'message', 'asctime', 'taskName'})
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        entry.update((key, value) for key, value in vars(record).items()
+                     if key not in RECORD_ATTRS)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # The stock one uses put_nowait, which fails on a full queue
+        self.queue.put(self._sentinel, timeout=5)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hands records to a listener thread through a bounded queue."""
+
+    def __init__(self, handlers, queue_size=QUEUE_SIZE):
+        super().__init__(None)
+        self.targets = handlers
+        self.queue_size = queue_size
+        self.counters = {'queued': 0, 'dropped': {}}
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self.queue = queue.Queue(self.queue_size)
+                self._listener = _Listener(
+                    self.queue, *self.targets, respect_handler_level=True)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record):
+        # The message is merged here, while its arguments are still as
+        # logged; the traceback is formatted on the listener thread
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+    def enqueue(self, record):
+        self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped = self.counters['dropped']
+            dropped[record.levelname] = dropped.get(record.levelname, 0) + 1
+            return
+        self.counters['queued'] += 1
+
+    def stop(self):
+        """Drain the queue and stop this process's listener."""
+        if self._pid != os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                try:
+                    self._listener.stop()
+                except queue.Full:
+                    return
+                self._pid = None
+
+    def stats(self):
+        pending = self.queue.qsize() if self._pid == os.getpid() else 0
+        return {'queued': self.counters['queued'],
+                'dropped': dict(self.counters['dropped']),
+                'pending': pending, 'queue_size': self.queue_size}
+
+
+def install(level=logging.INFO, queue_size=QUEUE_SIZE, stream=None):
+    """Route the root logger through a ``QueueHandler``; returns it."""
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if isinstance(handler, QueueHandler):
+            return handler
+    target = logging.StreamHandler(stream or sys.stderr)
+    target.setFormatter(JsonFormatter())
+    handler = QueueHandler([target], queue_size)
+    # Plain handlers from basicConfig would log everything a second time
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
+
+
+def stats():
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler):
+            return handler.stats()
+    return None
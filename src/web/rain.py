@@ -0,0 +1,405 @@
+"""Rainfall prediction pages and APIs."""
+import json
+import mimetypes
+import os
+import time
+from functools import lru_cache
+
+import numpy as np
+from flask import (Blueprint, abort, current_app, jsonify, redirect,
+                   render_template, request, send_from_directory, session,
+                   stream_template, url_for)
+from werkzeug.utils import safe_join
+
+from src.features.build_features import MONTHS
+from src.features.climatology import ALL, PERIODS
+from src.features.spatial import InverseDistance
+from src.models.forecast_store import (MAX_HORIZON, forecast_rows,
+                                       is_loaded, load_forecast)
+from src.models.registry import REGIONS, SUBDIVISION_REGIONS
+from src.web.resources import (audit, climatology, forecast_dates,
+                               forecast_subdivisions, forecast_tables,
+                               history, http_cache, limiter, predictions,
+                               shadow, subdivision_index, warm_forecasts)
+from src.web.templating import render_fragment
+
+bp = Blueprint('rain', __name__)
+# Each interpolator holds a cache of weight matrices, so only the most
+# recently used (k, power) pairs are kept
+INTERPOLATORS = 8
+MAX_K = 10
+# Longer than MAX_HORIZON is forecast on demand and stored from then on
+MAX_MONTHS = 1200
+
+# Endpoints reachable without logging in
+PUBLIC = ['login_rain', 'register_rain', 'ground0']
+# Background job kinds a node serving this blueprint accepts
+JOB_KINDS = ['forecast']
+
+
+def warm_up(app):
+    for load in (subdivision_index, climatology, history,
+                 forecast_subdivisions):
+        load()
+    warm_forecasts(app.config['FORECAST_LEVELS'])
+
+
+def probe(app):
+    # A synthetic year of forecast rows from every region model on disk
+    levels = app.config['FORECAST_LEVELS']
+    for subdivision in forecast_subdivisions():
+        model_path = REGIONS[SUBDIVISION_REGIONS[subdivision]][1]
+        forecast = load_forecast(model_path, levels=levels)
+        forecast_rows(forecast, forecast_dates(12), levels)
+
+
+@bp.route('/register_rain', methods=['GET', 'POST'])
+@limiter.limit('10 per minute')
+def register_rain():
+    if request.method == 'POST':
+        email = request.form['email']
+        password = request.form['password']
+        users = current_app.extensions['users']
+
+        if users.exists(email) or not users.add(email, password):
+            return render_template('register.html', register_type='rain',
+                                   error='Email already registered')
+        return redirect(url_for('rain.login_rain'))
+    return render_template('register.html', register_type='rain')
+
+
+@bp.route('/login_rain', methods=['GET', 'POST'])
+@limiter.limit('10 per minute')
+def login_rain():
+    if request.method == 'POST':
+        email = request.form['email']
+        password = request.form['password']
+        if current_app.extensions['users'].check(email, password):
+            session['email'] = email
+            return redirect('/home')
+        return render_template(
+            'login.html', login_type='rain',
+            error='Invalid User .If this is your first time here please '
+                  'register first.')
+    return render_template('login.html', login_type='rain')
+
+
+@bp.route('/logout_rain')
+def logout_rain():
+    session.pop('email', None)
+    return redirect(url_for('rain.login_rain'))
+
+
+def region_forecast(region, num_periods):
+    if not 1 <= num_periods <= MAX_MONTHS:
+        abort(400, f'months must be between 1 and {MAX_MONTHS}')
+    subdivision, model_path = REGIONS[region]
+    levels = current_app.config['FORECAST_LEVELS']
+    horizon = max(num_periods, MAX_HORIZON)
+
+    def compute():
+        forecast = load_forecast(model_path, horizon, levels)
+        return forecast, forecast_rows(forecast, forecast_dates(num_periods),
+                                       levels)
+
+    # The model file's stamp stands in for its version, as in load_forecast
+    stat = os.stat(model_path)
+    version = (model_path, stat.st_mtime_ns, stat.st_size)
+    key = version + (request.endpoint, num_periods, tuple(levels),
+                     forecast_dates(1)[0])
+    # Only building the forecast is worth making other workers wait for
+    lock_key = None if is_loaded(model_path, horizon, levels) else version
+    return predictions.do(key, compute, lock_key)
+
+
+def region_prediction(region):
+    num_periods = int(request.form['months'])
+    started = time.perf_counter()
+    forecast, prediction_results = region_forecast(region, num_periods)
+    elapsed = (time.perf_counter() - started) * 1000
+    mean = forecast['mean'][:num_periods]
+    shadow.submit(region, num_periods, mean, forecast['version'], elapsed)
+    audit.record(request.endpoint, {'months': num_periods}, mean,
+                 forecast['version'], elapsed)
+    levels = current_app.config['FORECAST_LEVELS']
+    # The table depends on nothing else, so a rendered one is reused as is
+    key = (forecast['version'], num_periods, tuple(levels),
+           prediction_results[0]['Date'])
+    table = render_fragment(current_app.jinja_env, forecast_tables, key,
+                            'partials/forecast_table.html',
+                            prediction_results=prediction_results,
+                            levels=levels)
+    if num_periods >= current_app.config['STREAM_TABLE_ROWS']:
+        return stream_template('result.html', forecast_table=table)
+    return render_template('result.html', forecast_table=table)
+
+
+def forecast_key(region):
+    # A forecast response changes only with the model, the levels and the
+    # year
+    if region not in REGIONS or not os.path.exists(REGIONS[region][1]):
+        return None
+    levels = current_app.config['FORECAST_LEVELS']
+    forecast = load_forecast(REGIONS[region][1], levels=levels)
+    return forecast['version'], tuple(levels), forecast_dates(1)[0]
+
+
+@bp.route('/api/forecast/<region>')
+@http_cache.cached(forecast_key, max_age=3600)
+def forecast_api(region):
+    if region not in REGIONS:
+        abort(404)
+    num_periods = request.args.get('months', 12, type=int)
+    started = time.perf_counter()
+    forecast, prediction_results = region_forecast(region, num_periods)
+    elapsed = (time.perf_counter() - started) * 1000
+    mean = forecast['mean'][:num_periods]
+    shadow.submit(region, num_periods, mean, forecast['version'], elapsed)
+    audit.record(request.endpoint, {'region': region, 'months': num_periods},
+                 mean, forecast['version'], elapsed)
+    return jsonify(region=region, subdivision=REGIONS[region][0],
+                   model_version=forecast['version'],
+                   levels=list(current_app.config['FORECAST_LEVELS']),
+                   forecast=prediction_results)
+
+
+def subdivision_forecast(subdivision, num_periods):
+    region = SUBDIVISION_REGIONS.get(subdivision)
+    if region is None or not os.path.exists(REGIONS[region][1]):
+        return None
+    forecast, prediction_results = region_forecast(region, num_periods)
+    return {'region': region, 'model_version': forecast['version'],
+            'forecast': prediction_results}
+
+
+def request_points():
+    # One point as ?lat=&lon=, or many as a JSON body
+    # {"points": [[lat, lon], ...]}
+    try:
+        if request.method == 'POST':
+            points = np.asarray(request.get_json()['points'], dtype=float)
+        else:
+            points = np.array([[float(request.args['lat']),
+                                float(request.args['lon'])]])
+    except (KeyError, TypeError, ValueError):
+        abort(400, 'expected lat/lon or a list of [lat, lon] points')
+    if (points.ndim != 2 or points.shape[1] != 2
+            or not np.isfinite(points).all()):
+        abort(400, 'expected a list of [lat, lon] points')
+    return points
+
+
+@bp.route('/api/locate', methods=['GET', 'POST'])
+def locate_api():
+    num_periods = request.args.get('months', 12, type=int)
+    points = request_points()
+    index, distance = subdivision_index().locate(points[:, 0], points[:, 1])
+    names = subdivision_index().names[index].tolist()
+    forecasts = {name: subdivision_forecast(name, num_periods)
+                 for name in set(names)}
+    locations = [{'lat': lat, 'lon': lon, 'subdivision': name,
+                  'distance_km': round(km, 1)}
+                 for (lat, lon), name, km in zip(points.tolist(), names,
+                                                 distance.tolist())]
+    return jsonify(locations=locations, forecasts=forecasts)
+
+
+@lru_cache(maxsize=INTERPOLATORS)
+def interpolator(k, power):
+    sources = subdivision_index().subset(forecast_subdivisions())
+    return InverseDistance(sources, k, power)
+
+
+@bp.route('/api/interpolate', methods=['GET', 'POST'])
+def interpolate_api():
+    num_periods = request.args.get('months', 12, type=int)
+    k = request.args.get('k', 3, type=int)
+    power = request.args.get('power', 2.0, type=float)
+    if not forecast_subdivisions():
+        abort(503, 'no forecast models available')
+    if not 1 <= k <= MAX_K or not 0 < power <= 10:
+        abort(400, f'k must be in 1..{MAX_K} and power in (0, 10]')
+    points = request_points()
+    # More neighbours than sources is the same interpolator
+    k = min(k, len(forecast_subdivisions()))
+    forecasts = np.array([
+        region_forecast(SUBDIVISION_REGIONS[name],
+                        num_periods)[0]['mean'][:num_periods]
+        for name in forecast_subdivisions()])
+    rainfall = interpolator(k, power).interpolate(points[:, 0], points[:, 1],
+                                                  forecasts)
+    return jsonify(dates=forecast_dates(num_periods),
+                   sources=forecast_subdivisions(), points=points.tolist(),
+                   rainfall=np.round(rainfall, 2).tolist())
+
+
+@bp.route('/api/climatology/<subdivision>')
+@http_cache.cached(lambda subdivision: climatology().source, max_age=3600)
+def climatology_api(subdivision):
+    period = request.args.get('period', 'ANNUAL')
+    bucket = request.args.get('bucket', ALL)
+    if (subdivision not in climatology().subdivisions
+            or period not in PERIODS
+            or bucket not in climatology().buckets):
+        abort(404)
+    return jsonify(subdivision=subdivision, period=period, bucket=bucket,
+                   stats=climatology().lookup(subdivision, period, bucket))
+
+
+def history_slices():
+    # Either one subdivision (all months) or one month (all subdivisions)
+    subdivision = request.args.get('subdivision')
+    month = request.args.get('month', '').upper() or None
+    start = request.args.get('start', type=int)
+    end = request.args.get('end', type=int)
+    if subdivision is not None:
+        if (subdivision not in history().subdivisions
+                or (month and month not in MONTHS)):
+            abort(404)
+        years, values = history().series(subdivision, start, end)
+        if month:
+            return [month], [(subdivision, years,
+                              values[:, MONTHS.index(month)])]
+        return MONTHS, [(subdivision, years, values)]
+    if month not in MONTHS:
+        abort(400, 'expected a subdivision or a month')
+    selected = history().month(month, start, end,
+                               last=request.args.get('last', type=int))
+    return [month], [(name, years, values)
+                     for name, (years, values) in selected.items()]
+
+
+def arrow_response(columns, slices):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        abort(406, 'Arrow output needs pyarrow installed')
+    names = [name for name, years, _ in slices for _ in range(len(years))]
+    years = np.concatenate([years for _, years, _ in slices])
+    values = np.concatenate([values.reshape(len(values), -1)
+                             for _, _, values in slices])
+    table = pa.table({
+        'subdivision': pa.array(names).dictionary_encode(), 'year': years,
+        **{column: values[:, i] for i, column in enumerate(columns)}})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return current_app.response_class(
+        sink.getvalue().to_pybytes(),
+        mimetype='application/vnd.apache.arrow.stream')
+
+
+@bp.route('/api/history')
+@http_cache.cached()
+def history_api():
+    columns, slices = history_slices()
+    if request.args.get('format') == 'arrow':
+        return arrow_response(columns, slices)
+    # Stored as float32; rounded as in Climatology.lookup to drop its noise
+    return jsonify(columns=columns, series=[
+        {'subdivision': name, 'years': years.tolist(),
+         'values': np.round(values.astype(np.float64), 2).tolist()}
+        for name, years, values in slices])
+
+
+@bp.route('/api/history/stats')
+def history_stats_api():
+    memory = history().memory_usage()
+    return jsonify(rows=len(history().years),
+                   subdivisions=len(history().subdivisions),
+                   memory_bytes=memory, total_bytes=sum(memory.values()))
+
+
+@bp.route('/figures/<path:filename>')
+def figure(filename):
+    # Drawn by `python -m src.visualization.visualize`; HTML and plotly.js
+    # come precompressed
+    directory = current_app.config['FIGURES_DIR']
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        path = safe_join(directory, filename + suffix)
+        if (encoding in request.accept_encodings and path
+                and os.path.exists(path)):
+            response = send_from_directory(
+                directory, filename + suffix, max_age=3600,
+                mimetype=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, max_age=3600)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@bp.route('/api/figures')
+def figures_api():
+    path = os.path.join(current_app.config['FIGURES_DIR'], 'manifest.json')
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        abort(503, 'no figures drawn yet')
+    return jsonify({
+        key: {'subdivision': entry['subdivision'],
+              'figures': {figure: url_for('rain.figure', filename=filename)
+                          for figure, filename in entry['files'].items()}}
+        for key, entry in manifest['subdivisions'].items()})
+
+
+@bp.route('/rain_home')
+@http_cache.cached(public=True)
+def ground0():
+    return render_template('ground0.html')
+
+
+@bp.route('/home')
+@http_cache.cached()
+def home():
+    return render_template('home.html')
+
+
+@bp.route('/konkan')
+@http_cache.cached()
+def konkan():
+    return render_template('konkan.html')
+
+
+@bp.route('/konkan_prediction', methods=['POST'])
+@limiter.limit('5 per minute')
+def konkan_prediction():
+    return region_prediction('konkan')
+
+
+@bp.route('/vidarbha')
+@http_cache.cached()
+def vidarbha():
+    return render_template('vidarbha.html')
+
+
+@bp.route('/vidarbha_prediction', methods=['POST'])
+@limiter.limit('5 per minute')
+def vidarbha_prediction():
+    return region_prediction('vidarbha')
+
+
+@bp.route('/marathwada')
+@http_cache.cached()
+def marathwada():
+    return render_template('marathwada.html')
+
+
+@bp.route('/marathwada_prediction', methods=['POST'])
+@limiter.limit('5 per minute')
+def marathwada_prediction():
+    return region_prediction('marathwada')
+
+
+@bp.route('/madhya_maharashtra')
+@http_cache.cached()
+def madhya_maharashtra():
+    return render_template('madhya_maharashtra.html')
+
+
+@bp.route('/madhya_maharashtra_prediction', methods=['POST'])
+@limiter.limit('5 per minute')
+def madhya_maharashtra_prediction():
+    return region_prediction('madhya_maharashtra')
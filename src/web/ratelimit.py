@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Rate limits shared by every worker, kept in SQLite.
+
+Flask-Limiter's default memory storage counts per process, so with N
+workers a "5 per minute" limit lets 5 * N requests through.
+``TokenBucketStorage`` is a ``limits`` storage backed by one SQLite file
+in WAL mode. Every worker on the host sees the same state, and each update
+runs in its own ``BEGIN IMMEDIATE`` transaction.
+
+Under the ``moving-window`` strategy the storage implements each limit as
+a token bucket. "N per T" holds N tokens and refills N every T, so bursts
+up to N are allowed but the sustained rate is N per T. A bucket that
+has refilled completely is the same as no bucket at all. Such rows are
+deleted in one batch every ``purge_interval`` seconds, not on each
+request. Fixed-window counters are supported as well, with the same
+batched expiry.
+
+Register the storage by importing this module, then configure
+``RATELIMIT_STORAGE_URI = 'sqlite:///<path>'`` and
+``RATELIMIT_STRATEGY = 'moving-window'``.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from limits.storage import MovingWindowSupport, Storage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bucket (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS bucket_expires ON bucket (expires);
+CREATE TABLE IF NOT EXISTS counter (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS counter_expires ON counter (expires);
+"""
+PURGE_INTERVAL = 60
+
+
+def storage_path(uri):
+    """``sqlite:///relative.db`` or ``sqlite:////absolute.db`` -> path."""
+    path = uri.split('://', 1)[1]
+    return path[1:] if path.startswith('/') else path
+
+
+class TokenBucketStorage(Storage, MovingWindowSupport):
+    """Token buckets and fixed-window counters in a shared SQLite file."""
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri=None, wrap_exceptions=False,
+                 purge_interval=PURGE_INTERVAL, **options):
+        self.path = storage_path(uri)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.purge_interval = float(purge_interval)
+        self._local = threading.local()
+        self._next_purge = 0.0
+        self._connection().executescript(SCHEMA)
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self):
+        # One connection per thread, reopened in forked workers
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _transaction(self, update):
+        """Run ``update(conn, now)`` atomically across processes."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = update(conn, now)
+            if now >= self._next_purge:
+                conn.execute('DELETE FROM bucket WHERE expires <= ?', (now,))
+                conn.execute('DELETE FROM counter WHERE expires <= ?', (now,))
+                self._next_purge = now + self.purge_interval
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return result
+
+    @staticmethod
+    def _tokens(conn, key, limit, rate, now):
+        row = conn.execute('SELECT tokens, updated FROM bucket WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            return float(limit)
+        return min(float(limit), row[0] + (now - row[1]) * rate)
+
+    # Token buckets, through the moving-window interface
+
+    def acquire_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        rate = limit / expiry
+
+        def take(conn, now):
+            tokens = self._tokens(conn, key, limit, rate, now)
+            if tokens < amount:
+                return False
+            tokens -= amount
+            conn.execute('INSERT OR REPLACE INTO bucket VALUES (?, ?, ?, ?)',
+                         (key, tokens, now, now + (limit - tokens) / rate))
+            return True
+
+        return self._transaction(take)
+
+    def get_moving_window(self, key, limit, expiry):
+        """(time the bucket was last full, whole tokens in use)."""
+        rate = limit / expiry
+        now = time.time()
+        tokens = self._tokens(self._connection(), key, limit, rate, now)
+        full_at = now + (limit - tokens) / rate
+        return full_at - expiry, limit - math.floor(tokens)
+
+    # Fixed-window counters
+
+    def incr(self, key, expiry, amount=1):
+        def add(conn, now):
+            row = conn.execute('SELECT value, expires FROM counter '
+                               'WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] <= now:
+                row = (0, now + expiry)
+            value = row[0] + amount
+            conn.execute('INSERT OR REPLACE INTO counter VALUES (?, ?, ?)',
+                         (key, value, row[1]))
+            return value
+
+        return self._transaction(add)
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM counter WHERE key = ? AND expires > ?',
+            (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        row = self._connection().execute(
+            'SELECT expires FROM counter WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self):
+        try:
+            self._connection().execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def reset(self):
+        def delete(conn, now):
+            return (conn.execute('DELETE FROM bucket').rowcount
+                    + conn.execute('DELETE FROM counter').rowcount)
+
+        return self._transaction(delete)
+
+    def clear(self, key):
+        def delete(conn, now):
+            conn.execute('DELETE FROM bucket WHERE key = ?', (key,))
+            conn.execute('DELETE FROM counter WHERE key = ?', (key,))
+
+        self._transaction(delete)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""State shared by the blueprints, each piece built on first use.
+
+Nothing here loads data at import time, so a profile that never touches
+the history store or the subdivision index never pays for them.
+"""
+import os
+from datetime import datetime
+
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+
+from src.data.history import open_store
+from src.features.climatology import load_or_build
+from src.features.spatial import SubdivisionIndex
+from src.models.forecast_store import load_forecast
+from src.models.registry import RAINFALL_DATA, REGIONS
+from src.web.audit import AuditLog
+from src.web.coalesce import SingleFlight
+from src.web.conditional import HttpCache
+# Imported to register the sqlite:// storage scheme with flask_limiter
+from src.web.ratelimit import TokenBucketStorage  # noqa: F401
+from src.web.shadow import ShadowEvaluator
+from src.web.startup import Lazy
+from src.web.templating import FragmentCache
+
+http_cache = HttpCache()
+forecast_tables = FragmentCache()
+# Identical concurrent forecast computations run once; forecast builds
+# also run once across workers when SINGLE_FLIGHT_DIR names a directory
+# for the lock files
+predictions = SingleFlight(os.environ.get('SINGLE_FLIGHT_DIR'))
+# Served predictions, written behind the response to AUDIT_DB
+audit = AuditLog()
+# Candidate models from SHADOW_MODELS, see create_app
+shadow = ShadowEvaluator()
+# Storage and strategy come from the app config, see create_app. No
+# default limits: only logins, registrations and prediction POSTs carry
+# their own, so pages, figures and read APIs are never throttled.
+limiter = Limiter(get_remote_address)
+
+# Optional GeoJSON with subdivision polygons; centroids are used otherwise
+subdivision_index = Lazy(lambda: SubdivisionIndex.from_csv(
+    RAINFALL_DATA, os.environ.get('SUBDIVISION_BOUNDARIES')))
+climatology = Lazy(lambda: load_or_build(RAINFALL_DATA))
+history = Lazy(lambda: open_store(RAINFALL_DATA))
+# Subdivisions whose region has a forecast model on disk
+forecast_subdivisions = Lazy(lambda: sorted(
+    subdivision for subdivision, path in REGIONS.values()
+    if os.path.exists(path)))
+
+
+def forecast_dates(num_periods):
+    # Forecasts start in January of next year
+    year = datetime.now().year + 1
+    return [datetime(year + i // 12, i % 12 + 1, 1).strftime('%B %Y')
+            for i in range(num_periods)]
+
+
+def warm_forecasts(levels):
+    for subdivision, path in REGIONS.values():
+        if os.path.exists(path):
+            load_forecast(path, levels=levels)
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""Shadow evaluation of candidate models on mirrored live inputs.
+
+A retrained ``XB.pbz2`` or region ``modelN.pbz2`` is placed anywhere and
+named in ``SHADOW_MODELS`` (``crop=<path>,konkan=<path>``). Each live
+prediction served for that model then queues a copy of its inputs,
+primary output and primary latency. ``put_nowait`` is the only shadow
+work on the response path; when the queue is full the copy is dropped
+and counted.
+
+A daemon thread per process runs the candidate on the same inputs. It
+records the candidate's latency and its divergence from the primary in
+a SQLite metrics store (``instance/shadow.db``), written in batches:
+
+* crop: divergence is 1 when the candidate picks a different crop.
+* forecast: divergence is the mean absolute difference of the monthly
+  means relative to the primary's. Outputs agree within
+  ``FORECAST_TOLERANCE``.
+
+``python -m src.web.shadow`` and ``/api/shadow/report`` compare p50/p99
+latency and agreement per candidate version before promotion. Candidate
+forecasts and compiled forests are cached under ``models/cache/shadow``
+so they never replace the primary's, in a directory per kind so two
+candidates with the same file name never replace each other's either.
+
+Forecasts are mirrored from both the region result pages and
+``/api/forecast/<region>``, except API requests answered with 304.
+"""
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+import click
+import numpy as np
+
+from src.models.forecast_store import (MAX_HORIZON, forecast_rows,
+                                       load_forecast)
+from src.models.tree_compiler import load_compiled
+
+SHADOW_DB = 'instance/shadow.db'
+CANDIDATE_DIR = 'models/cache/shadow'
+FORECAST_TOLERANCE = 0.05
+QUEUE_SIZE = 1000
+BATCH_SIZE = 100
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shadow (
+    created REAL NOT NULL,
+    kind TEXT NOT NULL,
+    primary_version TEXT NOT NULL,
+    candidate_version TEXT NOT NULL,
+    primary_ms REAL NOT NULL,
+    candidate_ms REAL NOT NULL,
+    divergence REAL NOT NULL,
+    agree INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS shadow_kind ON shadow (kind, candidate_version);
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def parse_candidates(spec):
+    """``crop=a.pbz2,konkan=b.pbz2`` -> ``{'crop': 'a.pbz2', ...}``."""
+    candidates = {}
+    parts = (part.strip() for part in (spec or '').split(','))
+    for item in filter(None, parts):
+        kind, _, path = item.partition('=')
+        if not path:
+            raise ValueError('expected kind=path, got {!r}'.format(item))
+        candidates[kind.strip()] = path.strip()
+    return candidates
+
+
+def _percentile(values, q):
+    return round(float(np.percentile(values, q)), 3)
+
+
+class MetricsStore:
+    """Shadow comparisons in SQLite."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=10,
+                                       isolation_level=None))
+
+    def add(self, rows):
+        with self._connect() as conn:
+            conn.execute('BEGIN')
+            conn.executemany('INSERT INTO shadow VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.execute('COMMIT')
+
+    def report(self, since=0.0):
+        """Latency percentiles and agreement per kind and model pair."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT kind, primary_version, candidate_version, primary_ms, '
+                'candidate_ms, divergence, agree FROM shadow '
+                'WHERE created >= ? '
+                'ORDER BY kind, primary_version, candidate_version',
+                (since,)).fetchall()
+        groups = {}
+        for kind, primary, candidate, *values in rows:
+            groups.setdefault((kind, primary, candidate), []).append(values)
+        report = []
+        for (kind, primary, candidate), values in groups.items():
+            primary_ms, candidate_ms, divergence, agree = np.array(values).T
+            report.append({
+                'kind': kind, 'primary_version': primary,
+                'candidate_version': candidate, 'samples': len(values),
+                'agreement': round(float(agree.mean()), 4),
+                'mean_divergence': round(float(divergence.mean()), 4),
+                'primary_p50_ms': _percentile(primary_ms, 50),
+                'primary_p99_ms': _percentile(primary_ms, 99),
+                'candidate_p50_ms': _percentile(candidate_ms, 50),
+                'candidate_p99_ms': _percentile(candidate_ms, 99),
+            })
+        return report
+
+
+class ShadowEvaluator:
+    """Mirror live predictions to candidate models, off the response path."""
+
+    def __init__(self, app=None, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.candidates = {}
+        self.store = None
+        self.levels = ()
+        self.counters = dict.fromkeys(
+            ['submitted', 'dropped', 'evaluated', 'failed'], 0)
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._warmed = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.candidates = parse_candidates(app.config.get('SHADOW_MODELS'))
+        self.store = MetricsStore(app.config.get('SHADOW_DB', SHADOW_DB))
+        self.levels = tuple(app.config['FORECAST_LEVELS'])
+        if self.candidates:
+            logger.info('shadowing %s', ', '.join(
+                '{} with {}'.format(kind, path)
+                for kind, path in self.candidates.items()))
+
+    def submit(self, kind, inputs, primary, primary_version, primary_ms):
+        """Queue a copy of one live prediction; never blocks."""
+        if kind not in self.candidates:
+            return
+        self._start()
+        try:
+            self._queue.put_nowait((time.time(), kind, inputs, primary,
+                                    primary_version, primary_ms))
+        except queue.Full:
+            self.counters['dropped'] += 1
+            return
+        self.counters['submitted'] += 1
+
+    def _start(self):
+        # Started on first use in each process, since a thread started in a
+        # preloading parent does not survive the fork into a worker
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.queue_size)
+                threading.Thread(target=self._run, name='shadow',
+                                 daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        pending = self._queue
+        while True:
+            batch = [pending.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            rows = []
+            for item in batch:
+                try:
+                    rows.append(self._evaluate(*item))
+                except Exception:
+                    self.counters['failed'] += 1
+                    logger.exception('shadow evaluation of %s failed', item[1])
+            try:
+                self.store.add(rows)
+            except sqlite3.Error:
+                self.counters['failed'] += len(rows)
+                logger.exception('could not record %d shadow results',
+                                 len(rows))
+                continue
+            self.counters['evaluated'] += len(rows)
+
+    def _predict(self, kind, inputs):
+        """(output, version) of the candidate for ``kind``."""
+        path = self.candidates[kind]
+        cache_dir = Path(CANDIDATE_DIR) / kind
+        if kind == 'crop':
+            compiled = cache_dir / (Path(path).stem + '.npz')
+            compiled.parent.mkdir(parents=True, exist_ok=True)
+            model = load_compiled(path, str(compiled))
+            return model.predict_labels([inputs])[0], model.source_version
+        # As long as the primary's, which forecasts past MAX_HORIZON on demand
+        forecast = load_forecast(path, max(inputs, MAX_HORIZON),
+                                 levels=self.levels,
+                                 forecast_dir=str(cache_dir),
+                                 slim_dir=str(cache_dir))
+        # The same work as the primary's rows; the date labels do not matter
+        forecast_rows(forecast, range(inputs), self.levels)
+        return forecast['mean'][:inputs], forecast['version']
+
+    def _evaluate(self, created, kind, inputs, primary, primary_version,
+                  primary_ms):
+        if kind not in self._warmed:
+            # Loading (or compiling) the candidate is not part of its latency
+            self._predict(kind, inputs)
+            self._warmed.add(kind)
+        started = time.perf_counter()
+        output, version = self._predict(kind, inputs)
+        candidate_ms = (time.perf_counter() - started) * 1000
+        if kind == 'crop':
+            divergence = float(output != primary)
+            agree = divergence == 0
+        else:
+            primary = np.asarray(primary, dtype=float)
+            divergence = float(np.abs(np.asarray(output) - primary).mean()
+                               / max(np.abs(primary).mean(), 1e-9))
+            agree = divergence <= FORECAST_TOLERANCE
+        return (created, kind, primary_version, version, primary_ms,
+                candidate_ms, divergence, int(agree))
+
+    def report(self, since=0.0):
+        return {'candidates': self.candidates, 'counters': self.counters,
+                'comparisons': self.store.report(since)}
+
+
+@click.command()
+@click.option('--db', default=SHADOW_DB, show_default=True)
+@click.option('--hours', default=0.0, help='Only the last N hours (0: all).')
+def main(db, hours):
+    """ Reports candidate latency and agreement against the primary models.
+    """
+    since = time.time() - hours * 3600 if hours else 0.0
+    report = MetricsStore(db).report(since)
+    if not report:
+        logger.info('no shadow results in %s', db)
+    for row in report:
+        logger.info('%-8s %s -> %s: %5d samples, agreement %6.2f%%, '
+                    'divergence %.4f, p50 %.2f -> %.2f ms, '
+                    'p99 %.2f -> %.2f ms',
+                    row['kind'], row['primary_version'],
+                    row['candidate_version'], row['samples'],
+                    row['agreement'] * 100, row['mean_divergence'],
+                    row['primary_p50_ms'], row['candidate_p50_ms'],
+                    row['primary_p99_ms'], row['candidate_p99_ms'])
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
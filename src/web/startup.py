@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""Worker start-up: lazily built state, background warm-up and a profile.
+
+Data and models the app needs are wrapped in ``Lazy`` so importing the app
+does no work. A warm-up thread builds them right after start-up. A request
+that needs one before it is ready builds it, or waits for the build already
+in progress.
+
+``python -m src.web.startup`` imports the app in a fresh interpreter,
+reports per-module import times (from ``python -X importtime``) and the
+time to the first response, and with ``--check`` fails when that time
+misses ``FIRST_RESPONSE_TARGET_MS``. With ``--profile`` it also compares
+deployment profiles (``APP_PROFILE``): time until warm-up has finished,
+peak RSS and modules loaded, each against the ``all`` profile.
+
+``Readiness`` runs a synthetic prediction per blueprint once warm-up is
+done. A worker is ready when every one of them has passed in under
+``READY_THRESHOLD_MS``; ``/readyz`` reports it to load balancers.
+"""
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import click
+
+FIRST_RESPONSE_TARGET_MS = 600
+READY_THRESHOLD_MS = 250
+PROBE = """
+import importlib, json, resource, sys, time
+started = time.perf_counter()
+app = importlib.import_module({module!r}).app
+imported = time.perf_counter()
+response = app.test_client().get({path!r})
+responded = time.perf_counter()
+if 'warm_up' in app.extensions:
+    app.extensions['warm_up'].join()
+warmed = time.perf_counter()
+print(json.dumps({{'status': response.status_code,
+                  'import_ms': (imported - started) * 1000,
+                  'first_response_ms': (responded - started) * 1000,
+                  'warm_ms': (warmed - started) * 1000,
+                  'modules': len(sys.modules),
+                  'rss_mb': resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class Lazy:
+    """A value built on first call, once, whichever thread gets there."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._built = False
+        self._value = None
+
+    def __call__(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self._value = self.factory()
+                    self._built = True
+        return self._value
+
+    @property
+    def ready(self):
+        return self._built
+
+
+class Readiness:
+    """Synthetic prediction probes that gate a worker's readiness.
+
+    Each probe is tried up to ``attempts`` times: the first call may still
+    load models or fill caches, and only a call under the threshold counts.
+    """
+
+    def __init__(self, probes, threshold_ms=READY_THRESHOLD_MS, attempts=3):
+        self.probes = probes
+        self.threshold_ms = threshold_ms
+        self.attempts = attempts
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def run(self):
+        with self._lock:
+            for name, probe in self.probes.items():
+                self.results[name] = self._check(name, probe)
+        return self.ready
+
+    def _check(self, name, probe):
+        for attempt in range(1, self.attempts + 1):
+            started = time.perf_counter()
+            try:
+                probe()
+            except Exception as e:
+                logger.exception('readiness probe %s failed', name)
+                return {'ok': False, 'attempts': attempt,
+                        'error': '{}: {}'.format(type(e).__name__, e)}
+            ms = (time.perf_counter() - started) * 1000
+            if ms <= self.threshold_ms:
+                break
+        return {'ok': ms <= self.threshold_ms, 'attempts': attempt,
+                'ms': round(ms, 1)}
+
+    @property
+    def ready(self):
+        return (len(self.results) == len(self.probes)
+                and all(result['ok'] for result in self.results.values()))
+
+    def report(self):
+        return {'ready': self.ready, 'threshold_ms': self.threshold_ms,
+                'probes': self.results}
+
+
+def start_warm_up(steps):
+    """Run each step in a daemon thread; failures are logged, not raised."""
+    def run():
+        for step in steps:
+            try:
+                step()
+            except Exception:
+                logger.exception('warm-up step %r failed', step)
+
+    thread = threading.Thread(target=run, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+def import_timings(module, top=20):
+    """(cumulative ms, self ms, module) of the slowest imports of a module."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        capture_output=True, text=True, check=True)
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        timings.append((int(cumulative) / 1000, int(own) / 1000,
+                        name.rstrip()))
+    return sorted(timings, reverse=True)[:top]
+
+
+def first_response(module, path, profile=None):
+    """Start-up timings and peak RSS of the app in a fresh interpreter."""
+    env = dict(os.environ)
+    if profile is not None:
+        env['APP_PROFILE'] = profile
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE.format(module=module, path=path)],
+        capture_output=True, text=True, check=True, env=env)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare_profiles(module, path, profiles):
+    probes = {profile: first_response(module, path, profile)
+              for profile in profiles}
+    base = probes.get('all')
+    for profile, probe in probes.items():
+        saved = ''
+        if base is not None and profile != 'all':
+            saved = ' (saves {:.0f} ms, {:.0f} MB)'.format(
+                base['warm_ms'] - probe['warm_ms'],
+                base['rss_mb'] - probe['rss_mb'])
+        logger.info('%-5s first response %4.0f ms, warm %5.0f ms, '
+                    'rss %4.0f MB, %4d modules%s', profile,
+                    probe['first_response_ms'], probe['warm_ms'],
+                    probe['rss_mb'], probe['modules'], saved)
+
+
+@click.command()
+@click.option('--module', default='app', show_default=True)
+@click.option('--path', default='/login_rain', show_default=True)
+@click.option('--top', default=20, show_default=True)
+@click.option('--target-ms', default=FIRST_RESPONSE_TARGET_MS,
+              show_default=True)
+@click.option('--check', is_flag=True,
+              help='Exit non-zero if the first response misses the target.')
+@click.option('--profile', '-p', 'profiles', multiple=True,
+              help='Compare deployment profiles, e.g. -p all -p rain -p crop.')
+def main(module, path, top, target_ms, check, profiles):
+    """ Reports import timings and time to first response of the app.
+    """
+    if profiles:
+        compare_profiles(module, path, profiles)
+        return
+    for cumulative, own, name in import_timings(module, top):
+        logger.info('%8.1f ms %8.1f ms  %s', cumulative, own, name)
+    probe = first_response(module, path)
+    logger.info('GET %s -> %d: import %.0f ms, first response %.0f ms '
+                '(target %d ms)', path, probe['status'], probe['import_ms'],
+                probe['first_response_ms'], target_ms)
+    if check and (probe['first_response_ms'] > target_ms
+                  or probe['status'] >= 500):
+        raise SystemExit('first response took {:.0f} ms, target is {} ms'
+                         .format(probe['first_response_ms'], target_ms))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
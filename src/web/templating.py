@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Template compilation and rendered-fragment caching.
+
+Compiled templates go to a ``FileSystemBytecodeCache`` on disk, so every
+worker process (and every restart) loads the bytecode instead of parsing
+the HTML again. ``compile_templates`` fills that cache ahead of time at
+deploy. Jinja keys each entry by the template's name and a checksum of its
+source, so an edited template is never served from a stale entry.
+
+Forecast tables depend only on the model version, the horizon, the levels
+and the first forecast month. ``FragmentCache`` keeps recently rendered
+tables keyed on those values. ``render_fragment`` streams a table while it
+renders and stores it once it is complete.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+BYTECODE_DIR = 'models/cache/templates'
+
+logger = logging.getLogger(__name__)
+
+
+def install_bytecode_cache(app, cache_dir=BYTECODE_DIR):
+    """Point the app's Jinja environment at an on-disk bytecode cache.
+
+    Must run before the first template is rendered.
+    """
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    app.jinja_options = dict(app.jinja_options,
+                             bytecode_cache=FileSystemBytecodeCache(
+                                 os.fspath(cache_dir)))
+
+
+def compile_templates(app):
+    """Compile every template into the bytecode cache; returns the names."""
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+
+class FragmentCache:
+    """Bounded LRU of rendered fragments, shared by request threads."""
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._fragments = OrderedDict()
+        # A lookup and its move_to_end must not interleave with an eviction
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._fragments.move_to_end(key)
+            return fragment
+
+    def set(self, key, fragment):
+        with self._lock:
+            self._fragments[key] = fragment
+            self._fragments.move_to_end(key)
+            if len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._fragments), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+def render_fragment(env, cache, key, template_name, **context):
+    """Yield a rendered fragment, from ``cache`` or rendered chunk by chunk.
+
+    Chunks are already escaped, so they are yielded as Markup. A fully
+    rendered fragment is stored under ``key``.
+    """
+    fragment = cache.get(key)
+    if fragment is not None:
+        yield fragment
+        return
+    parts = []
+    for chunk in env.get_template(template_name).generate(**context):
+        parts.append(chunk)
+        yield Markup(chunk)
+    cache.set(key, Markup(''.join(parts)))
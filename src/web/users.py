@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""User accounts in the app's SQLite database.
+
+The table is the one Flask-SQLAlchemy created for the former ``User``
+model, so existing ``instance/database.db`` files keep working. Plain
+sqlite3 keeps SQLAlchemy out of worker start-up.
+"""
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+import bcrypt
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user (
+    id INTEGER NOT NULL PRIMARY KEY,
+    email VARCHAR(20) UNIQUE,
+    password VARCHAR(60) NOT NULL
+)
+"""
+
+
+class UserStore:
+    """Registration and password checks against the ``user`` table."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(SCHEMA)
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=10,
+                                       isolation_level=None))
+
+    def exists(self, email):
+        with self._connect() as conn:
+            return conn.execute('SELECT 1 FROM user WHERE email = ?',
+                                (email,)).fetchone() is not None
+
+    def add(self, email, password):
+        """Register a user; False if the email is already taken."""
+        hashed = bcrypt.hashpw(password.encode('utf-8'),
+                               bcrypt.gensalt()).decode('utf-8')
+        try:
+            with self._connect() as conn:
+                conn.execute('INSERT INTO user (email, password) '
+                             'VALUES (?, ?)', (email, hashed))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def check(self, email, password):
+        with self._connect() as conn:
+            row = conn.execute('SELECT password FROM user WHERE email = ?',
+                               (email,)).fetchone()
+        return row is not None and bcrypt.checkpw(password.encode('utf-8'),
+                                                  row[0].encode('utf-8'))
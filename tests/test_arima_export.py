@@ -0,0 +1,50 @@
+"""Forecasts of the slim ARIMA exports against the pickled models."""
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from src.models.arima_export import (TOLERANCE, VERIFY_HORIZON, SlimARIMA,
+                                     load_full, load_slim, slim_path, verify)
+from src.models.registry import REGIONS
+
+pytest.importorskip('pmdarima')
+
+ROOT = Path(__file__).resolve().parents[1]
+MODELS = [model_path for _, model_path in REGIONS.values()]
+LEVELS = (50, 80, 95, 99)
+
+
+@pytest.fixture(params=MODELS)
+def models(request, monkeypatch):
+    # Registry paths are relative to the repository root
+    monkeypatch.chdir(ROOT)
+    model_path = request.param
+    if not slim_path(model_path).exists():
+        pytest.skip('{} has no slim export'.format(model_path))
+    slim = load_slim(model_path)
+    assert slim is not None, 'slim export of {} is stale'.format(model_path)
+    return load_full(model_path), slim
+
+
+def test_slim_forecast_matches_full_model(models):
+    full, slim = models
+    for level in LEVELS:
+        alpha = 1 - level / 100
+        mean, bounds = full.predict(n_periods=VERIFY_HORIZON,
+                                    return_conf_int=True, alpha=alpha)
+        slim_mean, slim_bounds = slim.predict(n_periods=VERIFY_HORIZON,
+                                              return_conf_int=True,
+                                              alpha=alpha)
+        scale = max(1.0, float(np.abs(bounds).max()))
+        np.testing.assert_allclose(slim_mean, mean, rtol=0,
+                                   atol=TOLERANCE * scale)
+        np.testing.assert_allclose(slim_bounds, bounds, rtol=0,
+                                   atol=TOLERANCE * scale)
+
+
+def test_saved_export_round_trips(models, tmp_path):
+    full, slim = models
+    path = tmp_path / 'model.npz'
+    slim.save(path)
+    assert verify(full, SlimARIMA.load(path)) <= TOLERANCE
@@ -0,0 +1,60 @@
+"""Climatology cubes updated in place against ones rebuilt from scratch."""
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from src.features.climatology import Climatology
+from src.models.registry import RAINFALL_DATA
+
+pd = pytest.importorskip('pandas')
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture(scope='module')
+def rainfall():
+    path = ROOT / RAINFALL_DATA
+    if not path.exists():
+        pytest.skip('no rainfall data')
+    return pd.read_csv(path)
+
+
+def assert_same_cube(updated, rebuilt):
+    assert updated.subdivisions == rebuilt.subdivisions
+    assert updated.buckets == rebuilt.buckets
+    np.testing.assert_allclose(updated.stats, rebuilt.stats, rtol=1e-5,
+                               equal_nan=True)
+
+
+def test_append_new_years_matches_rebuild(rainfall):
+    last = rainfall['YEAR'].max()
+    # The last three years, so the newest decade is refreshed, not added
+    old = rainfall[rainfall['YEAR'] <= last - 3]
+    new = rainfall[rainfall['YEAR'] > last - 3]
+    climatology = Climatology.from_frame(old)
+    climatology.append(new)
+    assert_same_cube(climatology, Climatology.from_frame(rainfall))
+
+
+def test_append_replaced_rows_matches_rebuild(rainfall):
+    climatology = Climatology.from_frame(rainfall)
+    changed = rainfall[rainfall['YEAR'] == rainfall['YEAR'].min() + 12]
+    changed = changed.assign(JAN=changed['JAN'] + 100.0)
+    affected = climatology.append(changed)
+    assert affected == sorted(changed['SUBDIVISION'].unique())
+    expected = pd.concat([rainfall.drop(changed.index), changed])
+    assert_same_cube(climatology, Climatology.from_frame(expected))
+
+
+def test_append_new_subdivision_matches_rebuild(rainfall):
+    first = sorted(rainfall['SUBDIVISION'].unique())[0]
+    old = rainfall[rainfall['SUBDIVISION'] != first]
+    climatology = Climatology.from_frame(old)
+    climatology.append(rainfall[rainfall['SUBDIVISION'] == first])
+    rebuilt = Climatology.from_frame(rainfall)
+    # New subdivisions are added last, so compare them by name
+    for subdivision in rebuilt.subdivisions:
+        for period in ('JAN', 'ANNUAL'):
+            assert (climatology.lookup(subdivision, period)
+                    == rebuilt.lookup(subdivision, period))
@@ -0,0 +1,128 @@
+"""The SQLite job queue, requeueing after dead workers, and crop jobs."""
+import csv
+import os
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from src.models.registry import CROP_MODEL
+from src.web import jobs
+from src.web.jobs import MAX_ATTEMPTS, JobQueue, _process_start
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(tmp_path / 'jobs.db')
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_claims_oldest_job_of_the_given_kinds(queue):
+    first = queue.submit('forecast', {'months': 12})
+    crop = queue.submit('crop', {'input': 'x.csv'})
+    second = queue.submit('forecast', {'months': 24})
+    assert queue.claim(1, ('crop',))['id'] == crop
+    job = queue.claim(1)
+    assert (job['id'], job['status'], job['attempts']) == (
+        first, 'running', 1)
+    assert job['params'] == {'months': 12}
+    assert queue.claim(1)['id'] == second
+    assert queue.claim(1) is None
+
+
+def test_finish_records_result_or_error(queue):
+    done, failed = queue.submit('crop', {}), queue.submit('crop', {})
+    queue.claim(1), queue.claim(1)
+    queue.progress(done, 0.5)
+    assert queue.get(done)['progress'] == 0.5
+    queue.finish(done, result='out.csv')
+    queue.finish(failed, error='ValueError: bad row')
+    assert (queue.get(done)['status'], queue.get(done)['progress'],
+            queue.get(done)['result']) == ('done', 1, 'out.csv')
+    assert queue.get(failed)['status'] == 'failed'
+    assert queue.get(failed)['error'] == 'ValueError: bad row'
+
+
+def test_requeues_jobs_of_dead_workers_only(queue):
+    orphan = queue.submit('forecast', {})
+    queue.claim(dead_pid())
+    running = queue.submit('forecast', {})
+    queue.claim(os.getpid())
+    assert queue.requeue() == [orphan]
+    job = queue.get(orphan)
+    assert (job['status'], job['worker'], job['attempts']) == (
+        'queued', None, 1)
+    assert queue.get(running)['status'] == 'running'
+    # A pool replacing a worker names it, alive or not
+    assert queue.requeue([os.getpid()]) == [running]
+
+
+def test_fails_job_after_max_attempts(queue):
+    job_id = queue.submit('crop', {})
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        assert queue.claim(dead_pid())['attempts'] == attempt
+        requeued = queue.requeue()
+        assert requeued == ([job_id] if attempt < MAX_ATTEMPTS else [])
+    job = queue.get(job_id)
+    assert job['status'] == 'failed'
+    assert str(MAX_ATTEMPTS) in job['error']
+    assert queue.claim(1) is None
+
+
+@pytest.mark.skipif(_process_start(os.getpid()) is None,
+                    reason='needs /proc')
+def test_requeues_job_whose_pid_was_reused(queue):
+    job_id = queue.submit('forecast', {})
+    queue.claim(os.getpid())
+    assert queue.requeue() == []
+    # The same pid, started at another time: another process
+    with sqlite3.connect(queue.path) as conn:
+        conn.execute('UPDATE job SET worker_start = worker_start - 1')
+    assert queue.requeue() == [job_id]
+
+
+def test_adds_columns_to_older_queues(tmp_path):
+    path = tmp_path / 'jobs.db'
+    schema = jobs.SCHEMA
+    for name, definition in jobs.ADDED_COLUMNS.items():
+        schema = schema.replace('    {} {},\n'.format(name, definition), '')
+    with sqlite3.connect(path) as conn:
+        conn.executescript(schema)
+        conn.execute("INSERT INTO job (id, kind, params, created) "
+                     "VALUES ('old', 'crop', '{}', 0)")
+    queue = JobQueue(path)
+    assert queue.get('old')['attempts'] == 0
+    assert queue.claim(1)['attempts'] == 1
+
+
+def test_crop_job_streams_rows_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    if not Path(CROP_MODEL).exists():
+        pytest.skip('no crop model')
+    monkeypatch.setattr(jobs, 'CROP_CHUNK_ROWS', 7)
+    rng = np.random.default_rng(0)
+    X = np.round(rng.uniform(10, 100, (50, len(jobs.CROP_COLUMNS))), 2)
+    upload = tmp_path / 'upload.csv'
+    with open(upload, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id'] + jobs.CROP_COLUMNS)
+        writer.writerows([i] + row for i, row in enumerate(X.tolist()))
+    output, progress = tmp_path / 'result.csv', []
+    jobs.run_crop({'input': str(upload)}, output, progress.append)
+    with open(output, newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['id'] + jobs.CROP_COLUMNS + ['crop']
+    assert [row[0] for row in rows[1:]] == [str(i) for i in range(50)]
+    expected = jobs.load_compiled().predict_labels(X)
+    assert [row[-1] for row in rows[1:]] == expected.tolist()
+    assert len(progress) == 8 and progress[-1] == 1
@@ -0,0 +1,46 @@
+"""Time to first response of a freshly started app."""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from src.web.startup import FIRST_RESPONSE_TARGET_MS
+
+ROOT = Path(__file__).resolve().parents[1]
+# Timed from before the app's first import, as a worker starting up sees it
+SCRIPT = """
+import time
+started = time.perf_counter()
+from src.web.factory import create_app
+app = create_app()
+status = app.test_client().get('/login_rain').status_code
+print(status, (time.perf_counter() - started) * 1000)
+"""
+# Best of a few cold starts, so one slow scheduling blip does not fail it
+RUNS = 5
+
+
+def first_response(instance_path):
+    # Databases of its own, so the run neither touches instance/ nor counts
+    # against the login limits of other runs
+    env = dict(os.environ, INSTANCE_PATH=str(instance_path))
+    env.pop('RATELIMIT_STORAGE_URI', None)
+    env.pop('JOBS_DB', None)
+    env.pop('AUDIT_DB', None)
+    result = subprocess.run([sys.executable, '-c', SCRIPT], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    status, elapsed_ms = result.stdout.split()
+    return int(status), float(elapsed_ms)
+
+
+def test_first_response_under_target(tmp_path):
+    timings = []
+    for run in range(RUNS):
+        status, elapsed_ms = first_response(tmp_path / str(run))
+        assert status == 200
+        timings.append(elapsed_ms)
+        if elapsed_ms < FIRST_RESPONSE_TARGET_MS:
+            break
+    assert min(timings) < FIRST_RESPONSE_TARGET_MS, (
+        'first response took {:.0f} ms at best, target is {} ms'.format(
+            min(timings), FIRST_RESPONSE_TARGET_MS))
@@ -0,0 +1,69 @@
+"""Compiled forests against the XGBoost models they were compiled from."""
+import bz2
+import csv
+import pickle
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from src.models.registry import CROP_DATA, CROP_MODEL
+from src.models.tree_compiler import (CHUNK_ROWS, CompiledForest,
+                                      compile_model, crop_labels)
+
+xgboost = pytest.importorskip('xgboost')
+
+ROOT = Path(__file__).resolve().parents[1]
+FEATURES = ['N', 'P', 'K', 'temperature', 'humidity', 'ph', 'rainfall']
+
+
+@pytest.fixture(scope='module')
+def synthetic():
+    """A small model with uneven tree depths and missing values."""
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(600, 5)).astype(np.float32)
+    y = (X[:, 0] > 0).astype(int) + (X[:, 1] + X[:, 2] > 0.5)
+    X[rng.random(X.shape) < 0.1] = np.nan
+    model = xgboost.XGBClassifier(n_estimators=20, max_depth=4,
+                                  learning_rate=0.3)
+    model.fit(X, y)
+    return model, X
+
+
+def test_compiled_forest_matches_xgboost(synthetic, tmp_path):
+    model, X = synthetic
+    forest = compile_model(model, ['a', 'b', 'c'], str(tmp_path / 'm.npz'))
+    # More rows than one chunk, so the chunk boundaries are covered
+    assert len(X) > CHUNK_ROWS
+    np.testing.assert_allclose(forest.predict_proba(X),
+                               model.predict_proba(X), rtol=0, atol=1e-5)
+    np.testing.assert_array_equal(forest.predict(X), model.predict(X))
+    np.testing.assert_array_equal(forest.predict_labels(X[:3]),
+                                  np.array(['a', 'b', 'c'])[
+                                      model.predict(X[:3])])
+
+
+def test_saved_forest_round_trips(synthetic, tmp_path):
+    model, X = synthetic
+    path = tmp_path / 'm.npz'
+    forest = compile_model(model, ['a', 'b', 'c'], str(path), 'v1')
+    loaded = CompiledForest.load(path)
+    assert loaded.source_version == 'v1'
+    np.testing.assert_array_equal(loaded.predict_margin(X),
+                                  forest.predict_margin(X))
+
+
+def test_crop_model_matches_xgboost(tmp_path):
+    model_path, data_path = ROOT / CROP_MODEL, ROOT / CROP_DATA
+    if not model_path.exists() or not data_path.exists():
+        pytest.skip('no crop model or data')
+    with bz2.BZ2File(model_path, 'rb') as f:
+        model = pickle.load(f)
+    with open(data_path, newline='', encoding='utf-8') as f:
+        X = np.array([[row[name] for name in FEATURES]
+                      for row in csv.DictReader(f)], dtype=np.float32)
+    forest = compile_model(model, crop_labels(data_path),
+                           str(tmp_path / 'XB.npz'))
+    np.testing.assert_array_equal(forest.predict(X), model.predict(X))
+    np.testing.assert_allclose(forest.predict_proba(X),
+                               model.predict_proba(X), rtol=0, atol=1e-5)